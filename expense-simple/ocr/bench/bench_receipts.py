@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""Benchmark and regression suite for the receipt pipeline.
+
+    python bench/bench_receipts.py                 # both tiers, check golden outputs
+    python bench/bench_receipts.py --tier text     # parser/categorizer only (no cv2 needed)
+    python bench/bench_receipts.py --update-golden # accept the current outputs
+    python bench/bench_receipts.py --record-fixtures  # re-record fixture boxes with the OCR engine
+
+Tier "text" replays the recorded OCR boxes in fixtures.json (one entry per
+distinct _work_*_clean.png receipt) and synthetic receipts of growing length
+through parse_fields, parse_line_items and ReceiptCategorizer.predict.
+Each fixture also carries "expected": the merchant, amount, date and items
+read off the receipt by hand. The row parser must reproduce them, except
+for the fields listed under "known_gaps" with what it reads instead (a
+known parser bug, e.g. D/M/Y dates on a receipt without "RM"); unlike
+golden.json neither is rewritten by --update-golden, and a gap that closes
+fails the run until it is taken out.
+Tier "images" times decode + preprocess_image (+ OCR when PaddleOCR is
+installed, unless --no-ocr) on the fixture images.
+
+Every case reports p50/p95 latency in ms and the peak traced allocation in
+MB; the process peak RSS is printed at the end. Merchant/amount/date/items
+are compared against golden.json and any difference makes the run exit 1.
+"""
+import os, sys, io, json, time, random, hashlib, argparse, tracemalloc
+from contextlib import redirect_stderr
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+OCR_DIR = os.path.dirname(HERE)
+sys.path.insert(0, OCR_DIR)
+
+import extract_receipt as er
+from ocr_metrics import peak_rss_mb
+
+FIXTURES = os.path.join(HERE, "fixtures.json")
+GOLDEN = os.path.join(HERE, "golden.json")
+GOLDEN_FIELDS = ("merchant", "amount", "date", "items")
+DEFAULT_SIZES = (100, 1000, 5000)
+
+
+# ---------- inputs ----------
+def _paddle_result(boxes):
+    """Recorded [text, score, [x0, y0, x1, y1]] boxes in PaddleOCR 2.x shape."""
+    page = []
+    for text, score, (x0, y0, x1, y1) in boxes:
+        page.append([[[x0, y0], [x1, y0], [x1, y1], [x0, y1]], (text, score)])
+    return [page]
+
+
+def _page(boxes):
+    """(lines, rows) exactly as ocr_lines derives them from an OCR result."""
+    res = _paddle_result(boxes)
+    lines = er._drop_path_lines(er._result_lines(res))
+    rows = er.group_rows(er._flatten_boxes(res))
+    return lines, rows
+
+
+def load_fixtures(path=FIXTURES):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_fixtures(fixtures, path=FIXTURES):
+    """Write fixtures.json in its diff-friendly layout: one box per line."""
+    out = ["["]
+    for n, fx in enumerate(fixtures):
+        out.append(f'  {{"name": {json.dumps(fx["name"])}, "image": {json.dumps(fx["image"])},')
+        if "expected" in fx:
+            out.append(f'   "expected": {json.dumps(fx["expected"], ensure_ascii=False)},')
+        if "known_gaps" in fx:
+            out.append(f'   "known_gaps": {json.dumps(fx["known_gaps"], ensure_ascii=False)},')
+        out.append('   "boxes": [')
+        boxes = [f"    {json.dumps(b, ensure_ascii=False)}" for b in fx["boxes"]]
+        out.append(",\n".join(boxes))
+        out.append("  ]}" + ("," if n < len(fixtures) - 1 else ""))
+    out.append("]")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(out) + "\n")
+
+
+def record_fixtures(path=FIXTURES):
+    """Replace each fixture's boxes with what the configured OCR engine reads off its image.
+
+    The fixture images are preprocess_image output already, so they go to the
+    engine as they are. Names, images and "expected" are kept.
+    """
+    import cv2
+    ocr = er.create_ocr()
+    fixtures = load_fixtures(path)
+    for fx in fixtures:
+        img = cv2.imread(os.path.join(OCR_DIR, fx["image"]))
+        if img is None:
+            raise SystemExit(f"cannot read {fx['image']}")
+        boxes = er._flatten_boxes(ocr.ocr(img))
+        fx["boxes"] = [[t, round(score, 4), [int(round(v)) for v in b]] for t, score, b in boxes]
+        print(f"{fx['name']:<20} {len(boxes)} boxes", flush=True)
+    save_fixtures(fixtures, path)
+    print(f"fixtures written to {path}; check the expected values, then --update-golden", flush=True)
+
+
+SYNTH_WORDS = (
+    "NASI LEMAK AYAM GORENG TEH TARIK MILO ICE KOPI O ROTI CANAI MEE GORENG "
+    "MINERAL WATER 600ML SPRITZER OISHI CHIPS BREAD GARDENIA EGG GRED A SUGAR "
+    "PANADOL SHAMPOO TISSUE DETERGENT RICE 5KG COOKING OIL MAGGI CURRY CHICKEN"
+).split()
+
+
+def synthetic_receipt(n_lines, seed=0):
+    """Boxes for a plausible receipt about n_lines OCR lines long (deterministic per seed)."""
+    rnd = random.Random(seed)
+    boxes, y = [], 100
+    W = 1400
+
+    def add(text, x0, x1, h=50):
+        boxes.append([text, 0.95, [x0, y, x1, y + h]])
+
+    for text in ("FamilyMart", "QL Maxincome Sdn Bhd 383322-D", "Jalan Astaka U8/83, Shah Alam"):
+        add(text, 200, 1200)
+        y += 70
+    add("07/10/2025 1:36", 60, 600)
+    add("#1000191467", 900, 1300)
+    y += 70
+    add("Desc", 60, 220)
+    add("Amt(RM)", 1100, 1340)
+    y += 90
+
+    total = 0.0
+    while len(boxes) < n_lines - 6:
+        desc = " ".join(rnd.choice(SYNTH_WORDS) for _ in range(rnd.randint(1, 4)))
+        unit = rnd.randint(50, 5000) / 100.0
+        qty = rnd.choice((1, 1, 1, 2, 3))
+        if rnd.random() < 0.3:
+            desc = f"{rnd.randint(1000, 9999)} {desc}"
+        add(desc, 60, 60 + 28 * len(desc))
+        if qty > 1:
+            y += 60
+            add(f"{qty} x {unit:.2f}", 100, 420)
+        add(f"{qty * unit:.2f}", W - 260, W - 60)
+        total += qty * unit
+        y += 70
+    y += 40
+    add("TOTAL", 60, 300, h=80)
+    add(f"{total:.2f}", W - 300, W - 60, h=80)
+    y += 110
+    add("Cash", 60, 260)
+    add(f"{total + 10:.2f}", W - 300, W - 60)
+    y += 70
+    add("Thank you", 500, 900)
+    return boxes
+
+
+# ---------- measurement ----------
+def _pct(values, p):
+    s = sorted(values)
+    if not s:
+        return 0.0
+    k = (len(s) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(s) - 1)
+    return s[lo] + (s[hi] - s[lo]) * (k - lo)
+
+
+def measure(fn, repeat):
+    """Run fn repeat times; return (last result, [ms per run], peak traced MB of one run)."""
+    out, times = None, []
+    sink = io.StringIO()
+    for i in range(repeat):
+        traced = i == 0
+        if traced:
+            tracemalloc.start()
+        t = time.perf_counter()
+        with redirect_stderr(sink):  # pipeline DEBUG chatter is not part of the workload
+            out = fn()
+        times.append((time.perf_counter() - t) * 1000.0)
+        if traced:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            # the traced run pays tracemalloc overhead; keep it out of the latency figures
+            if repeat > 1:
+                times.pop()
+        sink.seek(0)
+        sink.truncate()
+    return out, times, peak / (1024.0 * 1024.0)
+
+
+class Report:
+    def __init__(self):
+        self.cases = []
+        self.failures = []
+
+    def add(self, name, times, mem_mb, **extra):
+        case = {"case": name, "n": len(times), "p50_ms": round(_pct(times, 50), 3),
+                "p95_ms": round(_pct(times, 95), 3), "peak_mb": round(mem_mb, 2)}
+        case.update(extra)
+        self.cases.append(case)
+        print(f"{name:<42} p50 {case['p50_ms']:>10.3f} ms   p95 {case['p95_ms']:>10.3f} ms"
+              f"   peak {case['peak_mb']:>8.2f} MB", flush=True)
+
+    def check_expected(self, name, expected, actual, known_gaps=None):
+        """Hand-read fields; items compare on qty, desc and total (categories are the categorizer's call).
+
+        known_gaps maps a field to the wrong value the parser is known to read.
+        """
+        got = {k: actual.get(k) for k in ("merchant", "amount", "date")}
+        got["items"] = [{"qty": it["qty"], "desc": it["desc"], "total": it["total"]}
+                        for it in actual.get("items") or []]
+        if known_gaps:
+            print(f"  known gap {name}: {json.dumps(known_gaps, ensure_ascii=False)}"
+                  f" (right: {json.dumps({k: expected[k] for k in known_gaps}, ensure_ascii=False)})", flush=True)
+            expected = dict(expected, **known_gaps)
+        if got != expected:
+            key = f"{name}/expected"
+            self.failures.append(key)
+            print(f"  WRONG {key}:\n    expected {json.dumps(expected, ensure_ascii=False)}"
+                  f"\n    actual   {json.dumps(got, ensure_ascii=False)}", flush=True)
+
+    def check(self, golden, key, actual, update):
+        if update:
+            golden[key] = actual
+            return
+        if key not in golden:
+            print(f"  (no golden for {key}; run with --update-golden)", flush=True)
+            return
+        if golden[key] != actual:
+            self.failures.append(key)
+            print(f"  GOLDEN MISMATCH {key}:\n    expected {json.dumps(golden[key], ensure_ascii=False)}"
+                  f"\n    actual   {json.dumps(actual, ensure_ascii=False)}", flush=True)
+
+
+def _fields(result):
+    return {k: result.get(k) for k in GOLDEN_FIELDS}
+
+
+def _digest(result):
+    return hashlib.sha256(json.dumps(_fields(result), sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+# ---------- tier 1: text ----------
+def bench_text(report, golden, repeat, sizes, update):
+    cat = er.get_categorizer()
+    descs = []
+    for fx in load_fixtures():
+        name = fx["name"]
+        lines, rows = _page(fx["boxes"])
+        out, times, mem = measure(lambda: er.parse_fields(lines, rows), repeat)
+        report.add(f"text.parse_fields[rows] {name}", times, mem, lines=len(lines))
+        report.check(golden, f"{name}/rows", _fields(out), update)
+        if "expected" in fx:
+            report.check_expected(name, fx["expected"], out, fx.get("known_gaps"))
+
+        out, times, mem = measure(lambda: er.parse_fields(lines), repeat)
+        report.add(f"text.parse_fields[lines] {name}", times, mem, lines=len(lines))
+        report.check(golden, f"{name}/lines", _fields(out), update)
+
+        _, times, mem = measure(lambda: er.parse_line_items(lines, cat), repeat)
+        report.add(f"text.parse_line_items {name}", times, mem, lines=len(lines))
+        descs.extend(lines)
+
+    # a fresh categorizer per run so the memo does not turn this into a dict lookup
+    def predict_all():
+        c = type(cat)()
+        return [c.predict(d) for d in descs]
+    out, times, mem = measure(predict_all, repeat)
+    report.add(f"text.predict x{len(descs)}", times, mem)
+    report.check(golden, "predict", out, update)
+
+    for n in sizes:
+        lines, rows = _page(synthetic_receipt(n, seed=n))
+        r = max(1, repeat // (1 + n // 1000))
+        out, times, mem = measure(lambda: er.parse_fields(lines, rows), r)
+        report.add(f"text.parse_fields[rows] synthetic {n}", times, mem, lines=len(lines))
+        report.check(golden, f"synthetic-{n}/rows", _digest(out), update)
+
+        out, times, mem = measure(lambda: er.parse_fields(lines), r)
+        report.add(f"text.parse_fields[lines] synthetic {n}", times, mem, lines=len(lines))
+        report.check(golden, f"synthetic-{n}/lines", _digest(out), update)
+
+
+# ---------- tier 2: images ----------
+def bench_images(report, golden, repeat, use_ocr, update):
+    try:
+        import cv2  # noqa: F401
+    except ImportError:
+        print("DEBUG: cv2 not installed; skipping image tier", file=sys.stderr, flush=True)
+        return
+    ocr = None
+    if use_ocr:
+        try:
+            with redirect_stderr(io.StringIO()):
+                ocr = er.create_ocr()
+        except Exception as e:
+            print(f"DEBUG: OCR engine unavailable ({type(e).__name__}: {e}); timing preprocess only",
+                  file=sys.stderr, flush=True)
+
+    for fx in load_fixtures():
+        name = fx["name"]
+        with open(os.path.join(OCR_DIR, fx["image"]), "rb") as f:
+            data = f.read()
+
+        def prep():
+            return er.preprocess_image(er.decode_image(data))
+        clean, times, mem = measure(prep, repeat)
+        report.add(f"image.preprocess {name}", times, mem, image=fx["image"])
+        report.check(golden, f"{name}/clean_shape", list(clean.shape), update)
+
+        if ocr is None:
+            continue
+        r = max(1, repeat // 5)
+        (lines, rows), times, mem = measure(lambda: er.ocr_lines(data, ocr), r)
+        report.add(f"image.ocr_lines {name}", times, mem, image=fx["image"])
+        report.check(golden, f"{name}/ocr", _fields(er.parse_fields(lines, rows)), update)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark the receipt pipeline and check golden outputs.")
+    ap.add_argument("--tier", choices=("text", "images", "all"), default="all")
+    ap.add_argument("--repeat", type=int, default=20, help="runs per case (default 20)")
+    ap.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                    help="synthetic receipt lengths in OCR lines (default %(default)s)")
+    ap.add_argument("--no-ocr", action="store_true", help="image tier: time preprocessing only")
+    ap.add_argument("--update-golden", action="store_true", help="overwrite golden.json with current outputs")
+    ap.add_argument("--record-fixtures", action="store_true",
+                    help="re-record fixtures.json boxes with the OCR engine and exit")
+    ap.add_argument("--json", metavar="PATH", help="also write the report as JSON")
+    args = ap.parse_args()
+    if args.record_fixtures:
+        record_fixtures()
+        return
+
+    golden = {}
+    if os.path.exists(GOLDEN):
+        with open(GOLDEN, encoding="utf-8") as f:
+            golden = json.load(f)
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    repeat = max(2, args.repeat)
+
+    report = Report()
+    if args.tier in ("text", "all"):
+        bench_text(report, golden, repeat, sizes, args.update_golden)
+    if args.tier in ("images", "all"):
+        bench_images(report, golden, repeat, not args.no_ocr, args.update_golden)
+    rss = peak_rss_mb()
+    print(f"peak RSS {rss} MB", flush=True)
+
+    if args.update_golden:
+        with open(GOLDEN, "w", encoding="utf-8") as f:
+            json.dump(golden, f, ensure_ascii=False, indent=1, sort_keys=True)
+            f.write("\n")
+        print(f"golden outputs written to {GOLDEN}", flush=True)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"cases": report.cases, "peak_rss_mb": rss, "golden_failures": report.failures},
+                      f, indent=1)
+    if report.failures:
+        print(f"{len(report.failures)} golden/expected mismatch(es)", flush=True)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,65 @@
-import re
+import os, re, sys, hashlib, threading
+
+# memoized predictions per instance; bulk re-categorization repeats descriptions a lot
+_MEMO_LIMIT = 50000
+
+_WORD = re.compile(r"\w+")
+_PLAIN_WORD = re.compile(r"\w+", re.A)
+_LEADING_WORD = re.compile(r"[a-z0-9]", re.I)
+_UPPER_LITERAL = re.compile(r"(?<!\\)[A-Z]")
+_WRAPPED = re.compile(r"^\\b\((.*)\)\\b$", re.S)
+
+# optional learned model (see learned_categorizer.py); SMARTSPEND_CATEGORY_MODEL=0 disables it
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "category_model")
+
+
+def _split_alternatives(pattern):
+    """Split r"\b(a|b|c)\b" into [a, b, c]; None for any other shape."""
+    m = _WRAPPED.match(pattern)
+    if not m:
+        return None
+    body, alts, depth, cur, i = m.group(1), [], 0, [], 0
+    while i < len(body):
+        ch = body[i]
+        if ch == "\\":
+            cur.append(body[i:i + 2])
+            i += 2
+            continue
+        if ch == "[":
+            j = body.index("]", i + 2)  # character classes never contain "|" at depth
+            cur.append(body[i:j + 1])
+            i = j + 1
+            continue
+        if ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+            if depth < 0:
+                return None
+        elif ch == "|" and depth == 0:
+            alts.append("".join(cur))
+            cur = []
+            i += 1
+            continue
+        cur.append(ch)
+        i += 1
+    alts.append("".join(cur))
+    return alts if depth == 0 else None
+
 
 class ReceiptCategorizer:
-    def __init__(self):
+    """Rule-based item categorizer; earlier rules win when several match.
+
+    Rules are compiled once into an engine: plain keyword alternatives go into
+    a word -> rule-index table (one dict lookup per word of the description).
+    The remaining alternatives become one combined pattern that is tried only
+    at word starts, and only for rules that outrank the best keyword hit.
+    Custom rules of any other shape are searched as before. The engine is
+    rebuilt lazily after add_rule().
+    """
+
+    def __init__(self, model=None):
+        self.model = model  # learned model, consulted before the rules when confident
         self.rules = [
             # Food & Dining / Groceries
             (re.compile(r"\b(oishi|spritzer|milo|nestl[eé]|maggi|noodle|noodles|mee|biscuit|chips?|pan(chos)?|bread|milk|yogurt|coffee|kopi|tea|teh|sugar|rice|nasi|ayam|chicken|grill|pasta|butter|buttermilk|burger|sandwich|egg|telur|snack|drink|beverage|mineral\s*water|air\s*mineral|orange|juice|family\s*mart|speed\s*mart|bungkus|coriander)\b", re.I), "Food & Dining"),
@@ -22,16 +80,186 @@ class ReceiptCategorizer:
             # Entertainment
             (re.compile(r"\b(cinema|movie|spotify|netflix|voucher|top\s*up)\b", re.I), "Entertainment & Leisure"),
         ]
+        self._compiled_for = -1
+        self._memo = {}
+        self._memo_lock = threading.Lock()
+
+    def _engine(self):
+        """Build the keyword table and the residual pattern parts for all rules."""
+        if self._compiled_for != len(self.rules):
+            keywords, anchored, free = {}, [], []
+            self._needs_i = False
+            for i, (rx, _cat) in enumerate(self.rules):
+                alts = _split_alternatives(rx.pattern) if rx.flags & re.I else None
+                if alts is None or any(not _LEADING_WORD.match(a) for a in alts):
+                    pat = rx.pattern if rx.flags & re.I else f"(?-i:{rx.pattern})"
+                    free.append((i, f"(?P<r{i}>{pat})"))
+                    continue
+                rest = []
+                for alt in alts:
+                    if _PLAIN_WORD.fullmatch(alt):
+                        # r"\bword\b" matches exactly when "word" is a whole \w+ token
+                        keywords.setdefault(alt.lower(), i)
+                    else:
+                        rest.append(alt)
+                if rest:
+                    # every alternative starts with a word char, so the leading \b
+                    # holds exactly at word starts; match() is only tried there
+                    body = "|".join(rest)
+                    self._needs_i = self._needs_i or bool(_UPPER_LITERAL.search(body))
+                    anchored.append((i, "(?P<r%d>(?:%s)\\b)" % (i, body)))
+            self._keywords = keywords
+            self._anchored = anchored
+            self._free = free
+            self._prefixes = {}
+            self._compiled_for = len(self.rules)
+            self._memo = {}
+
+    def _combined(self, kind, limit):
+        """Combined pattern of rules[:limit] from the anchored or free parts, or None."""
+        key = (kind, limit)
+        if key not in self._prefixes:
+            parts = [p for i, p in (self._anchored if kind == "a" else self._free) if i < limit]
+            pattern = "|".join(parts)
+            # descriptions are lowercased, so lowercase patterns can skip re.I
+            # (which would disable the regex engine's prefix scan)
+            flags = re.I if kind == "f" or self._needs_i else 0
+            self._prefixes[key] = re.compile(pattern, flags) if parts else None
+        return self._prefixes[key]
+
+    def _best_rule(self, t):
+        """Index of the highest-priority rule matching anywhere in t, or None."""
+        self._engine()
+        n = best = len(self.rules)
+        kw = self._keywords
+        starts = []
+        for m in _WORD.finditer(t):
+            i = kw.get(m.group())
+            if i is not None and i < best:
+                best = i
+            starts.append(m.start())
+        if self._anchored:
+            for pos in starts:
+                if best == 0:
+                    break
+                rx = self._combined("a", best)
+                if rx is None:
+                    break
+                # alternatives are tried in priority order at this position
+                m = rx.match(t, pos)
+                if m is not None:
+                    best = int(m.lastgroup[1:])
+        if self._free:
+            # the first match at a position is the best one starting there, but a
+            # higher-priority rule can still match later, so keep scanning
+            pos = 0
+            while best > 0:
+                rx = self._combined("f", best)
+                m = rx.search(t, pos) if rx is not None else None
+                if m is None:
+                    break
+                best = int(m.lastgroup[1:])
+                pos = m.start() + 1
+        return best if best < n else None
 
     def predict(self, text: str) -> str:
         t = text.lower()
-        for rx, cat in self.rules:
-            if rx.search(t):
-                return cat
-        return "Other"
+        self._engine()
+        cat = self._memo.get(t)
+        if cat is None:
+            cat = self.predict_many([text])[0]
+        return cat
+
+    def _rule_category(self, t):
+        i = self._best_rule(t)
+        return self.rules[i][1] if i is not None else "Other"
+
+    def predict_many(self, descs):
+        """Categorize a batch of descriptions; repeated descriptions are scanned once.
+
+        With a learned model the unseen descriptions go through it in one batch;
+        the rules decide wherever the model is unsure.
+        """
+        self._engine()
+        keys = [d.lower() for d in descs]
+        # extract_many threads share this instance: a full memo is replaced, never
+        # emptied in place, so the dict read here keeps every entry it had
+        memo = self._memo
+        todo = list(dict.fromkeys(k for k in keys if k not in memo))
+        if not todo:
+            return [memo[k] for k in keys]
+        learned = self.model.predict(todo) if self.model is not None else [None] * len(todo)
+        found = {t: cat or self._rule_category(t) for t, cat in zip(todo, learned)}
+        with self._memo_lock:
+            if len(self._memo) + len(found) > _MEMO_LIMIT:
+                self._memo = found
+            else:
+                self._memo.update(found)
+        return [found[k] if k in found else memo[k] for k in keys]
 
     def add_rule(self, pattern: str, category: str):
         self.rules.append((re.compile(pattern, re.I), category))
 
     def get_all_categories(self):
         return sorted({cat for _, cat in self.rules})
+
+
+_shared = None
+_shared_fingerprint = ""
+
+
+def _model_path():
+    return os.environ.get("SMARTSPEND_CATEGORY_MODEL", MODEL_DIR)
+
+
+def _disk_fingerprint(path):
+    """Short id of the model files at path ("" for none): meta.json and the (tiny) bias array,
+    plus the size and mtime of the weights, which are too big to hash per request."""
+    if path in ("", "0", "off"):
+        return ""
+    h = hashlib.sha256()
+    try:
+        for name in ("meta.json", "bias.npy"):
+            with open(os.path.join(path, name), "rb") as f:
+                h.update(f.read())
+        st = os.stat(os.path.join(path, "weights.npy"))
+        h.update(f"{st.st_size}:{st.st_mtime_ns}".encode("utf-8"))
+    except OSError:
+        return ""
+    h.update((os.environ.get("SMARTSPEND_CATEGORY_MIN_CONF") or "").encode("utf-8"))
+    return h.hexdigest()[:12]
+
+
+def model_fingerprint():
+    """Id of the learned model behind get_categorizer() ("" for rules only), for result versions.
+
+    Once the categorizer is loaded this is the model it holds (a retrained
+    model only takes effect after a restart); before that, the one on disk,
+    which costs a few stat calls and no numpy import.
+    """
+    if _shared is not None:
+        return _shared_fingerprint
+    return _disk_fingerprint(_model_path())
+
+
+def _load_model():
+    path = _model_path()
+    if path in ("", "0", "off") or not os.path.exists(os.path.join(path, "meta.json")):
+        return None
+    try:
+        from learned_categorizer import CategoryModel  # numpy is only needed with a model
+        return CategoryModel.load(path)
+    except Exception as e:
+        print(f"DEBUG: category model not loaded: {e}", file=sys.stderr, flush=True)
+        return None
+
+
+def get_categorizer() -> ReceiptCategorizer:
+    """Process-wide categorizer, compiled once and reused across receipts."""
+    global _shared, _shared_fingerprint
+    if _shared is None:
+        fingerprint = _disk_fingerprint(_model_path())
+        model = _load_model()
+        _shared_fingerprint = fingerprint if model is not None else ""
+        _shared = ReceiptCategorizer(model)
+    return _shared
@@ -1,693 +1,2634 @@
-# -*- coding: utf-8 -*-
-import sys, os, json, re
-from datetime import datetime
-from paddleocr import PaddleOCR
-import cv2
-import numpy as np
-from categorizer import ReceiptCategorizer
-
-
-
-# ---------- brand lexicon & helpers ----------
-BRAND_REGEXES = [
-    (r"\bstarbucks?\b|frappuccino|venti|grande|macchiato", "Starbucks"),
-    (r"\bnike\b|nike\.com|just\s*do\s*it", "Nike"),
-    (r"\badidas\b|adidas\.com", "Adidas"),
-    (r"\buniqlo\b|uniqlo\.com", "UNIQLO"),
-    (r"\b7[- ]?eleven\b|7eleven", "7-Eleven"),
-    (r"\bikea\b|ikea\.com", "IKEA"),
-    (r"\bsephora\b", "Sephora"),
-    (r"\bwatsons\b", "Watsons"),
-    (r"\bguardian\b", "Guardian"),
-    (r"\bpetronas\b", "Petronas"),
-    (r"\bshell\b", "Shell"),
-    (r"\bmr\.?\s*diy\b|mr[ -]?diy", "MR DIY"),
-    (r"\bdomino'?s\b", "Domino's"),
-    (r"\bpizza\s*h?ut\b", "Pizza Hut"),
-    (r"\bmc\s?donald'?s\b|mcd\b", "McDonald's"),
-    (r"\bsubway\b", "Subway"),
-    (r"\b99\s*speed\s*mart\b|99\s*speedmart|99speedmart", "99 Speedmart"),
-    (r"\bfamily\s*mart\b|familymart", "FamilyMart"),
-    (r"\bfamily\s*hart\b|familyhart", "FamilyMart"),
-    (r"\bbungkus\s+ikat\s+tepi\b", "Bungkus Ikat Tepi"),
-    (r"\bcoriander\s*&\s*coffee\b|c\s*&\s*c\b", "Coriander & Coffee"),
-    (r"\brosto\b", "Rosto"),
-]
-
-MERCHANT_CATEGORY_HINTS = {
-    "99 speedmart": "Food & Dining",
-    "speed mart": "Food & Dining",
-    "familymart": "Food & Dining",
-    "family mart": "Food & Dining",
-    "bungkus ikat tepi": "Food & Dining",
-    "coriander": "Food & Dining",
-    "rosto": "Food & Dining",
-    "petronas": "Transportation",
-    "primax": "Transportation",
-    "shell": "Transportation",
-}
-
-CURRENCY_RE = r"(?:RM|MYR|USD|SGD|GBP|EUR|\$|\u00a3|\u20ac)?"
-MONEY_CAPTURE = rf"{CURRENCY_RE}\s*(\d{{1,3}}(?:[.,]\d{{3}})+(?:[.,]\d{{1,2}})?|\d+(?:[.,]\d{{1,2}})?)"
-MONEY_TIGHT = re.compile(MONEY_CAPTURE)
-
-MAX_PLAUSIBLE_AMOUNT = 100000.0
-
-def _is_plausible_money(value: float) -> bool:
-    return value is not None and value > 0 and value <= MAX_PLAUSIBLE_AMOUNT
-
-DATE_LIKE = re.compile(r"\d{1,2}[-/]\d{1,2}[-/]\d{2,4}")
-TIME_LIKE = re.compile(r"\d{1,2}:\d{2}")
-TRAILING_DOT_PRICE = re.compile(r"^\s*\d+[.,]\s*$")
-
-def _norm_money(s: str) -> float:
-    # remove currency, normalize separators; handle "38,02" vs "38.02"
-    s = s.strip()
-    s = re.sub(r"(RM|MYR|USD|SGD|GBP|EUR|\$|\u00a3|\u20ac)", "", s, flags=re.I).strip()
-    # if exactly one comma and no dot => decimal comma
-    if s.count(",") == 1 and s.count(".") == 0:
-        s = s.replace(",", ".")
-    # otherwise commas are thousands separators
-    if s.count(".") == 1:
-        s = s.replace(",", "")
-    return float(s)
-
-def _looks_like_line(s: str) -> bool:
-    s = s.strip()
-    if not s:
-        return False
-    # keep currency/amount-only lines
-    if MONEY_TIGHT.search(s):
-        return True
-    # keep lines that contain at least 2 digits (e.g., "192.10", "170")
-    if sum(ch.isdigit() for ch in s) >= 2:
-        return True
-    # otherwise require some letters so we skip noise
-    letters = sum(ch.isalpha() for ch in s)
-    return len(s) >= 3 and letters >= 1
-
-
-def _flatten_text(ocr_out):
-    """Turn PaddleOCR output (any version) into text lines."""
-    lines = []
-
-    def walk(o):
-        if isinstance(o, (list, tuple)):
-            for it in o:
-                if (
-                    isinstance(it, (list, tuple)) and len(it) >= 2
-                    and isinstance(it[1], (list, tuple)) and it[1]
-                    and isinstance(it[1][0], str)
-                ):
-                    t = it[1][0].strip()
-                    if _looks_like_line(t):
-                        lines.append(t)
-                else:
-                    walk(it)
-        elif isinstance(o, dict):
-            for k in ("text", "transcription", "value", "content", "sentence"):
-                v = o.get(k)
-                if isinstance(v, str) and _looks_like_line(v):
-                    lines.append(v.strip())
-            for v in o.values():
-                walk(v)
-        elif isinstance(o, str):
-            if _looks_like_line(o):
-                lines.append(o.strip())
-
-    walk(ocr_out)
-    # de-dup while preserving order
-    seen, out = set(), []
-    for ln in lines:
-        key = (ln.lower(), len(ln))
-        if key not in seen:
-            seen.add(key)
-            out.append(ln)
-    return out
-
-# ---------- line-item helpers ----------
-ITEM_NOISE = re.compile(
-    r"\b(total|grand\s*total|cash|change|invoice|amount|amt|aot|qty|quantity|item(s)?|desc|"
-    r"no\.?\s*of|visit|url|request|e-?invoice|date|time|balance|due|amount\(rm\))\b",
-    re.I
-)
-QTY_LINE = re.compile(rf"^\s*(\d+)\s*[x\u00d7]\s*{MONEY_CAPTURE}\s*$", re.I)
-INLINE_PRICE = re.compile(rf"^(.*?)[\s\.]+{MONEY_CAPTURE}\s*$")
-SKU_PREFIX = re.compile(r"^\s*\d{3,8}\s+")  # drop leading item codes like "3645 "
-# price forms that appear without description
-X_PRICE     = re.compile(rf"^[x\u00d7]\s*{MONEY_CAPTURE}\s*$", re.I)     # "x 1.35" | "x1.35"
-PRICE_ONLY  = re.compile(rf"^\s*{MONEY_CAPTURE}\s*$")               # "29.90"
-SUMMARY_NEAR = re.compile(
-    r"(tota[l]?|grand\s*total|sub\s*total|cash\w*|change\w*|amount\s*\(rm\)|amount\s*due|balance\s*due|paid)",
-    re.I
-)
-
-
-
-def clean_desc(s: str) -> str:
-    s = SKU_PREFIX.sub("", s).strip()
-    # collapse multiple spaces & remove trailing punctuation
-    s = re.sub(r"\s{2,}", " ", s)
-    s = re.sub(r"[:\-\u2022]+$", "", s)
-    return s.title()
-
-def parse_line_items(lines, categorizer, receipt_total=None, merchant=None):
-    items = []
-    pending_desc = None
-
-    merchant_norm = (merchant or "").strip().lower()
-
-    # words that strongly indicate header/merchant lines, not items
-    HEADER_NOISE = re.compile(
-        r"\b(ssm|company|co\.?|s(?:dn)?\s*bhd|enterprise|tel\.?|phone|employee|cashier|pos|table|order|waiter|pax|number|time|product|qty|total?|amount|invoice|receipt|thank|powered\s*by|take\s*out|dine\s*in)\b",
-        re.I
-    )
-
-    def is_valid_desc(text: str) -> bool:
-        if not text:
-            return False
-        t = text.strip()
-        if not t:
-            return False
-        low = t.lower()
-        # require at least a couple of alphabetic characters so we skip lines like "1 X"
-        if sum(ch.isalpha() for ch in t) < 2:
-            return False
-        # do not use merchant name (or close variants) as an item description
-        if merchant_norm and len(merchant_norm) >= 4 and (low == merchant_norm or merchant_norm in low):
-            return False
-        if HEADER_NOISE.search(low):
-            return False
-        return True
-
-    def find_prev_desc(idx):
-        fragments = []
-        for back in range(1, 6):
-            j = idx - back
-            if j < 0:
-                break
-            cand = lines[j].strip()
-            if not cand:
-                if fragments:
-                    break
-                continue
-            if ITEM_NOISE.search(cand) or MONEY_TIGHT.search(cand):
-                if fragments:
-                    break
-                continue
-            if not is_valid_desc(cand):
-                if fragments:
-                    break
-                continue
-            fragments.append(cand)
-        if fragments:
-            return " ".join(reversed(fragments))
-        return None
-
-    def add_item(qty, desc, unit):
-        if not desc:
-            return
-        if not _is_plausible_money(unit):
-            return
-        # validate description (avoid merchant/header lines)
-        if not is_valid_desc(desc):
-            return
-        desc = clean_desc(desc)
-        total = f"{qty * unit:.2f}"
-        # de-dup: same desc + same total within the current list
-        key = (desc.lower(), total)
-        if any((it["desc"].lower(), it["total"]) == key for it in items):
-            return
-        cat = categorizer.predict(desc)
-        items.append({
-            "qty": qty,
-            "desc": desc,
-            "unit_price": f"{unit:.2f}",
-            "total": total,
-            "category": cat
-        })
-
-    for i, ln in enumerate(lines):
-        ln = ln.strip()
-        if not ln or ITEM_NOISE.search(ln):
-            continue
-
-        # 1) "1 x 4.95" -> pair with previous/pending description
-        m = QTY_LINE.match(ln)
-        if m:
-            qty = int(m.group(1))
-            unit = _norm_money(m.group(2))
-            if not _is_plausible_money(unit):
-                pending_desc = None
-                continue
-            desc = pending_desc or find_prev_desc(i)
-            add_item(qty, desc, unit)
-            pending_desc = None
-            continue
-
-        # 2) "DESC .... 1.35"
-        m2 = INLINE_PRICE.match(ln)
-        if m2 and sum(c.isalpha() for c in m2.group(1)) >= 4:
-            # If the *next* line is "1 x 1.35", let that one consume the desc to avoid a duplicate
-            if i + 1 < len(lines):
-                mnext = QTY_LINE.match(lines[i + 1] or "")
-                if mnext and abs(_norm_money(mnext.group(2)) - _norm_money(m2.group(2))) < 0.005:
-                    pending_desc = m2.group(1)  # remember the desc for the next line
-                    continue
-            add_item(1, m2.group(1), _norm_money(m2.group(2)))
-            pending_desc = None
-            continue
-
-        # 3) "x 1.35" -> assume qty=1, pair with previous/pending desc
-        mx = X_PRICE.match(ln)
-        if mx:
-            add_item(1, pending_desc or find_prev_desc(i), _norm_money(mx.group(1)))
-            pending_desc = None
-            continue
-
-        # 4) "29.90" alone -> skip if it’s a summary/total/cash/change amount
-        raw_amount = None
-        m3 = PRICE_ONLY.match(ln)
-        if m3:
-            raw_amount = m3.group(1)
-        elif TRAILING_DOT_PRICE.match(ln):
-            raw_amount = ln.strip()
-        if raw_amount:
-            if DATE_LIKE.search(ln) or TIME_LIKE.search(ln):
-                continue
-            price = _norm_money(raw_amount)
-            if not _is_plausible_money(price):
-                pending_desc = None
-                continue
-            prev = lines[i - 1] if i > 0 else ""
-            nxt  = lines[i + 1] if i + 1 < len(lines) else ""
-            desc_candidate = pending_desc or find_prev_desc(i)
-            if pending_desc:
-                combo = find_prev_desc(i)
-                if combo and len(combo) > len(str(pending_desc)):
-                    desc_candidate = combo
-            # Skip clear summary sections (e.g., subtotal/total rows)
-            if (SUMMARY_NEAR.search(prev) or SUMMARY_NEAR.search(nxt)) and not desc_candidate:
-                pending_desc = None
-                continue
-            # If the amount exactly matches overall total AND we have no description,
-            # treat it as the summary total instead of an item row.
-            if (receipt_total and abs(price - float(receipt_total)) < 0.01) and not desc_candidate:
-                pending_desc = None
-                continue
-            add_item(1, desc_candidate, price)
-            pending_desc = None
-            continue
-
-        # 5) potential description waiting for a price line
-        if sum(ch.isalpha() for ch in ln) >= 3 and not MONEY_TIGHT.search(ln):
-            if is_valid_desc(ln):
-                if pending_desc:
-                    pending_desc = f"{pending_desc} {ln}".strip()
-                else:
-                    pending_desc = ln
-
-    return items
-
-
-
-# ---------- field parsing ----------
-TOTAL_ALIASES = re.compile(
-    r"(?<!sub)\b(total|grand\s*total|amount\s*due|balance\s*due)\b", re.I
-)
-
-def _pick_total(lines):
-
-    amount = None
-    last_idx = -1
-    for i, ln in enumerate(lines):
-        if TOTAL_ALIASES.search(ln):
-            last_idx = i
-
-    if last_idx >= 0:
-        for j in range(0, 3):
-            k = last_idx + j
-            if k < len(lines):
-                m = MONEY_TIGHT.search(lines[k])
-                if m:
-                    try:
-                        val = _norm_money(m.group(1))
-                        if _is_plausible_money(val):
-                            amount = val
-                            break
-                    except Exception:
-                        pass
-
-
-   # Fallback: biggest number
-    if amount is None:
-        candidates = []
-        for ln in lines:
-            if DATE_LIKE.search(ln) or TIME_LIKE.search(ln):
-                continue
-            for m in MONEY_TIGHT.finditer(ln):
-                try:
-                    val = _norm_money(m.group(1))
-                    if _is_plausible_money(val):
-                        candidates.append(val)
-                except:
-                    pass
-        if candidates:
-            amount = max(candidates)
-
-    # Extra fallback for lines with currency symbols or spaced decimals
-    if amount is None:
-        merged_lines = [re.sub(r"(\d)\s*[.,]\s*(\d{2})", r"\1.\2", ln) for ln in lines]
-        for ln in merged_lines:
-            if DATE_LIKE.search(ln) or TIME_LIKE.search(ln):
-                continue
-            m = MONEY_TIGHT.search(ln)
-            if m:
-                try:
-                    val = _norm_money(m.group(1))
-                    if _is_plausible_money(val):
-                        amount = val
-                        break
-                except:
-                    pass
-
-    return f"{amount:.2f}" if amount is not None else ""
-
-
-
-DATE_PATTERNS = [
-    # 5/25/2025 or 05-25-2025 or 5/25/25
-    (re.compile(r"\b(\d{1,2})[/-](\d{1,2})[/-](\d{2,4})\b"), "mdy"),
-    # 25/05/2025 or 25-05-25
-    (re.compile(r"\b(\d{1,2})[.-](\d{1,2})[.-](\d{2,4})\b"), "dmy"),
-    # 2025/05/25
-    (re.compile(r"\b(20\d{2})[/-](\d{1,2})[/-](\d{1,2})\b"), "ymd"),
-    # May 25, 2025 / 25 May 2025
-    (re.compile(r"\b([A-Za-z]{3,9})\s+(\d{1,2})(?:,)?\s+(20\d{2})\b"), "mon_d_y"),
-    (re.compile(r"\b(\d{1,2})\s+([A-Za-z]{3,9})\s+(20\d{2})\b"), "d_mon_y"),
-]
-
-MONTHS = {
-    "jan":1,"january":1,"feb":2,"february":2,"mar":3,"march":3,"apr":4,"april":4,
-    "may":5,"jun":6,"june":6,"jul":7,"july":7,"aug":8,"august":8,
-    "sep":9,"sept":9,"september":9,"oct":10,"october":10,"nov":11,"november":11,"dec":12,"december":12
-}
-
-def _parse_date(text):
-    text = text.replace(",", " ")
-    # scan bottom part first (most receipts put date/time there)
-    lines = text.splitlines()
-    search_space = "\n".join(lines[len(lines)//2:]) + "\n" + text
-
-    for rx, kind in DATE_PATTERNS:
-        m = rx.search(search_space)
-        if not m:
-            continue
-        try:
-            if kind == "mdy":
-                a, b, c = m.groups()
-                mm, dd, yy = int(a), int(b), int(c)
-                if yy < 100: yy += 2000
-                # if ambiguous (<=12 both), prefer DMY when currency looks Malaysian
-                if mm <= 12 and dd <= 12:
-                    if re.search(r"\b(RM|MYR)\b", text, flags=re.I):
-                        mm, dd = dd, mm
-                dt = datetime(yy, mm, dd)
-            elif kind == "dmy":
-                a, b, c = m.groups()
-                dd, mm, yy = int(a), int(b), int(c)
-                if yy < 100: yy += 2000
-                dt = datetime(yy, mm, dd)
-            elif kind == "ymd":
-                yy, mm, dd = map(int, m.groups())
-                dt = datetime(yy, mm, dd)
-            elif kind == "mon_d_y":
-                mon, dd, yy = m.groups()
-                mm = MONTHS[mon.lower()]
-                dt = datetime(int(yy), mm, int(dd))
-            elif kind == "d_mon_y":
-                dd, mon, yy = m.groups()
-                mm = MONTHS[mon.lower()]
-                dt = datetime(int(yy), mm, int(dd))
-            else:
-                continue
-            return dt.strftime("%Y-%m-%d")
-        except Exception:
-            continue
-    return ""
-
-def _detect_brand(joined_text, top_lines):
-    low = joined_text.lower()
-    low = re.sub(r"[a-z]:\\\\[^\n]+", "", low)  # remove paths like C:\...
-
-    # 1) explicit brand patterns anywhere
-    for rx, name in BRAND_REGEXES:
-        if re.search(rx, low, flags=re.I):
-            return name
-
-    # 2) first meaningful top line (if it looks like a venue name)
-    skip = r"(phone|tel|gst|vat|store|slip|staff|date|table|qty|card|visa|debit|credit|subtotal|tax|total|welcome)"
-    for ln in top_lines[:12]:
-        if re.search(skip, ln, flags=re.I):
-            continue
-        if sum(c.isalpha() for c in ln) >= 3:
-            # Title-case this guess
-            guess = re.sub(r"[:\-\u2022]+$", "", ln.strip())
-            if len(guess) < 4:
-                continue
-            if guess.islower():
-                continue
-            return guess
-
-    return ""
-
-def _debug_numbers(lines):
-    print(f"DEBUG: line_count={len(lines)}", file=sys.stderr, flush=True)
-
-    nums = []
-    for ln in lines:
-        for m in MONEY_TIGHT.finditer(ln):
-            nums.append(m.group(0))
-    # Print to STDERR so it doesn't break JSON output
-    print("DEBUG: numbers found =", nums, file=sys.stderr)
-
-
-def parse_fields(lines):
-    joined = "\n".join(lines)
-    # Remove any accidental path text
-    joined = re.sub(r"[a-z]:\\[^\n]+", "", joined, flags=re.I)
-
-    path_line = re.compile(r"^[a-z]:\\", re.I)
-    lines = [ln for ln in lines if not path_line.match(ln.strip())]
-
-    amount = _pick_total(lines)
-    date   = _parse_date(joined)
-    merchant = _detect_brand(joined, lines)
-
-    # Use categorizer for item-level only
-    from categorizer import ReceiptCategorizer
-    categorizer = ReceiptCategorizer()
-
-    items = parse_line_items(
-        lines,
-        categorizer,
-        receipt_total=float(amount) if amount else None,
-        merchant=merchant
-    )
-
-    merchant_hint = (merchant or "").lower()
-    applied_hint = None
-    for key, cat in MERCHANT_CATEGORY_HINTS.items():
-        if key in merchant_hint:
-            applied_hint = cat
-            for item in items:
-                if not item.get("category") or item["category"] == "Other":
-                    item["category"] = cat
-            break
-
-    items_total = 0.0
-    for item in items:
-        try:
-            items_total += float(item.get("total") or 0)
-        except Exception:
-            pass
-
-    if not items and amount and applied_hint:
-        try:
-            amount_str = f"{float(str(amount).strip()):.2f}"
-        except Exception:
-            amount_str = str(amount)
-        items.append({
-            "qty": 1,
-            # Prefer a neutral fallback rather than merchant name
-            "desc": "Receipt",
-            "unit_price": amount_str,
-            "total": amount_str,
-            "category": applied_hint
-        })
-
-    if items_total > 0:
-        amount_val = float(amount) if amount else 0.0
-        if amount_val <= 0 or abs(items_total - amount_val) > 0.01:
-            amount = f"{items_total:.2f}"
-
-    return {
-        "merchant": merchant,
-        "amount": amount,
-        "date": date,
-        "items": items,
-        "raw_text": joined
-    }
-
-
-def preprocess_image(img_path):
-    img = cv2.imread(img_path, cv2.IMREAD_COLOR)
-    if img is None:
-        return img_path
-
-    # Convert to gray and upscale first (tiny text needs pixels)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    h, w = gray.shape
-    if w < 1200:
-        scale = max(2, int(1200 / max(1, w)))
-        gray = cv2.resize(gray, (w*scale, h*scale), interpolation=cv2.INTER_CUBIC)
-
-    # Light deskew via minAreaRect on edges (helps small tilt)
-    try:
-        edges = cv2.Canny(gray, 50, 150)
-        ys, xs = np.where(edges > 0)
-        if len(xs) > 100:
-            coords = np.column_stack((xs, ys)).astype(np.float32)
-            rect = cv2.minAreaRect(coords)
-            ang = rect[-1]
-            ang = -(90 + ang) if ang < -45 else -ang
-            if 0.5 <= abs(ang) <= 8.0:
-                M = cv2.getRotationMatrix2D((gray.shape[1]//2, gray.shape[0]//2), ang, 1.0)
-                gray = cv2.warpAffine(gray, M, (gray.shape[1], gray.shape[0]), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
-    except Exception:
-        pass
-
-    # Candidate A: CLAHE (great for faint thermal/purple ink)
-    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
-    a = clahe.apply(gray)
-
-    # Candidate B: Adaptive threshold (handles uneven lighting)
-    b = cv2.medianBlur(gray, 3)
-    b = cv2.adaptiveThreshold(
-        b, 255,
-        cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-        cv2.THRESH_BINARY, 31, 10
-    )
-
-    # Candidate C: Contrast stretch + light blur (no binarization)
-    c = cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX)
-    c = cv2.GaussianBlur(c, (3, 3), 0)
-
-    def score(img_):
-        # Higher = more “texty”: use edge energy as a cheap proxy
-        sobelx = cv2.Sobel(img_, cv2.CV_32F, 1, 0, ksize=3)
-        sobely = cv2.Sobel(img_, cv2.CV_32F, 0, 1, ksize=3)
-        return float(np.mean(np.abs(sobelx)) + np.mean(np.abs(sobely)))
-
-    # Binarize A & C too for fair comparison
-    _, a_bin = cv2.threshold(a, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    _, c_bin = cv2.threshold(c, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-
-    cand = max([(a_bin, score(a_bin)), (b, score(b)), (c_bin, score(c_bin))], key=lambda t: t[1])[0]
-
-    # Slight morphology to reduce speckle and thicken faint strokes
-    cand = cv2.medianBlur(cand, 3)
-    cand = cv2.dilate(cand, np.ones((1, 2), np.uint8), iterations=1)
-
-    out = img_path + "_clean.png"
-    cv2.imwrite(out, cand)
-    return out
-
-
-def main():
-    result = {"merchant":"","amount":"","date":"","items":[],"raw_text":""}
-    try:
-        print("DEBUG: start", file=sys.stderr, flush=True)
-
-        if len(sys.argv) < 2:
-            print(json.dumps(result, ensure_ascii=False))
-            return
-
-        img_path = sys.argv[1]
-        if not (os.path.isfile(img_path) and os.path.getsize(img_path) > 0):
-            result["error"] = "file_missing_or_empty"
-            print(json.dumps(result, ensure_ascii=False))
-            return
-
-        try:
-            ocr = PaddleOCR(
-                lang="en",
-                use_angle_cls=True,
-                det_db_thresh=0.30,
-                det_db_box_thresh=0.50,
-                det_limit_side_len=1536,
-                drop_score=0.30,
-                use_gpu=False,
-            )
-        except TypeError:
-            # Older PaddleOCR versions may not accept some args; fall back gracefully
-            ocr = PaddleOCR(lang="en", use_angle_cls=True)
-
-        print("DEBUG: preprocessing", file=sys.stderr, flush=True)
-        clean_path = preprocess_image(img_path)
-        print(f"DEBUG: clean_path={clean_path}", file=sys.stderr, flush=True)
-
-        print("DEBUG: calling OCR", file=sys.stderr, flush=True)
-        res = None
-        try:
-            print("DEBUG: ocr(clean_path)...", file=sys.stderr, flush=True)
-            res = ocr.ocr(clean_path)
-            print("DEBUG: ocr(clean_path) ok", file=sys.stderr, flush=True)
-        except Exception as e1:
-            print(f"DEBUG: ocr(clean_path) failed: {e1}", file=sys.stderr, flush=True)
-            try:
-                print("DEBUG: ocr(original)...", file=sys.stderr, flush=True)
-                res = ocr.ocr(img_path)
-                print("DEBUG: ocr(original) ok", file=sys.stderr, flush=True)
-            except Exception as e2:
-                print(f"DEBUG: ocr(original) failed: {e2}", file=sys.stderr, flush=True)
-                result["error"] = str(e2)
-                print(json.dumps(result, ensure_ascii=False))
-                return
-
-        print(f"DEBUG: OCR done; type={type(res)}", file=sys.stderr, flush=True)
-
-        # Normalize result shape before flattening
-        if isinstance(res, list) and len(res) == 1 and isinstance(res[0], (list, tuple)):
-            res = res[0]
-        lines = _flatten_text(res)
-        # If preprocessing hurt recognition, fall back to original image
-        if len(lines) < 3:
-            try:
-                res2 = ocr.ocr(img_path)  # original, no preprocessing
-                lines2 = _flatten_text(res2)
-                if len(lines2) > len(lines):
-                    lines = lines2
-            except Exception:
-                pass
-
-        lines = [ln for ln in lines if not re.search(r"^[A-Za-z]:\\\\|^/+", ln)]
-        _debug_numbers(lines)
-
-        data = parse_fields(lines)
-        result.update(data)
-
-    except Exception as e:
-        result["error"] = f"{type(e).__name__}: {e}"
-
-    # ALWAYS print and log
-    out = json.dumps(result, ensure_ascii=False)
-    print(out)
-    try:
-        with open(os.path.join(os.path.dirname(__file__), "ocr_last_output.txt"), "w", encoding="utf-8") as f:
-            f.write(out + "\n")
-    except:
-        pass
-
-if __name__ == "__main__":
-    main()
+# -*- coding: utf-8 -*-
+import sys, os, json, re, time, queue, bisect, hashlib, itertools, threading
+import argparse
+from datetime import datetime
+from categorizer import get_categorizer, model_fingerprint
+from merchants import default_index
+from ocr_metrics import StageTimer, NULL_TIMER, peak_rss_mb, log_metrics
+
+
+
+# ---------- brand lexicon & helpers ----------
+# Known merchants live in merchants.json (see merchants.py); these hints cover
+# names that only the top-line heuristic finds.
+MERCHANT_CATEGORY_HINTS = {
+    "99 speedmart": "Food & Dining",
+    "speed mart": "Food & Dining",
+    "familymart": "Food & Dining",
+    "family mart": "Food & Dining",
+    "bungkus ikat tepi": "Food & Dining",
+    "coriander": "Food & Dining",
+    "rosto": "Food & Dining",
+    "petronas": "Transportation",
+    "primax": "Transportation",
+    "shell": "Transportation",
+}
+
+CURRENCY_RE = r"(?:RM|MYR|USD|SGD|GBP|EUR|\$|\u00a3|\u20ac)?"
+MONEY_CAPTURE = rf"{CURRENCY_RE}\s*(\d{{1,3}}(?:[.,]\d{{3}})+(?:[.,]\d{{1,2}})?|\d+(?:[.,]\d{{1,2}})?)"
+MONEY_TIGHT = re.compile(MONEY_CAPTURE)
+
+MAX_PLAUSIBLE_AMOUNT = 100000.0
+
+def _is_plausible_money(value: float) -> bool:
+    return value is not None and value > 0 and value <= MAX_PLAUSIBLE_AMOUNT
+
+DATE_LIKE = re.compile(r"\d{1,2}[-/]\d{1,2}[-/]\d{2,4}")
+TIME_LIKE = re.compile(r"\d{1,2}:\d{2}")
+TRAILING_DOT_PRICE = re.compile(r"^\s*\d+[.,]\s*$")
+
+def _norm_money(s: str) -> float:
+    # remove currency, normalize separators; handle "38,02" vs "38.02"
+    s = s.strip()
+    s = re.sub(r"(RM|MYR|USD|SGD|GBP|EUR|\$|\u00a3|\u20ac)", "", s, flags=re.I).strip()
+    # if exactly one comma and no dot => decimal comma
+    if s.count(",") == 1 and s.count(".") == 0:
+        s = s.replace(",", ".")
+    # otherwise commas are thousands separators
+    if s.count(".") == 1:
+        s = s.replace(",", "")
+    return float(s)
+
+def _looks_like_line(s: str) -> bool:
+    s = s.strip()
+    if not s:
+        return False
+    # keep currency/amount-only lines
+    if MONEY_TIGHT.search(s):
+        return True
+    # keep lines that contain at least 2 digits (e.g., "192.10", "170")
+    if sum(ch.isdigit() for ch in s) >= 2:
+        return True
+    # otherwise require some letters so we skip noise
+    letters = sum(ch.isalpha() for ch in s)
+    return len(s) >= 3 and letters >= 1
+
+
+def _flatten_text(ocr_out):
+    """Turn PaddleOCR output (any version) into text lines."""
+    lines = []
+
+    def walk(o):
+        if isinstance(o, (list, tuple)):
+            for it in o:
+                if (
+                    isinstance(it, (list, tuple)) and len(it) >= 2
+                    and isinstance(it[1], (list, tuple)) and it[1]
+                    and isinstance(it[1][0], str)
+                ):
+                    t = it[1][0].strip()
+                    if _looks_like_line(t):
+                        lines.append(t)
+                else:
+                    walk(it)
+        elif isinstance(o, dict):
+            for k in ("text", "transcription", "value", "content", "sentence"):
+                v = o.get(k)
+                if isinstance(v, str) and _looks_like_line(v):
+                    lines.append(v.strip())
+            for v in o.values():
+                walk(v)
+        elif isinstance(o, str):
+            if _looks_like_line(o):
+                lines.append(o.strip())
+
+    walk(ocr_out)
+    return _dedup_lines(lines)
+
+
+def _dedup_lines(lines):
+    # de-dup while preserving order
+    seen, out = set(), []
+    for ln in lines:
+        key = (ln.lower(), len(ln))
+        if key not in seen:
+            seen.add(key)
+            out.append(ln)
+    return out
+
+# ---------- layout (boxes -> physical rows) ----------
+def _box_bounds(poly):
+    """(x0, y0, x1, y1) from a 4-point polygon or a flat [x0, y0, x1, y1] box."""
+    try:
+        pts = [float(v) for v in _iter_numbers(poly)]
+    except (TypeError, ValueError):
+        return None
+    if len(pts) < 4:
+        return None
+    xs, ys = pts[0::2], pts[1::2]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _iter_numbers(o):
+    if hasattr(o, "tolist"):
+        o = o.tolist()
+    if isinstance(o, (list, tuple)):
+        for it in o:
+            yield from _iter_numbers(it)
+    else:
+        yield o
+
+
+def _flatten_boxes(ocr_out):
+    """Turn PaddleOCR output into [(text, score, (x0, y0, x1, y1)), ...]; [] if it has no geometry."""
+    boxes = []
+
+    def add(text, score, poly):
+        if not isinstance(text, str):
+            return
+        t = text.strip()
+        b = _box_bounds(poly)
+        if b is not None and _looks_like_line(t):
+            try:
+                score = float(score)
+            except (TypeError, ValueError):
+                score = 1.0
+            boxes.append((t, score, b))
+
+    def walk(o):
+        if isinstance(o, dict) or hasattr(o, "keys"):
+            # PaddleOCR 3.x: parallel rec_texts / rec_scores / rec_polys (or rec_boxes)
+            try:
+                texts = o.get("rec_texts")
+            except Exception:
+                texts = None
+            if texts is not None:
+                scores = o.get("rec_scores")
+                polys = o.get("rec_polys")
+                if polys is None:
+                    polys = o.get("rec_boxes")
+                if polys is None:
+                    return
+                scores = list(scores) if scores is not None else [1.0] * len(texts)
+                for t, sc, poly in zip(texts, scores, polys):
+                    add(t, sc, poly)
+            return
+        if isinstance(o, (list, tuple)):
+            for it in o:
+                # PaddleOCR 2.x: [poly, (text, score)]
+                if (
+                    isinstance(it, (list, tuple)) and len(it) >= 2
+                    and isinstance(it[1], (list, tuple)) and it[1]
+                    and isinstance(it[1][0], str)
+                ):
+                    add(it[1][0], it[1][1] if len(it[1]) > 1 else 1.0, it[0])
+                else:
+                    walk(it)
+
+    walk(ocr_out)
+    return boxes
+
+
+class Row:
+    """One physical receipt row: cells ordered left to right, plus an optional right-column amount."""
+    __slots__ = ("y0", "y1", "cells", "left", "amount")
+
+    def __init__(self, y0, y1, cells, left="", amount=None):
+        self.y0, self.y1 = y0, y1
+        self.cells = cells      # [(x0, x1, text, score)]
+        self.left = left        # text outside the amount column
+        self.amount = amount    # raw amount text from the right column, or None
+
+    @property
+    def text(self):
+        return " ".join(c[2] for c in self.cells)
+
+    def to_list(self):
+        return [self.y0, self.y1, [list(c) for c in self.cells], self.left, self.amount]
+
+    @classmethod
+    def from_list(cls, v):
+        return cls(v[0], v[1], [tuple(c) for c in v[2]], v[3], v[4])
+
+
+# a cell is in the amount column when it ends in the right part of the text block
+AMOUNT_COLUMN_FRAC = 0.6
+
+
+def group_rows(boxes):
+    """Cluster boxes into rows by vertical overlap and order each row by x (O(n log n))."""
+    if not boxes:
+        return []
+    boxes = sorted(boxes, key=lambda b: (b[2][1] + b[2][3]) / 2.0)
+    x_min = min(b[2][0] for b in boxes)
+    x_max = max(b[2][2] for b in boxes)
+    col_x = x_min + AMOUNT_COLUMN_FRAC * max(1.0, x_max - x_min)
+
+    groups = []  # [y0, y1, members]
+    for b in boxes:
+        x0, y0, x1, y1 = b[2]
+        if groups:
+            g = groups[-1]
+            overlap = min(g[1], y1) - max(g[0], y0)
+            if overlap >= 0.5 * max(1.0, min(g[1] - g[0], y1 - y0)):
+                g[2].append(b)
+                # running band = mean of members, so one tilted box cannot swallow the next row
+                n = len(g[2])
+                g[0] += (y0 - g[0]) / n
+                g[1] += (y1 - g[1]) / n
+                continue
+        groups.append([y0, y1, [b]])
+
+    rows = []
+    for y0, y1, members in groups:
+        members.sort(key=lambda b: b[2][0])
+        cells = [(b[2][0], b[2][2], b[0], b[1]) for b in members]
+        amount = None
+        left_cells = cells
+        last = cells[-1]
+        if last[1] >= col_x and (PRICE_ONLY.match(last[2]) or TRAILING_DOT_PRICE.match(last[2])):
+            if len(cells) > 1 or last[0] >= col_x:
+                amount = last[2]
+                left_cells = cells[:-1]
+        left = " ".join(c[2] for c in left_cells)
+        rows.append(Row(round(y0, 1), round(y1, 1), cells, left, amount))
+    return rows
+
+
+# ---------- line tokens ----------
+# per-line flag bits
+T_DATE, T_TIME, T_TOTAL, T_SUMMARY, T_NOISE, T_CURRENCY, T_MONTH, T_QTY = (1 << i for i in range(8))
+CURRENCY_WORD = re.compile(r"\b(RM|MYR)\b", re.I)
+# any letter run that could be a MONTHS key; the month date patterns cannot convert without one
+MONTH_WORD = re.compile(r"(?<![A-Za-z])(?:jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*(?![A-Za-z])", re.I)
+QTY_MARK = re.compile(r"[x\u00d7]", re.I)  # QTY_LINE and X_PRICE cannot match without one
+NUMERIC_DATES = 3  # DATE_PATTERNS[:3] never span a line break
+# MONEY_TIGHT as (whole match, amount) pairs; the lookahead only skips positions
+# no match can start at (currency letter/symbol, whitespace or digit)
+MONEY_PAIRS = re.compile(rf"(?=[RMUSGE$\u00a3\u20ac\s\d])({MONEY_CAPTURE})")
+
+
+class LineTokens:
+    """OCR lines scanned once for everything the total, date and item parsers look for.
+
+    need(bits) returns flags, where flags[i] holds the T_* bits of line i
+    (each pattern runs the first time one of its bits is asked for, and only
+    on lines that contain one of its keywords -- str.find over the lowered
+    text is far cheaper than the regex engine). money_at(i) / all_money()
+    give the (text, amount string) of each money match on a line. Amounts
+    are normalized on first use and memoized per string, numeric dates
+    searched on first use.
+    """
+    __slots__ = ("lines", "flags", "_done", "_money", "_joined", "_starts", "_low", "_always",
+                 "_values", "_dates")
+
+    # (pattern, bit, lowercase keywords one of which every match contains); keep in step with the patterns
+    _rules = None
+
+    def __init__(self, lines):
+        if LineTokens._rules is None:
+            LineTokens._rules = [
+                (DATE_LIKE, T_DATE, ("/", "-")),
+                (TIME_LIKE, T_TIME, (":",)),
+                (TOTAL_ALIASES, T_TOTAL, ("total", "due")),
+                (SUMMARY_NEAR, T_SUMMARY, ("tota", "cash", "change", "amount", "due", "paid")),
+                (ITEM_NOISE, T_NOISE, ("total", "cash", "change", "invoice", "amount", "amt", "aot", "qty",
+                                       "quantity", "item", "desc", "no", "visit", "url", "request", "date",
+                                       "time", "balance", "due")),
+                (CURRENCY_WORD, T_CURRENCY, ("rm", "myr")),
+                (MONTH_WORD, T_MONTH, ("jan", "feb", "mar", "apr", "may", "jun",
+                                       "jul", "aug", "sep", "oct", "nov", "dec")),
+                (QTY_MARK, T_QTY, ("x",)),
+            ]
+        self.lines = lines
+        self.flags = bytearray(len(lines))
+        self._done = 0
+        self._money = [None] * len(lines)
+        self._joined = "\n".join(lines)
+        self._starts = list(itertools.accumulate((len(ln) + 1 for ln in lines), initial=0))
+        self._low = None
+        self._values = {}
+        self._dates = {}
+
+    def need(self, bits):
+        """flags, with at least these T_* bits filled in."""
+        todo = bits & ~self._done
+        if todo:
+            if self._low is None:
+                lines, joined = self.lines, self._joined
+                if joined.isascii():
+                    self._low, self._always = joined.lower(), ()
+                else:
+                    # lower() may change the length of other scripts; such lines skip the keyword filter
+                    self._always = [i for i, ln in enumerate(lines) if not ln.isascii()]
+                    self._low = "\n".join(ln.lower() if ln.isascii() else " " * len(ln) for ln in lines)
+            flags, lines = self.flags, self.lines
+            for rx, bit, words in LineTokens._rules:
+                if bit & todo:
+                    for i in self._lines_with(words):
+                        if rx.search(lines[i]):
+                            flags[i] |= bit
+            self._done |= todo
+        return self.flags
+
+    def any(self, bit):
+        return any(f & bit for f in self.need(bit))
+
+    def money_at(self, i):
+        found = self._money[i]
+        if found is None:
+            found = self._money[i] = MONEY_PAIRS.findall(self.lines[i])
+        return found
+
+    def all_money(self):
+        money = self._money
+        if None in money:
+            # one findall per line yields the pairs without building match objects
+            self._money = money = [MONEY_PAIRS.findall(ln) if found is None else found
+                                   for ln, found in zip(self.lines, money)]
+        return money
+
+    def _lines_with(self, words):
+        low, starts = self._low, self._starts
+        hits = set(self._always)
+        for w in words:
+            pos = low.find(w)
+            while pos >= 0:
+                i = bisect.bisect_right(starts, pos) - 1
+                hits.add(i)
+                pos = low.find(w, starts[i + 1])  # one hit per line is enough
+        return sorted(hits)
+
+    def amount(self, s):
+        """_norm_money(s), memoized; raises like it for malformed amounts."""
+        v = self._values.get(s)
+        if v is None:
+            v = self._values[s] = _norm_money(s)
+        return v
+
+    def first_date(self, idx, start):
+        """Groups of the first DATE_PATTERNS[idx] match from line start on, then from the top."""
+        key = (idx, start)
+        if key not in self._dates:
+            rx = DATE_PATTERNS[idx][0]
+            # numeric dates hold no whitespace, so a match never crosses into another line
+            m = rx.search(self._joined, self._starts[start]) or rx.search(self._joined)
+            self._dates[key] = m.groups() if m else None
+        return self._dates[key]
+
+
+# ---------- line-item helpers ----------
+ITEM_NOISE = re.compile(
+    r"\b(total|grand\s*total|cash|change|invoice|amount|amt|aot|qty|quantity|item(s)?|desc|"
+    r"no\.?\s*of|visit|url|request|e-?invoice|date|time|balance|due|amount\(rm\))\b",
+    re.I
+)
+QTY_LINE = re.compile(rf"^\s*(\d+)\s*[x\u00d7]\s*{MONEY_CAPTURE}\s*$", re.I)
+INLINE_PRICE = re.compile(rf"^(.*?)[\s\.]+{MONEY_CAPTURE}\s*$")
+SKU_PREFIX = re.compile(r"^\s*\d{3,8}\s+")  # drop leading item codes like "3645 "
+# price forms that appear without description
+X_PRICE     = re.compile(rf"^[x\u00d7]\s*{MONEY_CAPTURE}\s*$", re.I)     # "x 1.35" | "x1.35"
+PRICE_ONLY  = re.compile(rf"^\s*{MONEY_CAPTURE}\s*$")               # "29.90"
+SUMMARY_NEAR = re.compile(
+    r"(tota[l]?|grand\s*total|sub\s*total|cash\w*|change\w*|amount\s*\(rm\)|amount\s*due|balance\s*due|paid)",
+    re.I
+)
+# how the customer paid: never an item, even when printed with its own amount
+TENDER = re.compile(
+    r"\b(payment|paid|qr|card|cash|change|tunai|baki|(?:my)?debit|visa|master\s*card|duit\s*now|e-?wallet)\b",
+    re.I
+)
+QTY_CELL = re.compile(r"^\d{1,3}$")  # "3" alone in a Qty column
+CENTS = re.compile(r"\d[.,]\d{2}\b")  # "4.95", not "550ML" or an item code
+
+
+
+def clean_desc(s: str) -> str:
+    s = SKU_PREFIX.sub("", s).strip()
+    # collapse multiple spaces & remove trailing punctuation
+    s = re.sub(r"\s{2,}", " ", s)
+    s = re.sub(r"[:\-\u2022]+$", "", s)
+    return s.title()
+
+# words that strongly indicate header/merchant lines, not items
+HEADER_NOISE = re.compile(
+    r"\b(ssm|company|co\.?|s(?:dn)?\s*bhd|enterprise|tel\.?|phone|employee|cashier|pos|table|order|waiter|pax|number|time|product|qty|total?|amount|invoice|receipt|thank|powered\s*by|take\s*out|dine\s*in)\b",
+    re.I
+)
+
+
+class _ItemCollector:
+    """Validates, cleans, categorizes and de-duplicates line items for one receipt."""
+
+    def __init__(self, categorizer, merchant=None):
+        self.categorizer = categorizer
+        self.merchant_norm = (merchant or "").strip().lower()
+        self.items = []
+        self._seen = set()  # (desc.lower(), total) of the items so far
+
+    def is_valid_desc(self, text: str) -> bool:
+        if not text:
+            return False
+        t = text.strip()
+        if not t:
+            return False
+        low = t.lower()
+        # require at least a couple of alphabetic characters so we skip lines like "1 X"
+        if sum(ch.isalpha() for ch in t) < 2:
+            return False
+        # do not use merchant name (or close variants) as an item description
+        merchant_norm = self.merchant_norm
+        if merchant_norm and len(merchant_norm) >= 4 and (low == merchant_norm or merchant_norm in low):
+            return False
+        if HEADER_NOISE.search(low):
+            return False
+        return True
+
+    def add(self, qty, desc, unit):
+        if not desc:
+            return
+        if not _is_plausible_money(unit):
+            return
+        # validate description (avoid merchant/header lines)
+        if not self.is_valid_desc(desc):
+            return
+        desc = clean_desc(desc)
+        total = f"{qty * unit:.2f}"
+        # de-dup: same desc + same total within the current list
+        key = (desc.lower(), total)
+        if key in self._seen:
+            return
+        self._seen.add(key)
+        self.items.append({
+            "qty": qty,
+            "desc": desc,
+            "unit_price": f"{unit:.2f}",
+            "total": total,
+            "category": None  # filled in by finish(), one batch per receipt
+        })
+
+    def finish(self):
+        """Categorize all collected items in one batch and return them."""
+        cats = self.categorizer.predict_many([it["desc"] for it in self.items])
+        for it, cat in zip(self.items, cats):
+            it["category"] = cat
+        return self.items
+
+
+# line kinds for parse_line_items, in the order the checks apply
+_NOISE, _QTY, _INLINE, _XPRICE, _PRICE, _DESC, _OTHER = range(7)
+
+
+def _classify_lines(lines, is_valid_desc, tokens):
+    """One pass over the lines: (kinds, payloads, fragments, near_summary).
+
+    payloads hold the captured money strings (or the description); fragments
+    is each line as a usable description fragment for find_prev_desc, or None.
+    """
+    kinds, payloads, frags, summary, qty_units = [], [], [], [], []
+    flags = tokens.need(T_SUMMARY | T_NOISE | T_QTY | T_DATE | T_TIME)
+    money_tokens = tokens.all_money()
+    for i, raw in enumerate(lines):
+        ln = raw.strip()
+        f = flags[i]
+        summary.append(bool(f & T_SUMMARY))
+        m = QTY_LINE.match(ln) if f & T_QTY else None
+        qty_units.append(m.group(2) if m else None)
+        noise = not ln or bool(f & T_NOISE)
+        money = bool(ln) and not noise and bool(money_tokens[i])
+        valid = bool(ln) and not noise and is_valid_desc(ln)
+        frags.append(ln if valid and not money else None)
+        if noise:
+            kinds.append(_NOISE); payloads.append(None)
+            continue
+        if m:
+            kinds.append(_QTY); payloads.append((int(m.group(1)), m.group(2)))
+            continue
+        m = INLINE_PRICE.match(ln)
+        if m and sum(c.isalpha() for c in m.group(1)) >= 4:
+            kinds.append(_INLINE); payloads.append((m.group(1), m.group(2)))
+            continue
+        m = X_PRICE.match(ln) if f & T_QTY else None
+        if m:
+            kinds.append(_XPRICE); payloads.append(m.group(1))
+            continue
+        m = PRICE_ONLY.match(ln)
+        raw_amount = m.group(1) if m else (ln if TRAILING_DOT_PRICE.match(ln) else None)
+        if raw_amount:
+            dated = bool(f & (T_DATE | T_TIME))
+            kinds.append(_PRICE); payloads.append((raw_amount, dated))
+            continue
+        if valid and not money and sum(ch.isalpha() for ch in ln) >= 3:
+            kinds.append(_DESC); payloads.append(ln)
+            continue
+        kinds.append(_OTHER); payloads.append(None)
+    return kinds, payloads, frags, summary, qty_units
+
+
+def parse_line_items(lines, categorizer, receipt_total=None, merchant=None, tokens=None):
+    """Items from plain OCR lines; tokens is a LineTokens of these lines if the caller has one."""
+    if tokens is None:
+        tokens = LineTokens(lines)
+    collector = _ItemCollector(categorizer, merchant)
+    add_item = collector.add
+    kinds, payloads, frags, summary, qty_units = _classify_lines(lines, collector.is_valid_desc, tokens)
+    n = len(lines)
+    pending_desc = None
+    money = tokens.amount
+
+    def find_prev_desc(idx):
+        fragments = []
+        for j in range(idx - 1, max(idx - 6, -1), -1):
+            f = frags[j]
+            if f is None:
+                if fragments:
+                    break
+                continue
+            fragments.append(f)
+        if fragments:
+            return " ".join(reversed(fragments))
+        return None
+
+    for i, kind in enumerate(kinds):
+        if kind == _NOISE or kind == _OTHER:
+            continue
+        data = payloads[i]
+
+        # 1) "1 x 4.95" -> pair with previous/pending description
+        if kind == _QTY:
+            unit = money(data[1])
+            if not _is_plausible_money(unit):
+                pending_desc = None
+                continue
+            add_item(data[0], pending_desc or find_prev_desc(i), unit)
+            pending_desc = None
+
+        # 2) "DESC .... 1.35"
+        elif kind == _INLINE:
+            desc, price = data
+            # If the *next* line is "1 x 1.35", let that one consume the desc to avoid a duplicate
+            nxt = qty_units[i + 1] if i + 1 < n else None
+            if nxt is not None and abs(money(nxt) - money(price)) < 0.005:
+                pending_desc = desc  # remember the desc for the next line
+                continue
+            add_item(1, desc, money(price))
+            pending_desc = None
+
+        # 3) "x 1.35" -> assume qty=1, pair with previous/pending desc
+        elif kind == _XPRICE:
+            add_item(1, pending_desc or find_prev_desc(i), money(data))
+            pending_desc = None
+
+        # 4) "29.90" alone -> skip if it’s a summary/total/cash/change amount
+        elif kind == _PRICE:
+            raw_amount, dated = data
+            if dated:
+                continue
+            price = money(raw_amount)
+            if not _is_plausible_money(price):
+                pending_desc = None
+                continue
+            desc_candidate = pending_desc or find_prev_desc(i)
+            if pending_desc:
+                combo = find_prev_desc(i)
+                if combo and len(combo) > len(str(pending_desc)):
+                    desc_candidate = combo
+            # Skip clear summary sections (e.g., subtotal/total rows)
+            near_summary = (i > 0 and summary[i - 1]) or (i + 1 < n and summary[i + 1])
+            if near_summary and not desc_candidate:
+                pending_desc = None
+                continue
+            # If the amount exactly matches overall total AND we have no description,
+            # treat it as the summary total instead of an item row.
+            if (receipt_total and abs(price - float(receipt_total)) < 0.01) and not desc_candidate:
+                pending_desc = None
+                continue
+            add_item(1, desc_candidate, price)
+            pending_desc = None
+
+        # 5) potential description waiting for a price line
+        else:
+            pending_desc = f"{pending_desc} {data}".strip() if pending_desc else data
+
+    return collector.finish()
+
+
+
+QTY_IN_TEXT = re.compile(rf"(?:^|\s)(\d+)\s*[x\u00d7]\s*(?:{MONEY_CAPTURE})?\s*$", re.I)
+
+
+def parse_row_items(rows, categorizer, receipt_total=None, merchant=None):
+    """Pair descriptions with amounts using the physical row model from group_rows.
+
+    A row with text on the left and an amount in the right column is an item
+    on its own; rows without an amount accumulate a (multi-line) description
+    for the next amount-only or "2 x 4.95" row.
+    """
+    collector = _ItemCollector(categorizer, merchant)
+    pending = []
+
+    for row in rows:
+        text = row.text.strip()
+        if not text:
+            continue
+        if ITEM_NOISE.search(text) or SUMMARY_NEAR.search(text) or TENDER.search(text):
+            # column headers / totals / payment lines end any description in progress
+            pending = []
+            continue
+
+        left = row.left.strip()
+        if row.amount is not None:
+            raw = row.amount
+            price = _norm_money(PRICE_ONLY.match(raw).group(1)) if PRICE_ONLY.match(raw) else _norm_money(raw)
+            qty, desc = 1, left
+            mq = QTY_IN_TEXT.search(left)
+            cells = [c[2].strip() for c in row.cells[:-1]]
+            if mq:
+                qty = int(mq.group(1))
+                desc = left[:mq.start()].strip()
+            elif len(cells) >= 2 and QTY_CELL.match(cells[-1]) and int(cells[-1]) >= 1:
+                # "NASI FIZOW | 3 | 15.00": a Qty column, the amount is the line total
+                qty = int(cells[-1])
+                desc = " ".join(cells[:-1])
+            if sum(ch.isalpha() for ch in desc) < 2:
+                desc = " ".join(pending)
+            if DATE_LIKE.search(text) or TIME_LIKE.search(text):
+                pending = []
+                continue
+            if not desc and receipt_total and abs(price - float(receipt_total)) < 0.01:
+                pending = []
+                continue
+            unit = price / qty if qty > 1 else price
+            if mq and mq.group(2):
+                unit = _norm_money(mq.group(2))
+            collector.add(qty, desc, unit)
+            pending = []
+            continue
+
+        # "2 x 4.95" printed under the description, not in the amount column
+        m = QTY_LINE.match(text)
+        if m:
+            collector.add(int(m.group(1)), " ".join(pending), _norm_money(m.group(2)))
+            pending = []
+            continue
+        m2 = INLINE_PRICE.match(text)
+        if m2 and sum(c.isalpha() for c in m2.group(1)) >= 4:
+            if not CENTS.search(m2.group(2)):
+                # "...JAGUNG PEDAS 145": prices sit in the amount column with cents,
+                # a bare number run into the text is part of the description
+                pending.append(m2.group(1))
+                continue
+            collector.add(1, m2.group(1), _norm_money(m2.group(2)))
+            pending = []
+            continue
+
+        if (sum(ch.isalpha() for ch in text) >= 3 and not CENTS.search(text) and not DATE_LIKE.search(text)
+                and collector.is_valid_desc(text)):
+            pending.append(text)
+        else:
+            pending = []
+
+    return collector.finish()
+
+
+
+# ---------- field parsing ----------
+TOTAL_ALIASES = re.compile(
+    r"(?<!sub)\b(total|grand\s*total|amount\s*due|balance\s*due)\b", re.I
+)
+
+def _pick_total(lines, tokens=None):
+    if tokens is None:
+        tokens = LineTokens(lines)
+    flags = tokens.need(T_TOTAL)
+
+    amount = None
+    last_idx = -1
+    for i, f in enumerate(flags):
+        if f & T_TOTAL:
+            last_idx = i
+
+    if last_idx >= 0:
+        for j in range(0, 3):
+            k = last_idx + j
+            if k < len(lines):
+                found = tokens.money_at(k)
+                if found:
+                    try:
+                        val = tokens.amount(found[0][1])
+                        if _is_plausible_money(val):
+                            amount = val
+                            break
+                    except Exception:
+                        pass
+
+
+   # Fallback: biggest number
+    if amount is None:
+        candidates = []
+        for f, found in zip(tokens.need(T_DATE | T_TIME), tokens.all_money()):
+            if f & (T_DATE | T_TIME):
+                continue
+            for _, s in found:
+                try:
+                    val = tokens.amount(s)
+                    if _is_plausible_money(val):
+                        candidates.append(val)
+                except Exception:
+                    pass
+        if candidates:
+            amount = max(candidates)
+
+    # Extra fallback for lines with currency symbols or spaced decimals
+    if amount is None:
+        merged_lines = [re.sub(r"(\d)\s*[.,]\s*(\d{2})", r"\1.\2", ln) for ln in lines]
+        for ln in merged_lines:
+            if DATE_LIKE.search(ln) or TIME_LIKE.search(ln):
+                continue
+            m = MONEY_TIGHT.search(ln)
+            if m:
+                try:
+                    val = _norm_money(m.group(1))
+                    if _is_plausible_money(val):
+                        amount = val
+                        break
+                except:
+                    pass
+
+    return f"{amount:.2f}" if amount is not None else ""
+
+
+
+DATE_PATTERNS = [
+    # 5/25/2025 or 05-25-2025 or 5/25/25
+    (re.compile(r"\b(\d{1,2})[/-](\d{1,2})[/-](\d{2,4})\b"), "mdy"),
+    # 25/05/2025 or 25-05-25
+    (re.compile(r"\b(\d{1,2})[.-](\d{1,2})[.-](\d{2,4})\b"), "dmy"),
+    # 2025/05/25
+    (re.compile(r"\b(20\d{2})[/-](\d{1,2})[/-](\d{1,2})\b"), "ymd"),
+    # May 25, 2025 / 25 May 2025
+    (re.compile(r"\b([A-Za-z]{3,9})\s+(\d{1,2})(?:,)?\s+(20\d{2})\b"), "mon_d_y"),
+    (re.compile(r"\b(\d{1,2})\s+([A-Za-z]{3,9})\s+(20\d{2})\b"), "d_mon_y"),
+]
+
+MONTHS = {
+    "jan":1,"january":1,"feb":2,"february":2,"mar":3,"march":3,"apr":4,"april":4,
+    "may":5,"jun":6,"june":6,"jul":7,"july":7,"aug":8,"august":8,
+    "sep":9,"sept":9,"september":9,"oct":10,"october":10,"nov":11,"november":11,"dec":12,"december":12
+}
+
+def _parse_date(text, tokens=None, dmy=None):
+    """First date in text as YYYY-MM-DD, or "". dmy says how to read an ambiguous 07/10
+    (None: D/M when the text itself prints RM/MYR)."""
+    text = text.replace(",", " ")
+    # scan bottom part first (most receipts put date/time there)
+    lines = text.splitlines()
+    half = len(lines)//2
+    if tokens is not None and lines != [ln.replace(",", " ") for ln in tokens.lines]:
+        tokens = None  # only usable when built from exactly these lines
+    search_space = None
+
+    for idx, (rx, kind) in enumerate(DATE_PATTERNS):
+        if tokens is not None and idx < NUMERIC_DATES:
+            groups = tokens.first_date(idx, half)
+        elif tokens is not None and not tokens.any(T_MONTH):
+            continue  # a month pattern match without a month name fails MONTHS below anyway
+        else:
+            # month patterns can run across a line break
+            if search_space is None:
+                search_space = "\n".join(lines[half:]) + "\n" + text
+            m = rx.search(search_space)
+            groups = m.groups() if m else None
+        if not groups:
+            continue
+        try:
+            if kind == "mdy":
+                a, b, c = groups
+                mm, dd, yy = int(a), int(b), int(c)
+                if yy < 100: yy += 2000
+                # if ambiguous (<=12 both), prefer DMY when currency looks Malaysian
+                if mm <= 12 and dd <= 12:
+                    if dmy is None:
+                        dmy = tokens.any(T_CURRENCY) if tokens is not None else bool(CURRENCY_WORD.search(text))
+                    if dmy:
+                        mm, dd = dd, mm
+                dt = datetime(yy, mm, dd)
+            elif kind == "dmy":
+                a, b, c = groups
+                dd, mm, yy = int(a), int(b), int(c)
+                if yy < 100: yy += 2000
+                dt = datetime(yy, mm, dd)
+            elif kind == "ymd":
+                yy, mm, dd = map(int, groups)
+                dt = datetime(yy, mm, dd)
+            elif kind == "mon_d_y":
+                mon, dd, yy = groups
+                mm = MONTHS[mon.lower()]
+                dt = datetime(int(yy), mm, int(dd))
+            elif kind == "d_mon_y":
+                dd, mon, yy = groups
+                mm = MONTHS[mon.lower()]
+                dt = datetime(int(yy), mm, int(dd))
+            else:
+                continue
+            return dt.strftime("%Y-%m-%d")
+        except Exception:
+            continue
+    return ""
+
+def _detect_brand(top_lines):
+    """Return (merchant name, dictionary match or None)."""
+    # 1) merchant dictionary: fuzzy in the header, exact anywhere
+    match = default_index().resolve(top_lines)
+    if match:
+        return match["name"], match
+
+    # 2) first meaningful top line (if it looks like a venue name)
+    skip = r"(phone|tel|gst|vat|store|slip|staff|date|table|qty|card|visa|debit|credit|subtotal|tax|total|welcome)"
+    for ln in top_lines[:12]:
+        if re.search(skip, ln, flags=re.I):
+            continue
+        if sum(c.isalpha() for c in ln) >= 3:
+            # Title-case this guess
+            guess = re.sub(r"[:\-\u2022]+$", "", ln.strip())
+            if len(guess) < 4:
+                continue
+            if guess.islower():
+                continue
+            return guess, None
+
+    return "", None
+
+def _debug_numbers(lines, tokens=None):
+    print(f"DEBUG: line_count={len(lines)}", file=sys.stderr, flush=True)
+
+    if tokens is None:
+        tokens = LineTokens(lines)
+    nums = [text for found in tokens.all_money() for text, _ in found]
+    # Print to STDERR so it doesn't break JSON output
+    print("DEBUG: numbers found =", nums, file=sys.stderr)
+
+
+def parse_fields(lines, rows=None, timer=NULL_TIMER, tokens=None):
+    """Fields from OCR text lines; rows (from group_rows) drive item pairing when available.
+
+    tokens may be the caller's LineTokens of these same lines (see _extract).
+    """
+    joined = "\n".join(lines)
+    # Remove any accidental path text
+    joined = re.sub(r"[a-z]:\\[^\n]+", "", joined, flags=re.I)
+
+    path_line = re.compile(r"^[a-z]:\\", re.I)
+    kept = [ln for ln in lines if not path_line.match(ln.strip())]
+    if tokens is None or tokens.lines is not lines or len(kept) != len(lines):
+        tokens = LineTokens(kept)
+    lines = kept
+
+    with timer.stage("parse.pick_total"):
+        amount = _pick_total(lines, tokens)
+    with timer.stage("parse.parse_date"):
+        date   = _parse_date(joined, tokens)
+    with timer.stage("parse.detect_brand"):
+        merchant, match = _detect_brand(lines)
+
+    # Use categorizer for item-level only (compiled once per process)
+    categorizer = get_categorizer()
+
+    receipt_total = float(amount) if amount else None
+    with timer.stage("parse.line_items"):
+        items = parse_row_items(rows, categorizer, receipt_total, merchant) if rows else []
+        if not items or (receipt_total and abs(_items_sum(items) - receipt_total) > 0.01):
+            line_items = parse_line_items(
+                lines,
+                categorizer,
+                receipt_total=receipt_total,
+                merchant=merchant,
+                tokens=tokens
+            )
+            # the row pairing missed the total: keep whichever reading is closer to it
+            if not items or (line_items and abs(_items_sum(line_items) - receipt_total)
+                             < abs(_items_sum(items) - receipt_total)):
+                items = line_items
+
+    applied_hint = _apply_category_hint(items, merchant, match)
+
+    items_total = _items_sum(items)
+
+    if not items and amount and applied_hint:
+        try:
+            amount_str = f"{float(str(amount).strip()):.2f}"
+        except Exception:
+            amount_str = str(amount)
+        items.append({
+            "qty": 1,
+            # Prefer a neutral fallback rather than merchant name
+            "desc": "Receipt",
+            "unit_price": amount_str,
+            "total": amount_str,
+            "category": applied_hint
+        })
+
+    if items_total > 0:
+        amount_val = float(amount) if amount else 0.0
+        if amount_val <= 0 or abs(items_total - amount_val) > 0.01:
+            amount = f"{items_total:.2f}"
+
+    return {
+        "merchant": merchant,
+        "merchant_score": match["score"] if match else None,
+        "amount": amount,
+        "date": date,
+        "items": items,
+        "raw_text": joined
+    }
+
+
+def _items_sum(items):
+    total = 0.0
+    for item in items:
+        try:
+            total += float(item.get("total") or 0)
+        except Exception:
+            pass
+    return total
+
+
+def _apply_category_hint(items, merchant, match):
+    """Give uncategorized items the merchant's category; returns that category or None."""
+    applied_hint = match["category"] if match else None
+    if not applied_hint:
+        merchant_hint = (merchant or "").lower()
+        for key, cat in MERCHANT_CATEGORY_HINTS.items():
+            if key in merchant_hint:
+                applied_hint = cat
+                break
+    if applied_hint:
+        for item in items:
+            if not item.get("category") or item["category"] == "Other":
+                item["category"] = applied_hint
+    return applied_hint
+
+
+def parse_band_fields(header, footer):
+    """merchant/amount/date from the header and footer band lines alone (progressive mode)."""
+    lines = header + footer
+    tokens = LineTokens(lines)
+    merchant, match = _detect_brand(header)
+    return {
+        "merchant": merchant,
+        "merchant_score": match["score"] if match else None,
+        "amount": _pick_total(lines, tokens),
+        "date": _parse_date("\n".join(lines), tokens),
+    }
+
+
+# Bump when preprocess_image or the OCR post-processing changes (invalidates cached OCR lines);
+# engine profile settings and models are fingerprinted on their own, see pipeline_version
+OCR_PIPELINE_VERSION = "6"
+# Bump when parse_fields output can change for the same lines (cached results get re-parsed)
+PARSER_VERSION = "8"
+
+
+def parser_version():
+    """PARSER_VERSION plus the learned category model in use: retraining re-parses cached results."""
+    fingerprint = model_fingerprint()
+    return f"{PARSER_VERSION}+{fingerprint}" if fingerprint else PARSER_VERSION
+
+
+def engine_profile(ocr=None):
+    """(name, fingerprint) of the profile an engine was built from (see ocr_engine.create);
+    engines built elsewhere count as the profile the environment selects now."""
+    tag = getattr(ocr, "smartspend_profile", None)
+    if tag is not None:
+        return tag
+    import ocr_engine
+    try:
+        return ocr_engine.profile_tag()
+    except ValueError:
+        return None, "custom"
+
+
+def pipeline_version(ocr=None):
+    """OCR_PIPELINE_VERSION plus the engine profile: other settings or models read other text."""
+    return f"{OCR_PIPELINE_VERSION}+{engine_profile(ocr)[1]}"
+
+
+def result_version(ocr=None):
+    """Version tag of a parsed result: stored results from another version are not reused as-is."""
+    return f"{pipeline_version(ocr)}:{parser_version()}"
+
+
+# Working-resolution targets: text needs ~1200px of width, and the detector
+# never looks at more than DET_LIMIT_SIDE_LEN pixels on the long side.
+MIN_TEXT_WIDTH = 1200
+DET_LIMIT_SIDE_LEN = 1536
+# Skew and binarization choice are decided on a proxy this size (long side)
+PROXY_SIDE = 800
+
+
+def _image_size(data):
+    """(width, height) from a PNG/JPEG header without decoding, or None."""
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+    if data[:2] == b"\xff\xd8":
+        i, n = 2, len(data)
+        while i + 9 < n:
+            if data[i] != 0xFF:
+                i += 1
+                continue
+            marker = data[i + 1]
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+                i += 1 if marker == 0xFF else 2
+                continue
+            seg = int.from_bytes(data[i + 2:i + 4], "big")
+            # SOF0..SOF15 except DHT/JPG/DAC carry the frame size
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                h = int.from_bytes(data[i + 5:i + 7], "big")
+                w = int.from_bytes(data[i + 7:i + 9], "big")
+                return w, h
+            i += 2 + seg
+    return None
+
+
+def _working_scale(w, h):
+    """Scale from the decoded size to the size we preprocess and OCR at."""
+    if w < MIN_TEXT_WIDTH:
+        scale = float(max(2, int(MIN_TEXT_WIDTH / max(1, w))))
+    else:
+        scale = 1.0
+    # do not go beyond what the detector will use, but keep text width legible
+    cap = max(DET_LIMIT_SIDE_LEN / max(w, h), MIN_TEXT_WIDTH / max(1, w))
+    return min(scale, cap)
+
+
+def _reduction(data, quad=None):
+    """1, 2, 4 or 8: how far a JPEG can be shrunk while decoding and keep its working resolution.
+
+    With quad (from locate_receipt) only that region has to keep it.
+    """
+    size = _image_size(data)
+    if not size or data[:2] != b"\xff\xd8":
+        return 1
+    w, h = _quad_size(quad, *size) if quad is not None else size
+    scale = _working_scale(w, h)
+    for factor in (8, 4, 2):
+        if scale * factor <= 1.0:
+            return factor
+    return 1
+
+
+def _coarser_than(img, data, quad):
+    """img, decoded from data, has fewer pixels than decode_image(data, quad) would give."""
+    size = _image_size(data)
+    return bool(size) and img.shape[1] * _reduction(data, quad) < size[0]
+
+
+def decode_image(data, quad=None):
+    """Decode encoded image bytes (JPEG/PNG/...) into a BGR array, or None.
+
+    Oversized photos are decoded at 1/2, 1/4 or 1/8 size directly when the
+    working resolution (of the whole photo, or of quad) would throw those
+    pixels away anyway.
+    """
+    import cv2
+    import numpy as np
+    if not data:
+        return None
+    buf = np.frombuffer(data, np.uint8)
+    flag = {8: cv2.IMREAD_REDUCED_COLOR_8, 4: cv2.IMREAD_REDUCED_COLOR_4,
+            2: cv2.IMREAD_REDUCED_COLOR_2}.get(_reduction(data, quad))
+    if flag is not None:
+        img = cv2.imdecode(buf, flag)
+        if img is not None:
+            return img
+    return cv2.imdecode(buf, cv2.IMREAD_COLOR)
+
+
+def _estimate_skew(proxy):
+    """Light deskew angle via minAreaRect on edges (helps small tilt); 0 when none."""
+    import cv2
+    import numpy as np
+    try:
+        edges = cv2.Canny(proxy, 50, 150)
+        ys, xs = np.where(edges > 0)
+        if len(xs) > 100:
+            coords = np.column_stack((xs, ys)).astype(np.float32)
+            rect = cv2.minAreaRect(coords)
+            ang = rect[-1]
+            ang = -(90 + ang) if ang < -45 else -ang
+            if 0.5 <= abs(ang) <= 8.0:
+                return ang
+    except Exception:
+        pass
+    return 0.0
+
+
+def _rotate(gray, ang):
+    import cv2
+    M = cv2.getRotationMatrix2D((gray.shape[1]//2, gray.shape[0]//2), ang, 1.0)
+    return cv2.warpAffine(gray, M, (gray.shape[1], gray.shape[0]), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+
+
+def _odd(n, lo=3):
+    n = max(lo, int(round(n)))
+    return n if n % 2 else n + 1
+
+
+def _binarize(gray, kind, px_scale=1.0):
+    """One of the three candidate cleanups; px_scale shrinks kernels on the proxy."""
+    import cv2
+    if kind == "clahe":
+        # Candidate A: CLAHE (great for faint thermal/purple ink)
+        clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8, 8))
+        a = clahe.apply(gray)
+        _, out = cv2.threshold(a, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        return out
+    if kind == "adaptive":
+        # Candidate B: Adaptive threshold (handles uneven lighting)
+        b = cv2.medianBlur(gray, 3)
+        return cv2.adaptiveThreshold(
+            b, 255,
+            cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+            cv2.THRESH_BINARY, _odd(31 * px_scale), 10
+        )
+    # Candidate C: Contrast stretch + light blur, then Otsu
+    c = cv2.normalize(gray, None, 0, 255, cv2.NORM_MINMAX)
+    c = cv2.GaussianBlur(c, (3, 3), 0)
+    _, out = cv2.threshold(c, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return out
+
+
+def _texty_score(img_):
+    import cv2
+    import numpy as np
+    # Higher = more "texty": use edge energy as a cheap proxy
+    sobelx = cv2.Sobel(img_, cv2.CV_32F, 1, 0, ksize=3)
+    sobely = cv2.Sobel(img_, cv2.CV_32F, 0, 1, ksize=3)
+    return float(np.mean(np.abs(sobelx)) + np.mean(np.abs(sobely)))
+
+
+def preprocess_image(img, dump_path=None, timer=NULL_TIMER, return_gray=False, quad=None):
+    """BGR array in, cleaned single-channel array out (written to dump_path only when asked).
+
+    With quad (from locate_receipt) the receipt is first cut out and
+    perspective-corrected, straight to working resolution. Skew and the best
+    of three binarizations are chosen on a small proxy; only the winning
+    transform is then applied once at working resolution. With return_gray,
+    also return the deskewed grayscale before binarization (same geometry as
+    the cleaned image) for re-reading crops.
+    """
+    import cv2
+    import numpy as np
+    if quad is not None:
+        with timer.stage("preprocess.warp"):
+            img = warp_receipt(img, quad)
+    with timer.stage("preprocess.gray"):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    h, w = gray.shape
+
+    # Decide on a proxy at the working resolution's text scale
+    scale = _working_scale(w, h)
+    proxy_scale = min(1.0, PROXY_SIDE / max(w, h))
+    with timer.stage("preprocess.proxy"):
+        proxy = cv2.resize(gray, (max(1, int(w * proxy_scale)), max(1, int(h * proxy_scale))),
+                           interpolation=cv2.INTER_AREA) if proxy_scale < 1.0 else gray
+
+    with timer.stage("preprocess.deskew"):
+        ang = _estimate_skew(proxy)
+        if ang:
+            proxy = _rotate(proxy, ang)
+    with timer.stage("preprocess.select"):
+        kinds = ("clahe", "adaptive", "normalize")
+        px_scale = proxy_scale / scale
+        best = max(kinds, key=lambda k: _texty_score(_binarize(proxy, k, px_scale)))
+
+    # Apply once at working resolution (tiny text needs pixels; huge photos do not)
+    with timer.stage("preprocess.resize"):
+        tw, th = max(1, int(round(w * scale))), max(1, int(round(h * scale)))
+        if (tw, th) != (w, h):
+            interp = cv2.INTER_CUBIC if scale > 1.0 else cv2.INTER_AREA
+            gray = cv2.resize(gray, (tw, th), interpolation=interp)
+        if ang:
+            gray = _rotate(gray, ang)
+    with timer.stage("preprocess.binarize"):
+        cand = _binarize(gray, best)
+
+    # Slight morphology to reduce speckle and thicken faint strokes
+    with timer.stage("preprocess.morph"):
+        cand = cv2.medianBlur(cand, 3)
+        cand = cv2.dilate(cand, np.ones((1, 2), np.uint8), iterations=1)
+    timer.note("working_size", [int(cand.shape[1]), int(cand.shape[0])])
+    timer.note("binarize", best)
+
+    if dump_path:
+        cv2.imwrite(dump_path, cand)
+    return (cand, gray) if return_gray else cand
+
+
+# ---------- receipt localization ----------
+# Phone photos show table, hands and background around the receipt. Finding
+# the paper first lets the detector spend det_limit_side_len on text only.
+LOCATE_SIDE = 480         # long side of the copy the quadrilateral is searched on
+LOCATE_MIN_AREA = 0.08    # of the photo; smaller blobs are not the receipt
+LOCATE_MAX_AREA = 0.92    # beyond this the photo already is the receipt
+LOCATE_MIN_FILL = 0.85    # contour area / quad area: the outline must really be four-sided
+LOCATE_MARGIN = 0.01      # of the quad size, added around the detected edges
+# extract_many: several receipts side by side are each smaller than one alone
+MULTI_MIN_AREA = 0.02
+MULTI_MIN_RATIO = 0.2     # of the largest outline; smaller ones are labels or scraps
+MAX_RECEIPTS = 8
+
+
+def _order_quad(pts):
+    """Corners as top-left, top-right, bottom-right, bottom-left."""
+    import numpy as np
+    pts = np.asarray(pts, dtype=np.float32).reshape(4, 2)
+    s, d = pts.sum(axis=1), pts[:, 1] - pts[:, 0]
+    return np.array([pts[np.argmin(s)], pts[np.argmin(d)], pts[np.argmax(s)], pts[np.argmax(d)]],
+                    dtype=np.float32)
+
+
+def _quad_candidates(gray, top=3):
+    """Outer contours that may be the receipt: bright paper, then strong edges."""
+    import cv2
+    import numpy as np
+    blur = cv2.GaussianBlur(gray, (5, 5), 0)
+    _, bright = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    bright = cv2.morphologyEx(bright, cv2.MORPH_CLOSE, np.ones((9, 9), np.uint8))
+    edges = cv2.dilate(cv2.Canny(blur, 30, 100), np.ones((3, 3), np.uint8))
+    edges = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, np.ones((5, 5), np.uint8))
+    for mask in (bright, edges):
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        yield from sorted(contours, key=cv2.contourArea, reverse=True)[:top]
+
+
+def _find_quad(gray):
+    """Ordered receipt corners in gray's pixels, or None when no outline is convincing."""
+    return next(_iter_quads(gray), None)
+
+
+def _iter_quads(gray, min_area=LOCATE_MIN_AREA, top=3):
+    """Convincing receipt outlines in gray's pixels (ordered corners), in _quad_candidates order."""
+    import cv2
+    import numpy as np
+    area = float(gray.shape[0] * gray.shape[1])
+    for c in _quad_candidates(gray, top):
+        hull = cv2.convexHull(c)
+        c_area = cv2.contourArea(hull)
+        if not min_area * area <= c_area <= LOCATE_MAX_AREA * area:
+            continue
+        approx = cv2.approxPolyDP(hull, 0.02 * cv2.arcLength(hull, True), True)
+        if len(approx) == 4 and cv2.isContourConvex(approx):
+            quad = approx.reshape(4, 2)
+        else:
+            # rounded or curled corners: the enclosing rectangle, if the blob fills it
+            quad = cv2.boxPoints(cv2.minAreaRect(hull))
+        q_area = cv2.contourArea(np.asarray(quad, dtype=np.float32))
+        if q_area <= 0 or c_area / q_area < LOCATE_MIN_FILL or q_area > LOCATE_MAX_AREA * area:
+            continue
+        ordered = _order_quad(quad)
+        # a receipt standing on a corner confuses the ordering; better not to warp at all
+        if cv2.contourArea(ordered) >= 0.99 * q_area:
+            yield ordered
+
+
+def _locate_gray(img):
+    import cv2
+    s = min(1.0, LOCATE_SIDE / max(img.shape[:2]))
+    small = cv2.resize(img, None, fx=s, fy=s, interpolation=cv2.INTER_AREA) if s < 1.0 else img
+    return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+
+
+def _normalize_quad(quad, gray):
+    h, w = gray.shape
+    centre = quad.mean(axis=0)
+    quad = centre + (quad - centre) * (1.0 + 2 * LOCATE_MARGIN)
+    return (quad / (w, h)).clip(0.0, 1.0)
+
+
+def locate_receipt(img):
+    """Receipt corners as fractions of the photo's width/height (tl, tr, br, bl), or None.
+
+    Searched on a LOCATE_SIDE grayscale copy; None (disabled with
+    SMARTSPEND_OCR_LOCATE=0, or no confident outline) means OCR the whole
+    photo as before.
+    """
+    if os.environ.get("SMARTSPEND_OCR_LOCATE", "1") == "0":
+        return None
+    gray = _locate_gray(img)
+    quad = _find_quad(gray)
+    return _normalize_quad(quad, gray) if quad is not None else None
+
+
+def locate_receipts(img):
+    """Every receipt outline in a photo of several, as locate_receipt quads in reading order.
+
+    Outlines of at least MULTI_MIN_AREA of the photo and MULTI_MIN_RATIO of
+    the largest one count, at most MAX_RECEIPTS; one found by both the
+    brightness and the edge mask is kept once. Receipts that touch merge
+    into one outline, which is then read as one receipt.
+    """
+    import cv2
+    if os.environ.get("SMARTSPEND_OCR_LOCATE", "1") == "0":
+        return []
+
+    def inside(quad, other):
+        return cv2.pointPolygonTest(quad, tuple(map(float, other.mean(axis=0))), False) >= 0
+
+    gray = _locate_gray(img)
+    found = []
+    for quad in _iter_quads(gray, MULTI_MIN_AREA, top=2 * MAX_RECEIPTS):
+        # the same receipt again, a block of text on one, or the table around them
+        if any(inside(q, quad) or inside(quad, q) for q in found):
+            continue
+        found.append(quad)
+    if not found:
+        return []
+    largest = max(cv2.contourArea(q) for q in found)
+    found = [q for q in found if cv2.contourArea(q) >= MULTI_MIN_RATIO * largest][:MAX_RECEIPTS]
+    # rows of receipts top to bottom, each row left to right; a receipt whose
+    # centre is level with the first one of a row is in that row
+    rows = []
+    for q in sorted(found, key=lambda q: float(q[:, 1].mean())):
+        if rows and rows[-1][0][:, 1].min() <= q[:, 1].mean() <= rows[-1][0][:, 1].max():
+            rows[-1].append(q)
+        else:
+            rows.append([q])
+    return [_normalize_quad(q, gray) for row in rows for q in sorted(row, key=lambda q: float(q[:, 0].mean()))]
+
+
+def _quad_size(quad, w, h):
+    """(width, height) in pixels of the rectified quad on a w x h image."""
+    import numpy as np
+    pts = quad * (w, h)
+    tl, tr, br, bl = pts
+    return (max(np.linalg.norm(tr - tl), np.linalg.norm(br - bl)),
+            max(np.linalg.norm(bl - tl), np.linalg.norm(br - tr)))
+
+
+def warp_receipt(img, quad):
+    """Perspective-correct the quad out of img, sized for OCR (see _working_scale)."""
+    import cv2
+    import numpy as np
+    h, w = img.shape[:2]
+    qw, qh = _quad_size(quad, w, h)
+    scale = _working_scale(qw, qh)
+    tw, th = max(1, int(round(qw * scale))), max(1, int(round(qh * scale)))
+    src = (quad * (w, h)).astype(np.float32)
+    dst = np.array([[0, 0], [tw - 1, 0], [tw - 1, th - 1], [0, th - 1]], dtype=np.float32)
+    M = cv2.getPerspectiveTransform(src, dst)
+    interp = cv2.INTER_CUBIC if scale > 1.0 else cv2.INTER_LINEAR
+    return cv2.warpPerspective(img, M, (tw, th), flags=interp, borderMode=cv2.BORDER_REPLICATE)
+
+
+# ---------- duplicate detection ----------
+HASH_SIDE = 256   # long side of the image the perceptual hash is computed on
+def _paper_box(gray):
+    """(x, y, w, h) of the largest bright blob (the receipt) in a small grayscale image, or None."""
+    import cv2
+    import numpy as np
+    _, th = cv2.threshold(cv2.GaussianBlur(gray, (5, 5), 0), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    th = cv2.morphologyEx(th, cv2.MORPH_CLOSE, np.ones((7, 7), np.uint8))
+    n, _, stats, _ = cv2.connectedComponentsWithStats(th)
+    if n > 1:
+        i = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+        x, y, w, h = (int(v) for v in stats[i, :4])
+        if w * h > 0.2 * gray.size:
+            return x, y, w, h
+    return None
+
+
+def _paper_region(gray):
+    """Crop to the receipt so framing changes do not move the hash."""
+    box = _paper_box(gray)
+    if box is None:
+        return gray
+    x, y, w, h = box
+    return gray[y:y + h, x:x + w]
+
+
+def receipt_hash(data):
+    """64-bit DCT perceptual hash of the deskewed receipt, or None if the bytes do not decode.
+
+    Works on a HASH_SIDE grayscale proxy (large JPEGs decode straight at
+    reduced size), so it is cheap enough to run before any OCR.
+    """
+    import cv2
+    import numpy as np
+    buf = np.frombuffer(data, np.uint8)
+    flag = cv2.IMREAD_GRAYSCALE
+    size = _image_size(data)
+    if size and data[:2] == b"\xff\xd8":
+        for factor, reduced in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+                                (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                                (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)):
+            if max(size) >= factor * HASH_SIDE:
+                flag = reduced
+                break
+    gray = cv2.imdecode(buf, flag)
+    if gray is None:
+        return None
+    s = HASH_SIDE / max(gray.shape)
+    if s < 1.0:
+        gray = cv2.resize(gray, None, fx=s, fy=s, interpolation=cv2.INTER_AREA)
+    gray = _paper_region(gray)
+    ang = _estimate_skew(gray)
+    if ang:
+        gray = _rotate(gray, ang)
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].flatten()
+    bits = low > np.median(low[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+# ---------- storage rendition ----------
+# What we keep in receipt_blob: enough to read the receipt back, not the phone photo
+STORE_MAX_SIDE = 1600
+STORE_QUALITY = 60      # WebP; grayscale text stays legible well below photo qualities
+STORE_JPEG_QUALITY = 70  # when this OpenCV build cannot write WebP
+PAPER_MARGIN = 0.02     # of the crop size, kept around the detected receipt
+
+
+def _encode_gray(gray, quality):
+    """(bytes, mime type): WebP when available, else JPEG."""
+    import cv2
+    ok, buf = cv2.imencode(".webp", gray, [cv2.IMWRITE_WEBP_QUALITY, quality])
+    if ok:
+        return buf.tobytes(), "image/webp"
+    ok, buf = cv2.imencode(".jpg", gray, [cv2.IMWRITE_JPEG_QUALITY, STORE_JPEG_QUALITY,
+                                          cv2.IMWRITE_JPEG_OPTIMIZE, 1])
+    return (buf.tobytes(), "image/jpeg") if ok else (None, None)
+
+
+def _fit(gray, side):
+    import cv2
+    s = side / max(gray.shape[:2])
+    if s >= 1.0:
+        return gray
+    return cv2.resize(gray, (max(1, round(gray.shape[1] * s)), max(1, round(gray.shape[0] * s))),
+                      interpolation=cv2.INTER_AREA)
+
+
+def compact_receipt(data, max_side=STORE_MAX_SIDE, quality=STORE_QUALITY):
+    """Bounded-size rendition of an upload for storage.
+
+    Crops to the detected receipt, drops colour, caps the long side and
+    re-encodes. Returns {"type", "image", "original_bytes", "stored_bytes",
+    "saved_bytes"}, or None when the bytes do not decode as an
+    image (PDFs are stored as uploaded).
+    """
+    import cv2
+    import numpy as np
+    # full size: decode_image would shrink to the OCR working scale, which can be under max_side
+    gray = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE) if data else None
+    if gray is None:
+        return None
+    h, w = gray.shape
+    # find the paper on a small proxy, then cut it out of the full image
+    s = min(1.0, PROXY_SIDE / max(h, w))
+    box = _paper_box(_fit(gray, PROXY_SIDE))
+    if box is not None:
+        x, y, bw, bh = (v / s for v in box)
+        mx, my = bw * PAPER_MARGIN, bh * PAPER_MARGIN
+        x0, y0 = max(0, int(x - mx)), max(0, int(y - my))
+        x1, y1 = min(w, int(x + bw + mx) + 1), min(h, int(y + bh + my) + 1)
+        gray = gray[y0:y1, x0:x1]
+    image, mime = _encode_gray(_fit(gray, max_side), quality)
+    if image is None:
+        return None
+    if len(image) >= len(data):
+        # already small (e.g. a screenshot); keeping the upload costs nothing
+        return None
+    return {
+        "type": mime,
+        "image": image,
+        "original_bytes": len(data),
+        "stored_bytes": len(image),
+        "saved_bytes": len(data) - len(image),
+    }
+
+
+def create_ocr(profile=None):
+    """Build the OCR engine for the active profile (slow: loads det/rec/cls models; see ocr_engine.py)."""
+    import ocr_engine
+    return ocr_engine.create(profile)
+
+
+class OCRError(Exception):
+    """Both OCR passes failed; the message is reported as-is in result["error"]."""
+
+
+def empty_result():
+    return {"merchant":"","amount":"","date":"","items":[],"raw_text":""}
+
+
+def read_source(src):
+    """Return the raw bytes for a path or pass bytes through."""
+    if isinstance(src, (bytes, bytearray)):
+        return bytes(src)
+    with open(src, "rb") as f:
+        return f.read()
+
+
+def extract(src, ocr, dump_path=None, scope="", on_partial=None):
+    """Run preprocessing + OCR + field parsing for one image (path or bytes) with an existing engine.
+
+    scope (e.g. the user id) limits duplicate detection to that user's earlier receipts;
+    without one there is no duplicate detection at all.
+    on_partial, if given, is called once with {"partial": true, merchant, amount,
+    date, "first_ms"} as soon as the header and footer are read, before the
+    line items; cache hits and undecodable images skip straight to the result.
+    """
+    timer = StageTimer()
+    result = _extract(src, ocr, dump_path, timer, scope, on_partial)
+    result["timings"] = timer.as_dict()
+    if timer.info.get("image_size"):
+        result["image_size"] = timer.info["image_size"]
+    result["peak_rss_mb"] = peak_rss_mb()
+    log_metrics({
+        "timings": result["timings"],
+        "peak_rss_mb": result["peak_rss_mb"],
+        "cache": result.get("cache"),
+        "error": result.get("error"),
+        "lines": len((result.get("raw_text") or "").splitlines()),
+        "items": len(result.get("items") or []),
+        **timer.info,
+    })
+    return result
+
+
+def _extract(src, ocr, dump_path, timer, scope="", on_partial=None):
+    result = empty_result()
+    deadline = Deadline()  # the budget covers the whole request, reading included
+    try:
+        src_path = None if isinstance(src, (bytes, bytearray)) else src
+        if src_path is not None and not (os.path.isfile(src_path) and os.path.getsize(src_path) > 0):
+            result["error"] = "file_missing_or_empty"
+            return result
+        with timer.stage("read"):
+            data = read_source(src)
+        if not data:
+            result["error"] = "file_missing_or_empty"
+            return result
+
+        # near-duplicates are looked up before the cache so a re-upload is flagged too
+        import receipt_dupes
+        # no owner, no lookup: an unscoped "" bucket would match receipts across accounts
+        dupes = receipt_dupes.default_index() if scope else None
+        phash = sha = dup = None
+        if dupes is not None:
+            with timer.stage("import.cv2"):
+                import cv2  # noqa: F401
+            with timer.stage("dupes.lookup"):
+                phash = receipt_hash(data)
+                sha = hashlib.sha256(data).hexdigest()
+                dup = dupes.nearest(phash, scope) if phash is not None else None
+            if dup is not None:
+                print(f"DEBUG: near-duplicate of {dup['sha256'][:12]} (distance {dup['distance']})",
+                      file=sys.stderr, flush=True)
+                result["duplicate_of"] = {k: dup[k] for k in ("sha256", "distance", "seen")}
+                if dup["sha256"] == sha and dup["version"] == result_version(ocr):
+                    # the very same file again; a perceptual match alone may be another receipt,
+                    # and a result from an older pipeline is redone (the OCR cache may still help)
+                    result.update(dup["result"])
+                    result["cache"] = "duplicate"
+                    return result
+
+        import ocr_cache
+        cache = ocr_cache.default_cache()
+        key = None
+        if cache is not None:
+            with timer.stage("cache.lookup"):
+                key = ocr_cache.image_key(data, pipeline_version(ocr))
+                hit = cache.get(key)
+            if hit is not None:
+                page, cached, stored_parser = hit
+                print("DEBUG: cache hit", file=sys.stderr, flush=True)
+                if stored_parser != parser_version():
+                    rows = [Row.from_list(r) for r in page.get("rows") or []]
+                    cached = parse_fields(page["lines"], rows, timer=timer)
+                    cache.put(key, page, cached, parser_version())
+                result.update(cached)
+                result["cache"] = "hit"
+                _remember(dupes, phash, sha, cached, scope, ocr)
+                return result
+            result["cache"] = "miss"
+
+        on_bands = None
+        if on_partial is not None:
+            def on_bands(header, footer):
+                with timer.stage("parse.bands"):
+                    partial = parse_band_fields(header, footer)
+                first_ms = round(timer.elapsed_ms(), 2)
+                timer.note("first_fields_ms", first_ms)
+                on_partial({"partial": True, **partial, "first_ms": first_ms})
+
+        # the merchant is recognized from the header band itself; a header pass is only
+        # tried once some merchant has a learned layout
+        import receipt_templates
+        templates = receipt_templates.default_store()
+        chosen = {}
+        on_header = None
+        if templates is not None and on_bands is None and templates.any_usable():
+            def on_header(header, w, h):
+                merchant, match = _detect_brand(header)
+                layout = templates.get(match["name"]) if match else None
+                if layout is None:
+                    return None
+                chosen.update(layout=layout, merchant=merchant, match=match)
+                chosen["cut"] = template_cut(layout, w, h)
+                return chosen["cut"]
+
+        lines, rows = ocr_lines(data, ocr, src_path=src_path, dump_path=dump_path, timer=timer,
+                                deadline=deadline, on_bands=on_bands, on_header=on_header)
+        tokens = LineTokens(lines)
+        _debug_numbers(lines, tokens)
+
+        parsed = None
+        cut_short = False  # the page ends where the layout said, not at the bottom of the receipt
+        if chosen:
+            name = chosen["match"]["name"]
+            with timer.stage("parse.template"):
+                parsed = parse_with_template(lines, rows, chosen["layout"], chosen["merchant"],
+                                             chosen["match"], timer.info.get("page_size"))
+            timer.note("template", name if parsed is not None else "failed")
+            if parsed is None:
+                print(f"DEBUG: receipt does not fit the {name} layout", file=sys.stderr, flush=True)
+                try:
+                    templates.failed(name)
+                except Exception as e:
+                    print(f"DEBUG: template store failed: {e}", file=sys.stderr, flush=True)
+                if chosen["cut"] is not None:
+                    # the bottom was never read: start over the generic way
+                    lines, rows = ocr_lines(data, ocr, src_path=src_path, dump_path=dump_path, timer=timer,
+                                            deadline=deadline)
+                    tokens = LineTokens(lines)
+            else:
+                cut_short = chosen["cut"] is not None
+        if parsed is None:
+            parsed = parse_fields(lines, rows, timer=timer, tokens=tokens)
+        # a receipt that just failed its merchant's layout must not reset that layout's failures
+        if templates is not None and timer.info.get("fallback") != "full" and timer.info.get("template") != "failed":
+            _learn_layout(templates, parsed, rows, timer.info.get("page_size"))
+        result.update(parsed)
+        _remember(dupes, phash, sha, parsed, scope, ocr)
+        if key is not None and not cut_short:
+            # a cut page could not be re-parsed after a parser change; only full reads are cached
+            try:
+                page = {"lines": lines, "rows": [r.to_list() for r in rows]}
+                with timer.stage("cache.store"):
+                    cache.put(key, page, parsed, parser_version())
+            except Exception as e:
+                print(f"DEBUG: cache store failed: {e}", file=sys.stderr, flush=True)
+
+    except OCRError as e:
+        result["error"] = str(e)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+
+    return result
+
+
+def _learn_layout(templates, parsed, rows, page_size):
+    sample = layout_sample(parsed, rows, page_size)
+    if sample is None:
+        return
+    try:
+        # a sample implies a dictionary match, so merchant is the canonical name
+        templates.learn(parsed["merchant"], sample)
+    except Exception as e:
+        print(f"DEBUG: template store failed: {e}", file=sys.stderr, flush=True)
+
+
+def _remember(dupes, phash, sha, parsed, scope, ocr):
+    if dupes is None or phash is None:
+        return
+    if not (parsed.get("raw_text") or parsed.get("items")):
+        return  # nothing worth warning about later
+    try:
+        dupes.add(phash, sha, parsed, scope, result_version(ocr))
+    except Exception as e:
+        print(f"DEBUG: duplicate index store failed: {e}", file=sys.stderr, flush=True)
+
+
+# ---------- several receipts in one photo ----------
+def extract_many(src, ocr, dump_path=None, scope=""):
+    """Extract every receipt in a photo of several; {"receipts": [result + "box", ...]}.
+
+    Each outline from locate_receipts is preprocessed, OCRed and parsed on
+    its own engine (the strip engines of ocr_tiled), concurrently, so a pile
+    takes about as long as its slowest receipt. "box" is the outline as
+    [[x, y], ...] fractions of the photo (tl, tr, br, bl). A photo with one
+    receipt or none goes through extract unchanged, with "box" null.
+    Regions skip the OCR cache and duplicate index, which are keyed on whole
+    uploads.
+    """
+    timer = StageTimer()
+    out = {"receipts": []}
+    quads, img, data = [], None, b""
+    try:
+        with timer.stage("read"):
+            data = read_source(src)
+        with timer.stage("import.cv2"):
+            import cv2  # noqa: F401
+        with timer.stage("decode"):
+            img = decode_image(data)
+        if img is not None:
+            with timer.stage("locate"):
+                quads = locate_receipts(img)
+    except Exception as e:
+        print(f"DEBUG: receipt segmentation failed: {e}", file=sys.stderr, flush=True)
+    print(f"DEBUG: {len(quads)} receipt outline(s) found", file=sys.stderr, flush=True)
+    if len(quads) < 2:
+        one = extract(src, ocr, dump_path=dump_path, scope=scope)
+        one["box"] = None
+        out["receipts"].append(one)
+        return out
+
+    from concurrent.futures import ThreadPoolExecutor
+    deadline = Deadline()
+    # one decode at the resolution the smallest receipt needs serves all of them
+    finest = min(quads, key=lambda q: _reduction(data, q))
+    if _coarser_than(img, data, finest):
+        with timer.stage("decode.region"):
+            img = decode_image(data, finest)
+    pool = _checkout_engines(ocr, min(_tile_workers(), len(quads)))
+    timer.note("receipts", [len(quads), pool.qsize()])
+
+    def run(quad):
+        eng = pool.get()
+        try:
+            return _extract_region(data, img, quad, eng, deadline)
+        finally:
+            pool.put(eng)
+
+    try:
+        with timer.stage("regions"), ThreadPoolExecutor(max_workers=pool.qsize()) as ex:
+            out["receipts"] = list(ex.map(run, quads))
+    finally:
+        _return_engines(pool, ocr)
+    out["timings"] = timer.as_dict()
+    out["image_size"] = [int(img.shape[1]), int(img.shape[0])]
+    out["peak_rss_mb"] = peak_rss_mb()
+    log_metrics({
+        "timings": out["timings"],
+        "peak_rss_mb": out["peak_rss_mb"],
+        "error": next((r["error"] for r in out["receipts"] if r.get("error")), None),
+        "items": sum(len(r.get("items") or []) for r in out["receipts"]),
+        **timer.info,
+    })
+    return out
+
+
+def _extract_region(data, img, quad, ocr, deadline):
+    timer = StageTimer()
+    result = empty_result()
+    try:
+        lines, rows = _ocr_region(data, img, quad, ocr, timer=timer, deadline=deadline, tile=False)
+        result.update(parse_fields(lines, rows, timer=timer))
+    except OCRError as e:
+        result["error"] = str(e)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["box"] = [[round(float(x), 4), round(float(y), 4)] for x, y in quad]
+    result["timings"] = timer.as_dict()
+    return result
+
+
+def _to_bgr(img):
+    import cv2
+    # PaddleOCR expects 3-channel input; the cleaned image is single-channel
+    return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR) if img.ndim == 2 else img
+
+
+def _ocr_undecodable(data, ocr, src_path):
+    """Formats cv2 cannot decode (e.g. PDF) go to PaddleOCR as a file, like before."""
+    if src_path:
+        return ocr.ocr(src_path)
+    import tempfile
+    fd, tmp = tempfile.mkstemp(prefix="_work_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return ocr.ocr(tmp)
+    finally:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+# ---------- tiled OCR ----------
+# Tall receipts are read in overlapping strips instead of one pass that the
+# detector would shrink to DET_LIMIT_SIDE_LEN on the long side.
+TILE_MIN_HEIGHT = 2 * DET_LIMIT_SIDE_LEN   # working-image height that switches tiling on
+TILE_MIN_ASPECT = 2.0                      # ... for images at least this tall for their width
+TILE_HEIGHT = DET_LIMIT_SIDE_LEN
+# must exceed twice the tallest text line so a line cut by one strip's edge is whole in the next
+TILE_OVERLAP = 160
+
+_tile_engines = {}     # profile tag -> queue of extra engines for the strip threads, built on first use
+_tile_engines_lock = threading.Lock()
+
+
+def _tile_workers():
+    env = os.environ.get("SMARTSPEND_OCR_TILE_WORKERS")
+    if env:
+        return max(1, int(env))
+    return max(1, min(4, (os.cpu_count() or 1) // 2))
+
+
+def _tile_spans(h):
+    """[(top, bottom, own_top, own_bottom)] strips covering 0..h; each line belongs to one strip."""
+    step = TILE_HEIGHT - TILE_OVERLAP
+    n = max(1, -(-(h - TILE_OVERLAP) // step))
+    spans = []
+    for i in range(n):
+        top = i * step
+        bottom = h if i == n - 1 else top + TILE_HEIGHT
+        # ownership splits each overlap in half
+        own_top = 0 if i == 0 else top + TILE_OVERLAP // 2
+        own_bottom = h if i == n - 1 else bottom - TILE_OVERLAP // 2
+        spans.append((top, bottom, own_top, own_bottom))
+    return spans
+
+
+def _should_tile(img):
+    if os.environ.get("SMARTSPEND_OCR_TILES", "1") == "0":
+        return False
+    h, w = img.shape[:2]
+    return h >= TILE_MIN_HEIGHT and h >= TILE_MIN_ASPECT * w
+
+
+def _checkout_engines(ocr, n):
+    """The caller's engine plus up to n - 1 extra engines of its profile (one per strip thread), as a queue.
+
+    Extras are built with the caller's profile so every strip reads with the
+    same models and settings; an engine not built by create_ocr has no
+    profile to copy and reads its strips alone.
+    """
+    pool = queue.Queue()
+    pool.put(ocr)
+    tag = getattr(ocr, "smartspend_profile", None)
+    if tag is None:
+        return pool
+    with _tile_engines_lock:
+        spare = _tile_engines.setdefault(tag, queue.Queue())
+        while spare.qsize() < n - 1:
+            print(f"DEBUG: loading extra {tag[0]} OCR engine for strips", file=sys.stderr, flush=True)
+            try:
+                extra = create_ocr(tag[0])
+            except Exception as e:
+                # fewer threads, same result
+                print(f"DEBUG: extra OCR engine failed: {e}", file=sys.stderr, flush=True)
+                break
+            if getattr(extra, "smartspend_profile", None) != tag:
+                # the profile was edited since the caller's engine was built
+                print("DEBUG: profile changed; strips share one engine", file=sys.stderr, flush=True)
+                break
+            spare.put(extra)
+        for _ in range(min(n - 1, spare.qsize())):
+            pool.put(spare.get())
+    return pool
+
+
+def _return_engines(pool, ocr):
+    while not pool.empty():
+        eng = pool.get()
+        if eng is not ocr:
+            _tile_engines[eng.smartspend_profile].put(eng)
+
+
+def ocr_tiled(ocr, img, timer=NULL_TIMER):
+    """OCR a tall image strip by strip; returns a PaddleOCR 2.x shaped result in page coordinates.
+
+    Strips run concurrently, each on its own engine (PaddleOCR instances are
+    not safe to share between threads). A box is kept only by the strip that
+    owns its centre, which drops the duplicates read in the overlaps.
+    """
+    spans = _tile_spans(img.shape[0])
+    strips, workers = _ocr_spans(ocr, img, spans, _tile_workers())
+    timer.note("tiles", [len(spans), workers])
+    return [[line for strip in strips for line in strip]]
+
+
+def _ocr_spans(ocr, img, spans, max_workers):
+    """OCR (top, bottom, own_top, own_bottom) strips of img; ([kept lines per strip], threads used)."""
+    from concurrent.futures import ThreadPoolExecutor
+    pool = _checkout_engines(ocr, min(max_workers, len(spans)))
+    workers = pool.qsize()
+
+    def run(span):
+        top, bottom, own_top, own_bottom = span
+        eng = pool.get()
+        try:
+            res = eng.ocr(_to_bgr(img[top:bottom]))
+        finally:
+            pool.put(eng)
+        kept = []
+        for t, sc, (x0, y0, x1, y1) in _flatten_boxes(res):
+            y0, y1 = y0 + top, y1 + top
+            if own_top <= (y0 + y1) / 2.0 < own_bottom:
+                kept.append([[[x0, y0], [x1, y0], [x1, y1], [x0, y1]], (t, sc)])
+        return kept
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            strips = list(ex.map(run, spans))
+    finally:
+        _return_engines(pool, ocr)
+    return strips, workers
+
+
+# ---------- progressive extraction ----------
+# The merchant sits in the header and the total/date near the bottom, so in
+# progressive mode those bands are read first and reported before the middle
+# (the line items) is read. The strips share TILE_OVERLAP ownership rules, so
+# the stitched page is the same set of lines a single pass would give.
+PROGRESSIVE_BAND = 0.25   # of the working-image height, at the top and at the bottom
+
+
+def _band_spans(h, tile=False):
+    """(header/footer spans, middle spans) covering 0..h; the middle is empty on short images."""
+    half = TILE_OVERLAP // 2
+    band = min(int(h * PROGRESSIVE_BAND), TILE_HEIGHT - half)
+    if h - 2 * band < TILE_OVERLAP:
+        return [(0, h, 0, h)], []
+    bands = [(0, band + half, 0, band), (h - band - half, h, h - band, h)]
+    top, bottom = band - half, h - band + half
+    if tile:
+        middle = [[t + top, b + top, o0 + top, o1 + top] for t, b, o0, o1 in _tile_spans(bottom - top)]
+    else:
+        middle = [[top, bottom, top, bottom]]
+    # the overlap with each band is owned by the band
+    middle[0][2], middle[-1][3] = band, h - band
+    return bands, [tuple(s) for s in middle]
+
+
+def ocr_progressive(ocr, img, on_bands, timer=NULL_TIMER):
+    """OCR the header and footer bands, call on_bands(header_lines, footer_lines), then the rest.
+
+    Returns the whole page like ocr_tiled. The bands run on the caller's
+    engine so the first fields never wait for extra strip engines to load.
+    """
+    bands, middle = _band_spans(img.shape[0], _should_tile(img))
+    with timer.stage("ocr.bands"):
+        strips, _ = _ocr_spans(ocr, img, bands, 1)
+    header, footer = (strips[0], strips[1]) if len(strips) == 2 else (strips[0], [])
+    try:
+        on_bands(_result_lines(header), _result_lines(footer))
+    except Exception as e:
+        print(f"DEBUG: partial result failed: {e}", file=sys.stderr, flush=True)
+    rest = []
+    if middle:
+        with timer.stage("ocr.middle"):
+            rest, workers = _ocr_spans(ocr, img, middle, _tile_workers())
+        timer.note("tiles", [len(bands) + len(middle), workers])
+    return [header + [line for strip in rest for line in strip] + footer]
+
+
+# ---------- merchant layout templates ----------
+# A merchant with a learned layout (receipt_templates.py) has its receipts
+# read header first: once the header names the merchant, OCR stops a little
+# below where its total and date rows sit, and the rows above the total row
+# are parsed as items directly. A receipt that does not fit the layout
+# (including a missing date when the layout had one) is read and parsed
+# again the generic way, and counts against the layout. The header pass is
+# only tried once the store holds a usable layout; receipts from other shops
+# then cost one extra engine call on the header band and TILE_OVERLAP pixels
+# read twice, and are read to the bottom as before.
+TEMPLATE_TAIL_MARGIN = 0.05    # page widths read below the learned last useful row
+TEMPLATE_AMOUNT_SLACK = 0.05   # of the page width, around the learned total column edge
+
+
+def _row_money(row):
+    if row.amount is not None:
+        return row.amount
+    found = MONEY_TIGHT.findall(row.text)
+    return found[-1] if found else None
+
+
+def layout_sample(parsed, rows, page_size):
+    """What a cleanly parsed receipt says about its merchant's layout, or None.
+
+    Only dictionary merchants teach a layout, and only when the template
+    parser would have read this very receipt the same way from it.
+    """
+    if not (parsed.get("merchant_score") and parsed.get("amount") and rows and page_size):
+        return None
+    try:
+        amount = float(parsed["amount"])
+    except ValueError:
+        return None
+    w, h = page_size
+    for row in reversed(rows):
+        m = TOTAL_ALIASES.search(row.text)
+        money = _row_money(row) if m else None
+        try:
+            if money and abs(_norm_money(money) - amount) <= 0.01:
+                break
+        except ValueError:
+            continue
+    else:
+        return None
+    bottom = row.y1
+    if parsed.get("date"):
+        # a row alone lacks the rest of the receipt's locale hints; read it the receipt's way
+        dmy = bool(CURRENCY_WORD.search(parsed.get("raw_text") or ""))
+        date_rows = [r for r in rows if _parse_date(r.text, dmy=dmy) == parsed["date"]]
+        if not date_rows:
+            return None  # a date split over rows could end up below a learned cut
+        bottom = max(bottom, date_rows[0].y1)
+    sample = {
+        "anchor": " ".join(m.group(1).lower().split()),
+        "tail": round((h - bottom) / w, 4),
+        "amount_x": round(row.cells[-1][1] / w, 4),
+        "dated": bool(parsed.get("date")),
+    }
+    found = _template_total_items(rows, dict(sample, amount_x=[sample["amount_x"]] * 2), w,
+                                  parsed["merchant"])
+    if found is None or abs(found[0] - amount) > 0.01 or len(found[1]) != len(parsed.get("items") or []):
+        return None
+    return sample
+
+
+def template_cut(layout, w, h):
+    """Page y below which a receipt with this layout has nothing we parse, or None to read it all.
+
+    Only the bottom is trimmed, measured up from the page bottom in page
+    widths: a layout records no header height or left/right margins. Pages
+    are usually cropped to the receipt (locate_receipt); leftover margin
+    below it only moves the cut down (more is read), while a receipt cut
+    off at the bottom, or a page widened by side margins, can move it above
+    the total row, and then parse_with_template fails and the page is read
+    again in full.
+    """
+    cut = h - (layout["tail"] - TEMPLATE_TAIL_MARGIN) * w
+    return int(cut) if cut < h else None
+
+
+def _template_total_items(rows, layout, w, merchant):
+    """(total, items) by the layout, or None: the amount on the last row with its keyword and
+    amount column, and the items above that row, which must add up to it."""
+    lo, hi = layout["amount_x"]
+    keyword = re.compile(r"(?<!sub)\b" + r"\s*".join(map(re.escape, layout["anchor"].split())) + r"\b", re.I)
+    for i in range(len(rows) - 1, -1, -1):
+        row = rows[i]
+        money = _row_money(row)
+        if money and keyword.search(row.text) and \
+                lo - TEMPLATE_AMOUNT_SLACK <= row.cells[-1][1] / w <= hi + TEMPLATE_AMOUNT_SLACK:
+            break
+    else:
+        return None
+    try:
+        amount = _norm_money(money)
+    except ValueError:
+        return None
+    if not _is_plausible_money(amount):
+        return None
+    items = parse_row_items(rows[:i], get_categorizer(), amount, merchant)
+    try:
+        if not items or abs(sum(float(it["total"]) for it in items) - amount) > 0.01:
+            return None
+    except (TypeError, ValueError):
+        return None
+    return amount, items
+
+
+def parse_with_template(lines, rows, layout, merchant, match, page_size):
+    """parse_fields for a merchant with a learned layout, or None when the receipt does not fit it."""
+    if not rows or not page_size:
+        return None
+    found = _template_total_items(rows, layout, page_size[0], merchant)
+    if found is None:
+        return None
+    amount, items = found
+    joined = "\n".join(lines)
+    date = _parse_date(joined)
+    if not date and layout.get("dated", True):
+        return None  # the date row was below the cut, or misread: the layout no longer holds
+    _apply_category_hint(items, merchant, match)
+    return {
+        "merchant": merchant,
+        "merchant_score": match["score"],
+        "amount": f"{amount:.2f}",
+        "date": date,
+        "items": items,
+        "raw_text": joined,
+    }
+
+
+def ocr_header_first(ocr, img, on_header, timer=NULL_TIMER):
+    """OCR the header band, ask on_header(header_lines, w, h) where to stop, then read down to there.
+
+    Returns the page read so far like ocr_tiled; everything is read when
+    on_header returns None. Short images are read in one pass without asking.
+    """
+    h, w = img.shape[:2]
+    bands, middle = _band_spans(h)
+    if not middle:
+        return ocr.ocr(_to_bgr(img))
+    band = bands[0][3]
+    with timer.stage("ocr.header"):
+        (header,), _ = _ocr_spans(ocr, img, [bands[0]], 1)
+    try:
+        cut = on_header(_result_lines([header]), w, h)
+    except Exception as e:
+        print(f"DEBUG: template lookup failed: {e}", file=sys.stderr, flush=True)
+        cut = None
+    bottom = h if cut is None else max(band, min(h, cut))
+    timer.note("template_cut", round(1.0 - bottom / h, 3) if cut is not None else None)
+    rest = []
+    if bottom > band:
+        half = TILE_OVERLAP // 2
+        with timer.stage("ocr.rest"):
+            (rest,), _ = _ocr_spans(ocr, img, [(band - half, min(h, bottom + half), band, bottom)], 1)
+    return [header + rest]
+
+
+# ---------- adaptive fallback ----------
+# A first pass with fewer boxes than this is retried on the original image
+MIN_LINES = 3
+# Lines the recognizer scored below this are re-read from a grayscale crop
+LOW_CONFIDENCE = 0.80
+MAX_CROPS = 8
+CROP_PAD = 0.35           # of the box height, around each crop
+CROP_OVERHEAD_MS = 40.0   # fixed cost per crop pass on top of its area share
+# Per-request OCR budget; fallbacks that would not fit are skipped
+OCR_BUDGET_MS = 15000.0
+
+
+class Deadline:
+    def __init__(self, budget_ms=None):
+        if budget_ms is None:
+            budget_ms = float(os.environ.get("SMARTSPEND_OCR_BUDGET_MS") or OCR_BUDGET_MS)
+        self.end = time.perf_counter() + budget_ms / 1000.0
+
+    def remaining_ms(self):
+        return (self.end - time.perf_counter()) * 1000.0
+
+    def allows(self, est_ms):
+        return self.remaining_ms() > est_ms
+
+
+def _plan_fallback(boxes, first_ms, page_area, deadline):
+    """Decide what, if anything, to re-OCR after the first pass.
+
+    Returns ("none" | "full" | "crops" | "skipped", low-confidence boxes).
+    """
+    if len(boxes) < MIN_LINES:
+        return ("full" if deadline.allows(first_ms) else "skipped"), []
+    low = sorted((b for b in boxes if b[1] < LOW_CONFIDENCE), key=lambda b: b[1])[:MAX_CROPS]
+    if not low:
+        return "none", []
+    area = sum((b[2][2] - b[2][0]) * (b[2][3] - b[2][1]) * (1 + 2 * CROP_PAD) ** 2 for b in low)
+    est = CROP_OVERHEAD_MS * len(low) + first_ms * min(1.0, area / max(1.0, page_area))
+    return ("crops" if deadline.allows(est) else "skipped"), low
+
+
+def _reread_crops(ocr, gray, low):
+    """Re-OCR low-confidence boxes from the unbinarized image; return {old box: [new boxes]}."""
+    h, w = gray.shape[:2]
+    better = {}
+    for box in low:
+        text, score, (x0, y0, x1, y1) = box
+        pad = CROP_PAD * max(1.0, y1 - y0)
+        cx0, cy0 = max(0, int(x0 - pad)), max(0, int(y0 - pad))
+        cx1, cy1 = min(w, int(x1 + pad) + 1), min(h, int(y1 + pad) + 1)
+        if cx1 - cx0 < 8 or cy1 - cy0 < 8:
+            continue
+        try:
+            res = ocr.ocr(_to_bgr(gray[cy0:cy1, cx0:cx1]))
+        except Exception as e:
+            print(f"DEBUG: crop re-OCR failed: {e}", file=sys.stderr, flush=True)
+            continue
+        found = []
+        for t, sc, (bx0, by0, bx1, by1) in _flatten_boxes(res):
+            nb = (bx0 + cx0, by0 + cy0, bx1 + cx0, by1 + cy0)
+            # the padding may catch neighbouring lines; keep what sits in the old box
+            cy = (nb[1] + nb[3]) / 2.0
+            if y0 <= cy <= y1:
+                found.append((t, sc, nb))
+        if found and sum(b[1] for b in found) / len(found) > score:
+            better[box] = sorted(found, key=lambda b: b[2][0])
+    return better
+
+
+def ocr_lines(data, ocr, src_path=None, dump_path=None, timer=NULL_TIMER, deadline=None, on_bands=None,
+              on_header=None):
+    """Decode once, preprocess in memory, OCR and return (text lines, layout rows).
+
+    After the first pass, _plan_fallback uses its box count and recognizer
+    scores to pick at most one follow-up within the deadline: a full pass on
+    the original when almost nothing was found, or re-reading only the
+    low-confidence boxes from grayscale crops.
+
+    With on_bands the first pass is ocr_progressive, which hands over the
+    header and footer lines before reading the middle of the receipt; with
+    on_header it is ocr_header_first, which may stop above the bottom.
+    """
+    deadline = deadline or Deadline()
+    with timer.stage("import.cv2"):
+        import cv2  # noqa: F401  (first use pays the import; keep it out of "decode")
+    with timer.stage("decode"):
+        img = decode_image(data)
+    if img is None:
+        print("DEBUG: cv2 could not decode image; OCR on original", file=sys.stderr, flush=True)
+        try:
+            with timer.stage("ocr"):
+                res = _ocr_undecodable(data, ocr, src_path)
+        except Exception as e:
+            raise OCRError(str(e)) from e
+        with timer.stage("flatten"):
+            lines = _drop_path_lines(_result_lines(res))
+            boxes = _flatten_boxes(res)
+        with timer.stage("layout"):
+            rows = group_rows(boxes)
+        return lines, rows
+    timer.note("image_size", [int(img.shape[1]), int(img.shape[0])])
+    with timer.stage("locate"):
+        quad = locate_receipt(img)
+    timer.note("located", quad is not None)
+    return _ocr_region(data, img, quad, ocr, dump_path, timer, deadline, on_bands, on_header)
+
+
+def _ocr_region(data, img, quad, ocr, dump_path=None, timer=NULL_TIMER, deadline=None, on_bands=None,
+                on_header=None, tile=True):
+    """ocr_lines from the decoded photo on: the receipt inside quad (None: all of img).
+
+    tile=False keeps tall receipts to one pass on ocr, for callers that
+    already hold the strip engines (extract_many).
+    """
+    deadline = deadline or Deadline()
+    if quad is not None and _coarser_than(img, data, quad):
+        # the receipt is a small part of the photo: decode again with the pixels it needs
+        with timer.stage("decode.region"):
+            img = decode_image(data, quad)
+
+    print("DEBUG: preprocessing", file=sys.stderr, flush=True)
+    with timer.stage("preprocess"):
+        clean, gray = preprocess_image(img, dump_path, timer=timer, return_gray=True, quad=quad)
+    print(f"DEBUG: clean image {clean.shape[1]}x{clean.shape[0]}", file=sys.stderr, flush=True)
+    timer.note("page_size", [int(clean.shape[1]), int(clean.shape[0])])
+
+    print("DEBUG: calling OCR", file=sys.stderr, flush=True)
+    t0 = time.perf_counter()
+    try:
+        print("DEBUG: ocr(clean)...", file=sys.stderr, flush=True)
+        with timer.stage("ocr"):
+            if on_bands is not None:
+                res = ocr_progressive(ocr, clean, on_bands, timer)
+            elif on_header is not None and not _should_tile(clean):
+                res = ocr_header_first(ocr, clean, on_header, timer)
+            elif tile and _should_tile(clean):
+                res = ocr_tiled(ocr, clean, timer)
+            else:
+                res = ocr.ocr(_to_bgr(clean))
+        print("DEBUG: ocr(clean) ok", file=sys.stderr, flush=True)
+    except Exception as e1:
+        print(f"DEBUG: ocr(clean) failed: {e1}", file=sys.stderr, flush=True)
+        # a pass on the original costs about what the failed one did
+        if not deadline.allows((time.perf_counter() - t0) * 1000.0):
+            timer.note("fallback", "skipped")
+            raise OCRError(str(e1)) from e1
+        try:
+            print("DEBUG: ocr(original)...", file=sys.stderr, flush=True)
+            with timer.stage("ocr_fallback"):
+                res = ocr.ocr(_unprocessed(img, quad))
+            print("DEBUG: ocr(original) ok", file=sys.stderr, flush=True)
+        except Exception as e2:
+            print(f"DEBUG: ocr(original) failed: {e2}", file=sys.stderr, flush=True)
+            raise OCRError(str(e2)) from e2
+        timer.note("fallback", "full")
+        with timer.stage("flatten"):
+            lines = _result_lines(res)
+            boxes = _flatten_boxes(res)
+        with timer.stage("layout"):
+            rows = group_rows(boxes)
+        return _drop_path_lines(lines), rows
+    first_ms = (time.perf_counter() - t0) * 1000.0
+
+    print(f"DEBUG: OCR done; type={type(res)}", file=sys.stderr, flush=True)
+
+    with timer.stage("flatten"):
+        lines = _result_lines(res)
+        boxes = _flatten_boxes(res)
+    # boxes carry the scores; engines without geometry fall back to the line count
+    plan, low = _plan_fallback(boxes or [("", 1.0, (0, 0, 0, 0))] * len(lines),
+                               first_ms, clean.shape[0] * clean.shape[1], deadline)
+    print(f"DEBUG: fallback plan={plan} boxes={len(boxes)} low={len(low)}", file=sys.stderr, flush=True)
+    timer.note("fallback", plan if plan != "crops" else f"crops:{len(low)}")
+    if plan == "full":
+        # preprocessing may have hurt recognition: try the original image
+        try:
+            with timer.stage("ocr_fallback"):
+                res2 = ocr.ocr(_unprocessed(img, quad))  # original, no preprocessing
+            with timer.stage("flatten"):
+                lines2 = _flatten_text(res2)
+            if len(lines2) > len(lines):
+                lines = lines2
+                boxes = _flatten_boxes(res2)
+        except Exception:
+            pass
+    elif plan == "crops":
+        with timer.stage("ocr_crops"):
+            better = _reread_crops(ocr, gray, low)
+        if better:
+            lines, boxes = _apply_crops(lines, boxes, better)
+        timer.note("crops_improved", len(better))
+
+    with timer.stage("layout"):
+        rows = group_rows(boxes)
+    return _drop_path_lines(lines), rows
+
+
+def _apply_crops(lines, boxes, better):
+    """(lines, boxes) with the re-read boxes from _reread_crops swapped in, box by box."""
+    texts = [" ".join(nb[0] for nb in better[b]) if b in better else b[0] for b in boxes]
+    if _dedup_lines([b[0] for b in boxes]) == lines:
+        # the lines are the box texts: rebuild them from the boxes, so a text printed
+        # twice is only replaced where its box was re-read
+        lines = _dedup_lines(texts)
+    else:
+        # lines the boxes do not account for: only swap texts that name one box
+        seen = {}
+        for b in boxes:
+            seen[b[0]] = seen.get(b[0], 0) + 1
+        subst = {old[0]: " ".join(b[0] for b in new) for old, new in better.items() if seen[old[0]] == 1}
+        lines = [subst.get(ln, ln) for ln in lines]
+    return lines, [nb for b in boxes for nb in better.get(b, [b])]
+
+
+def _unprocessed(img, quad):
+    """The receipt without preprocessing for the fallback passes: the warped quad, else all of img.
+
+    Never the whole photo when quad is set; in extract_many it shows the other receipts too.
+    """
+    return warp_receipt(img, quad) if quad is not None else img
+
+
+def _result_lines(res):
+    # Normalize result shape before flattening
+    if isinstance(res, list) and len(res) == 1 and isinstance(res[0], (list, tuple)):
+        res = res[0]
+    return _flatten_text(res)
+
+
+def _drop_path_lines(lines):
+    return [ln for ln in lines if not re.search(r"^[A-Za-z]:\\\\|^/+", ln)]
+
+
+# ---------- text-only reparse ----------
+# keys copied from an input record to its output so callers can match them up
+REPARSE_TAGS = ("id", "expense_id", "path")
+
+
+def reparse_record(rec):
+    """parse_fields over stored text: rec is raw_text, a list of lines, or a dict holding either."""
+    out = {}
+    if isinstance(rec, dict):
+        for k in REPARSE_TAGS:
+            if k in rec:
+                out[k] = rec[k]
+        lines = rec.get("lines")
+        if lines is None:
+            lines = (rec.get("raw_text") or "").splitlines()
+    elif isinstance(rec, str):
+        lines = rec.splitlines()
+    else:
+        lines = list(rec or [])
+    out.update(empty_result())
+    try:
+        lines = [str(ln).strip() for ln in lines if str(ln).strip()]
+        out.update(parse_fields(lines))
+    except Exception as e:
+        out["error"] = f"{type(e).__name__}: {e}"
+    return out
+
+
+def reparse(records):
+    """Yield one parsed result per stored record (no OCR, no image imports)."""
+    for rec in records:
+        yield reparse_record(rec)
+
+
+def _read_jsonl(f):
+    for ln in f:
+        ln = ln.strip()
+        if not ln:
+            continue
+        try:
+            yield json.loads(ln)
+        except ValueError as e:
+            yield {"bad_input": True, "error": f"invalid_json: {e}"}
+
+
+def _reparse_main(path):
+    f = sys.stdin if path in (None, "-") else open(path, encoding="utf-8")
+    try:
+        for rec in _read_jsonl(f):
+            if isinstance(rec, dict) and rec.get("bad_input"):
+                out = empty_result()
+                out["error"] = rec["error"]
+            else:
+                out = reparse_record(rec)
+            sys.stdout.write(json.dumps(out, ensure_ascii=False) + "\n")
+            sys.stdout.flush()
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+# ---------- startup self-check ----------
+# Import cost of the CLI before any OCR work (ms, cumulative -X importtime)
+IMPORT_BUDGET_MS = 150.0
+# Must never be imported by `import extract_receipt` itself
+HEAVY_MODULES = ("numpy", "cv2", "paddleocr", "paddle")
+SELF_CHECK_STAGES = [
+    ("cli", "import extract_receipt"),
+    ("numpy", "import numpy"),
+    ("cv2", "import cv2"),
+    ("paddleocr", "import paddleocr"),
+]
+
+
+def _importtime(stmt):
+    """Cold-import stmt in a fresh interpreter; return (wall ms, [(cumulative us, top-level module)], all names)."""
+    import subprocess, time
+    t = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", stmt],
+                          cwd=os.path.dirname(os.path.abspath(__file__)),
+                          capture_output=True, text=True)
+    wall = (time.perf_counter() - t) * 1000.0
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "import failed")
+    top, names = [], set()
+    for ln in proc.stderr.splitlines():
+        if not ln.startswith("import time:") or "|" not in ln:
+            continue
+        parts = ln.split("|")
+        try:
+            cum = int(parts[1])
+        except ValueError:
+            continue  # header line
+        name = parts[2].rstrip()
+        names.add(name.strip())
+        if not name.startswith("  "):  # one space after "|" means top level
+            top.append((cum, name.strip()))
+    return wall, top, names
+
+
+def self_check():
+    """Print a startup timing report; return False when the CLI import is over budget or pulls in heavy modules."""
+    budget = float(os.environ.get("SMARTSPEND_IMPORT_BUDGET_MS") or IMPORT_BUDGET_MS)
+    report, ok = {"python": sys.version.split()[0], "budget_ms": budget, "stages": {}}, True
+    for stage, stmt in SELF_CHECK_STAGES:
+        try:
+            wall, top, names = _importtime(stmt)
+        except Exception as e:
+            report["stages"][stage] = {"error": str(e)}
+            continue
+        top.sort(reverse=True)
+        entry = {
+            "wall_ms": round(wall, 1),
+            "import_ms": round(sum(c for c, _ in top) / 1000.0, 1),
+            "slowest": [[name, round(c / 1000.0, 1)] for c, name in top[:5]],
+        }
+        if stage == "cli":
+            heavy = sorted(m for m in HEAVY_MODULES if m in names)
+            entry["heavy_imports"] = heavy
+            entry["within_budget"] = entry["import_ms"] <= budget and not heavy
+            ok = entry["within_budget"]
+        report["stages"][stage] = entry
+    print(json.dumps(report, ensure_ascii=False, indent=1))
+    return ok
+
+
+def _storage_json(src):
+    """compact_receipt for the CLI: base64 payloads, or None to keep the upload as is."""
+    import base64
+    try:
+        comp = compact_receipt(read_source(src))
+    except Exception as e:
+        print(f"DEBUG: compaction failed: {e}", file=sys.stderr, flush=True)
+        return None
+    if comp is None:
+        return None
+    print(f"DEBUG: storage rendition {comp['original_bytes']} -> {comp['stored_bytes']} bytes",
+          file=sys.stderr, flush=True)
+    comp["image_b64"] = base64.b64encode(comp.pop("image")).decode("ascii")
+    return comp
+
+
+def _write_last_output(out):
+    # write-then-rename so concurrent uploads never leave a half-written file
+    path = os.path.join(os.path.dirname(__file__), "ocr_last_output.txt")
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(out + "\n")
+        os.replace(tmp, path)
+    except:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Extract merchant/amount/date/items from a receipt image.")
+    ap.add_argument("image", nargs="?", help="receipt image path, or - to read image bytes from stdin")
+    ap.add_argument("--serve", action="store_true", help="run the warm OCR daemon instead of a single extraction")
+    ap.add_argument("--host", default=None, help="daemon host (default SMARTSPEND_OCR_HOST or 127.0.0.1)")
+    ap.add_argument("--port", type=int, default=None, help="daemon port (default SMARTSPEND_OCR_PORT or 8765)")
+    ap.add_argument("--no-daemon", action="store_true", help="always run OCR in-process")
+    ap.add_argument("--reparse", nargs="?", const="-", metavar="JSONL",
+                    help="re-run parse_fields over stored raw_text/lines records (file or stdin), no OCR")
+    ap.add_argument("--profile", metavar="PSTATS", default=None,
+                    help="debug: run in-process under cProfile and dump stats to this file")
+    ap.add_argument("--dump-clean", metavar="PNG", default=None,
+                    help="debug: also write the preprocessed image to this path")
+    ap.add_argument("--scope", default="",
+                    help="owner of the receipt (e.g. user id); duplicates are only looked up within a scope, "
+                         "and not at all without one")
+    ap.add_argument("--compact", action="store_true",
+                    help="also return a size-bounded storage rendition (base64) under \"storage\"")
+    ap.add_argument("--progressive", action="store_true",
+                    help="print a {\"partial\": true} merchant/amount/date line as soon as the header and "
+                         "footer are read, then the full result line")
+    ap.add_argument("--multi", action="store_true",
+                    help="the photo may show several receipts: print {\"receipts\": [...]} with one result "
+                         "and crop box per receipt")
+    ap.add_argument("--self-check", action="store_true",
+                    help="report cold import times per stage and exit non-zero if the CLI import is over budget")
+    args = ap.parse_args()
+
+    if args.self_check:
+        sys.exit(0 if self_check() else 1)
+
+    if args.reparse:
+        _reparse_main(args.reparse)
+        return
+
+    if args.serve:
+        import ocr_daemon
+        ocr_daemon.serve(args.host, args.port)
+        return
+
+    result = empty_result()
+    src = None
+    try:
+        print("DEBUG: start", file=sys.stderr, flush=True)
+
+        if not args.image:
+            print(json.dumps(result, ensure_ascii=False))
+            return
+
+        if args.image == "-":
+            src = sys.stdin.buffer.read()
+            if not src:
+                result["error"] = "file_missing_or_empty"
+                print(json.dumps(result, ensure_ascii=False))
+                return
+        else:
+            src = args.image
+            if not (os.path.isfile(src) and os.path.getsize(src) > 0):
+                result["error"] = "file_missing_or_empty"
+                print(json.dumps(result, ensure_ascii=False))
+                return
+            src = os.path.abspath(src)
+
+        on_partial = None
+        if args.progressive and not args.multi:
+            def on_partial(rec):
+                print(json.dumps(rec, ensure_ascii=False), flush=True)
+
+        def run_here():
+            if args.multi:
+                return extract_many(src, create_ocr(), dump_path=args.dump_clean, scope=args.scope)
+            return extract(src, create_ocr(), dump_path=args.dump_clean, scope=args.scope,
+                           on_partial=on_partial)
+
+        # Prefer a warm daemon; run in-process only when none is listening
+        remote = None
+        if args.profile:
+            import cProfile
+            prof = cProfile.Profile()
+            result = prof.runcall(run_here)
+            prof.dump_stats(args.profile)
+            print(f"DEBUG: profile written to {args.profile}", file=sys.stderr, flush=True)
+        elif not args.no_daemon and not args.dump_clean:
+            # the daemon never writes files for a client, so --dump-clean always runs here
+            import ocr_daemon
+            remote = ocr_daemon.request_extract(src, args.host, args.port, scope=args.scope,
+                                                on_partial=on_partial, multi=args.multi)
+        if remote is not None:
+            print("DEBUG: served by daemon", file=sys.stderr, flush=True)
+            result = remote
+        elif not args.profile:
+            result = run_here()
+
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+
+    # the stored copy does not depend on OCR having worked
+    if args.compact and src is not None:
+        result["storage"] = _storage_json(src)
+
+    # ALWAYS print and log
+    out = json.dumps(result, ensure_ascii=False)
+    print(out)
+    _write_last_output(out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""Learned item categorizer: hashed n-gram features + a linear (softmax) model.
+
+    python learned_categorizer.py train expenses.csv [--out DIR]   # offline, from exported history
+    python learned_categorizer.py predict "Nasi Lemak Ayam" "Panadol 10s"
+
+The training file is an export of the expenses table with `note` and
+`category` columns (CSV with a header row, or JSON lines). Notes saved from
+a receipt look like "Merchant — item"; only the item part is used, since
+that is what the categorizer sees at prediction time.
+
+Features are signed hashes of word unigrams/bigrams and character 3-5
+grams into 2**bits columns, stored as CSR arrays (indptr, indices, data).
+A whole receipt is scored with one sparse x dense product against the
+weight matrix, which is memory-mapped from weights.npy so loading the
+model costs almost nothing until rows are touched. ReceiptCategorizer uses
+the model when it is confident and its regex rules otherwise.
+"""
+import os, sys, re, csv, json, zlib, argparse
+import numpy as np
+
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "category_model")
+DEFAULT_BITS = 18
+DEFAULT_MIN_CONFIDENCE = 0.6
+MODEL_VERSION = 1
+
+_WORD = re.compile(r"\w+")
+
+
+# ---------- features ----------
+def _features(text):
+    words = _WORD.findall(text.lower())
+    feats = ["w:" + w for w in words]
+    feats += ["b:%s %s" % pair for pair in zip(words, words[1:])]
+    for w in words:
+        padded = f" {w} "
+        for n in (3, 4, 5):
+            feats += ["c:" + padded[i:i + n] for i in range(len(padded) - n + 1)]
+    return feats
+
+
+def featurize(texts, bits=DEFAULT_BITS):
+    """CSR arrays (indptr, indices, data) of L2-normalized signed hashed features."""
+    mask = (1 << bits) - 1
+    indptr, indices, data = [0], [], []
+    for text in texts:
+        row = {}
+        for f in _features(text):
+            h = zlib.crc32(f.encode("utf-8"))
+            j = h & mask
+            row[j] = row.get(j, 0.0) + (1.0 if h & 0x80000000 else -1.0)
+        indices.extend(row.keys())
+        data.extend(row.values())
+        indptr.append(len(indices))
+    indptr = np.asarray(indptr, dtype=np.int64)
+    indices = np.asarray(indices, dtype=np.int64)
+    data = np.asarray(data, dtype=np.float32)
+    # L2-normalize each row so long descriptions do not dominate; bincount, unlike
+    # reduceat over indptr, copes with rows without features (anywhere, even last)
+    lengths = np.diff(indptr)
+    rows = np.repeat(np.arange(len(texts)), lengths)
+    sq = np.bincount(rows, weights=data * data, minlength=len(texts))
+    norms = np.ones(len(texts), dtype=np.float32)
+    nz = lengths > 0
+    norms[nz] = np.sqrt(sq[nz])
+    data /= norms[rows]
+    return indptr, indices, data
+
+
+def sparse_dot(indptr, indices, data, weights):
+    """(n x D CSR) @ (D x C dense) -> n x C, touching only the referenced weight rows."""
+    n = len(indptr) - 1
+    out = np.zeros((n, weights.shape[1]), dtype=np.float32)
+    if len(indices) == 0:
+        return out
+    contrib = np.asarray(weights[indices], dtype=np.float32) * data[:, None]
+    nz = np.flatnonzero(np.diff(indptr))
+    out[nz] = np.add.reduceat(contrib, indptr[nz], axis=0)
+    return out
+
+
+def _softmax(z):
+    z = z - z.max(axis=1, keepdims=True)
+    np.exp(z, out=z)
+    z /= z.sum(axis=1, keepdims=True)
+    return z
+
+
+# ---------- model ----------
+class CategoryModel:
+    def __init__(self, weights, bias, labels, bits, min_confidence=DEFAULT_MIN_CONFIDENCE):
+        self.weights = weights
+        self.bias = bias
+        self.labels = list(labels)
+        self.bits = bits
+        self.min_confidence = min_confidence
+
+    def predict_proba(self, texts):
+        indptr, indices, data = featurize(texts, self.bits)
+        return _softmax(sparse_dot(indptr, indices, data, self.weights) + self.bias)
+
+    def predict(self, texts):
+        """Label per text, or None where the model is unsure (or only says "Other")."""
+        if not texts:
+            return []
+        proba = self.predict_proba(texts)
+        best = proba.argmax(axis=1)
+        out = []
+        for j, p in zip(best, proba[np.arange(len(texts)), best]):
+            label = self.labels[j]
+            out.append(label if p >= self.min_confidence and label != "Other" else None)
+        return out
+
+    def save(self, path, **meta):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "weights.npy"), np.asarray(self.weights, dtype=np.float32))
+        np.save(os.path.join(path, "bias.npy"), np.asarray(self.bias, dtype=np.float32))
+        meta = dict(meta, version=MODEL_VERSION, labels=self.labels, bits=self.bits,
+                    min_confidence=self.min_confidence)
+        with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != MODEL_VERSION:
+            raise ValueError(f"unsupported category model version {meta.get('version')}")
+        weights = np.load(os.path.join(path, "weights.npy"), mmap_mode="r")
+        bias = np.load(os.path.join(path, "bias.npy"))
+        min_conf = float(os.environ.get("SMARTSPEND_CATEGORY_MIN_CONF") or meta["min_confidence"])
+        return cls(weights, bias, meta["labels"], meta["bits"], min_conf)
+
+
+def train(texts, labels, bits=DEFAULT_BITS, epochs=60, lr=0.5, l2=1e-5):
+    """Full-batch softmax regression with Adagrad on hashed features."""
+    classes = sorted(set(labels))
+    y = np.asarray([classes.index(l) for l in labels])
+    indptr, indices, data = featurize(texts, bits)
+    n, c, d = len(texts), len(classes), 1 << bits
+    rows = np.repeat(np.arange(n), np.diff(indptr))
+    W = np.zeros((d, c), dtype=np.float32)
+    b = np.zeros(c, dtype=np.float32)
+    gW2 = np.zeros_like(W) + 1e-8
+    gb2 = np.zeros_like(b) + 1e-8
+    for _ in range(epochs):
+        P = _softmax(sparse_dot(indptr, indices, data, W) + b)
+        P[np.arange(n), y] -= 1.0
+        P /= n
+        # X^T @ G, one bincount per class
+        gW = np.empty_like(W)
+        for k in range(c):
+            gW[:, k] = np.bincount(indices, weights=data * P[rows, k], minlength=d)
+        gW += l2 * W
+        gb = P.sum(axis=0)
+        gW2 += gW * gW
+        gb2 += gb * gb
+        W -= lr * gW / np.sqrt(gW2)
+        b -= lr * gb / np.sqrt(gb2)
+    return CategoryModel(W, b, classes, bits)
+
+
+# ---------- training data ----------
+def note_text(note):
+    """Item part of a saved note ("Merchant — item" -> "item")."""
+    return note.rsplit(" — ", 1)[-1].strip()
+
+
+def normalize_label(category):
+    cat = (category or "").strip()
+    # the expenses page stores free-form "Other: ..." labels
+    return "Other" if not cat or cat.lower().startswith("other") else cat
+
+
+def read_history(path):
+    """(texts, labels) from a CSV or JSONL export of the expenses table."""
+    texts, labels = [], []
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith((".jsonl", ".json")):
+            records = (json.loads(ln) for ln in f if ln.strip())
+        else:
+            records = csv.DictReader(f)
+        for rec in records:
+            text = note_text(str(rec.get("note") or ""))
+            if sum(ch.isalpha() for ch in text) < 2:
+                continue
+            texts.append(text)
+            labels.append(normalize_label(rec.get("category")))
+    return texts, labels
+
+
+def _train_main(args):
+    texts, labels = read_history(args.history)
+    print(f"DEBUG: {len(texts)} labelled notes, {len(set(labels))} categories", file=sys.stderr, flush=True)
+    if len(set(labels)) < 2:
+        sys.exit("need at least two categories to train")
+    order = np.random.default_rng(0).permutation(len(texts))
+    cut = int(len(texts) * (1.0 - args.holdout)) if args.holdout > 0 else len(texts)
+    tr, ho = order[:cut], order[cut:]
+    model = train([texts[i] for i in tr], [labels[i] for i in tr], bits=args.bits, epochs=args.epochs)
+    model.min_confidence = args.min_confidence
+    if len(ho):
+        proba = model.predict_proba([texts[i] for i in ho])
+        best = proba.argmax(axis=1)
+        conf = proba[np.arange(len(ho)), best]
+        hit = np.asarray([model.labels[j] == labels[i] for j, i in zip(best, ho)])
+        sure = conf >= args.min_confidence
+        print(json.dumps({
+            "holdout": int(len(ho)),
+            "accuracy": round(float(hit.mean()), 3),
+            "coverage_at_min_confidence": round(float(sure.mean()), 3),
+            "accuracy_when_confident": round(float(hit[sure].mean()), 3) if sure.any() else None,
+        }), flush=True)
+        # keep every example for the shipped model
+        model = train(texts, labels, bits=args.bits, epochs=args.epochs)
+        model.min_confidence = args.min_confidence
+    model.save(args.out, trained_on=len(texts))
+    print(f"DEBUG: model written to {args.out}", file=sys.stderr, flush=True)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Train or query the learned item categorizer.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("train", help="train from an exported (note, category) file")
+    p.add_argument("history", help="CSV (with note,category header) or JSONL export")
+    p.add_argument("--out", default=DEFAULT_DIR)
+    p.add_argument("--bits", type=int, default=DEFAULT_BITS, help="log2 of the hashed feature space")
+    p.add_argument("--epochs", type=int, default=60)
+    p.add_argument("--holdout", type=float, default=0.2, help="fraction held out for the printed evaluation")
+    p.add_argument("--min-confidence", type=float, default=DEFAULT_MIN_CONFIDENCE)
+    p = sub.add_parser("predict", help="print model label and confidence for each text")
+    p.add_argument("texts", nargs="+")
+    p.add_argument("--model", default=DEFAULT_DIR)
+    args = ap.parse_args()
+
+    if args.cmd == "train":
+        _train_main(args)
+        return
+    model = CategoryModel.load(args.model)
+    proba = model.predict_proba(args.texts)
+    for text, row in zip(args.texts, proba):
+        j = int(row.argmax())
+        print(json.dumps({"text": text, "label": model.labels[j], "confidence": round(float(row[j]), 3)},
+                         ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Merchant resolution: fuzzy lookup of receipt header text in a merchant dictionary.
+
+    index = default_index()
+    index.resolve(lines)  ->  {"name": "FamilyMart", "score": 0.9, "category": "Food & Dining", "matched": "family hart"}
+
+The dictionary (merchants.json next to this script, override with
+SMARTSPEND_MERCHANTS=<path>) lists each merchant's canonical name, its
+aliases and optional exact-only keywords and category. Aliases are matched
+against word-aligned windows of the first HEADER_LINES lines with a bounded
+edit distance, so OCR slips like "FAMILY HART" resolve without hand-written
+duplicates. Short aliases must match exactly and as whole tokens ("Subway"
+is not "Sunway", "AEON" not "Aeonmall"), and address lines ("Lot 5, Jalan
+Aeon", "47500 Subang Jaya") never name the merchant. A character-trigram
+index picks the few aliases worth comparing, which keeps the lookup cost
+independent of the dictionary size.
+"""
+import os, re, json
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "merchants.json")
+
+HEADER_LINES = 12
+# exact matches outside the header region rank below any header match
+BODY_ALIAS_SCORE = 0.9
+KEYWORD_SCORE = 0.7
+
+_TOKEN = re.compile(r"[a-z0-9&]+")
+# street, lot, unit and postcode words: the line says where the shop is, not who it is
+ADDRESS_LINE = re.compile(
+    r"\b(jalan|jln|lorong|lrg|persiaran|lebuh|lot|taman|tmn|bandar|kampung|kg|no\.|"
+    r"\d{5})(?![a-z0-9])",
+    re.I
+)
+
+
+def _tokens(text):
+    return _TOKEN.findall(text.lower())
+
+
+def _grams(s):
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+def max_edits(n):
+    """Edits tolerated for an alias of n characters (spaces excluded)."""
+    if n <= 6:
+        return 0  # one edit turns "subway" into "sunway", "primax" into "prima"
+    if n <= 8:
+        return 1
+    return 2
+
+
+def _distance(a, b, limit):
+    """Levenshtein distance, or limit + 1 as soon as it must exceed limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        if min(cur) > limit:
+            return limit + 1
+        prev = cur
+    return prev[-1]
+
+
+class MerchantIndex:
+    def __init__(self, merchants):
+        self.merchants = []
+        self.aliases = []       # (compact alias, merchant idx, allowed edits, gram count, token count)
+        self.postings = {}      # trigram -> [alias idx]
+        self.phrases = {}       # token tuple -> (merchant idx, score), exact lookup anywhere
+        self.max_phrase = 1
+        seen = set()
+        for m in merchants:
+            mi = len(self.merchants)
+            self.merchants.append({"name": m["name"], "category": m.get("category")})
+            for alias in [m["name"]] + list(m.get("aliases", ())):
+                toks = tuple(_tokens(alias))
+                compact = "".join(toks)
+                if not toks:
+                    continue
+                self._phrase(toks, mi, BODY_ALIAS_SCORE)
+                if len(compact) < 3 or compact in seen:
+                    continue
+                seen.add(compact)
+                ai = len(self.aliases)
+                grams = _grams(compact)
+                self.aliases.append((compact, mi, max_edits(len(compact)), len(grams), len(toks)))
+                for g in grams:
+                    self.postings.setdefault(g, []).append(ai)
+            for kw in m.get("keywords", ()):
+                toks = tuple(_tokens(kw))
+                if toks:
+                    self._phrase(toks, mi, KEYWORD_SCORE)
+
+    def _phrase(self, toks, mi, score):
+        if self.phrases.get(toks, (None, -1.0))[1] < score:
+            self.phrases[toks] = (mi, score)
+        self.max_phrase = max(self.max_phrase, len(toks))
+
+    @classmethod
+    def load(cls, path=DEFAULT_PATH):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["merchants"] if isinstance(data, dict) else data)
+
+    def _match(self, mi, score, matched):
+        m = self.merchants[mi]
+        return {"name": m["name"], "score": round(score, 3), "category": m["category"], "matched": matched}
+
+    def match_line(self, line):
+        """Best fuzzy alias match inside one line, or None (always for address lines)."""
+        if ADDRESS_LINE.search(line):
+            return None
+        toks = _tokens(line)
+        if not toks:
+            return None
+        counts = {}
+        for g in _grams("".join(toks)):
+            for ai in self.postings.get(g, ()):
+                counts[ai] = counts.get(ai, 0) + 1
+        best = None
+        for ai, shared in counts.items():
+            alias, mi, k, ngrams, ntoks = self.aliases[ai]
+            # each edit destroys at most three of the alias trigrams
+            if shared < ngrams - 3 * k:
+                continue
+            # a short alias spans as many tokens as it has: "s hell" is not Shell
+            max_toks = ntoks if k == 0 else len(toks)
+            for start in range(len(toks)):
+                window = ""
+                for tok in toks[start:start + max_toks]:
+                    window += tok
+                    if len(window) > len(alias) + k:
+                        break
+                    if len(window) < len(alias) - k:
+                        continue
+                    d = _distance(alias, window, k)
+                    if d > k:
+                        continue
+                    score = 1.0 - d / max(len(alias), len(window))
+                    if best is None or (score, len(alias)) > (best[0], len(best[2])):
+                        best = (score, mi, alias, window)
+        if best is None:
+            return None
+        return self._match(best[1], best[0], best[3])
+
+    def find_exact(self, lines):
+        """First exact alias or keyword phrase anywhere in the lines (address lines skipped), or None."""
+        for line in lines:
+            if ADDRESS_LINE.search(line):
+                continue
+            toks = _tokens(line)
+            for i in range(len(toks)):
+                for n in range(min(self.max_phrase, len(toks) - i), 0, -1):
+                    hit = self.phrases.get(tuple(toks[i:i + n]))
+                    if hit is not None:
+                        return self._match(hit[0], hit[1], " ".join(toks[i:i + n]))
+        return None
+
+    def resolve(self, lines, header_lines=HEADER_LINES):
+        """Best header match, else the first exact phrase in the whole text, else None."""
+        best = None
+        for line in lines[:header_lines]:
+            m = self.match_line(line)
+            if m is not None and (best is None or m["score"] > best["score"]):
+                best = m
+                if best["score"] == 1.0:
+                    break
+        return best or self.find_exact(lines)
+
+
+_default = None
+
+
+def default_index():
+    """Process-wide index from SMARTSPEND_MERCHANTS (or merchants.json), loaded once."""
+    global _default
+    path = os.environ.get("SMARTSPEND_MERCHANTS") or DEFAULT_PATH
+    if _default is None or _default[0] != path:
+        _default = (path, MerchantIndex.load(path))
+    return _default[1]
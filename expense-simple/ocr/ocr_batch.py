@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Bulk receipt ingestion: fan receipts out over a pool of warm OCR workers.
+
+    python ocr_batch.py <directory | glob | manifest.txt> [-j WORKERS] [--scope USER_ID]
+
+Prints one JSON line per receipt as soon as it finishes, tagged with "path".
+A manifest is a text file with one image path per line (relative paths are
+resolved against the manifest's directory). --scope names the owner of the
+receipts for duplicate detection; without it there is none.
+"""
+import os, sys, json, glob, argparse
+import multiprocessing as mp
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".tif", ".tiff")
+
+_ocr = None  # per-worker PaddleOCR instance
+_scope = ""  # owner of this batch, see extract_receipt.extract
+
+
+def collect_inputs(spec):
+    """Expand a directory, glob pattern or manifest file into image paths."""
+    if os.path.isdir(spec):
+        paths = []
+        for root, _dirs, files in os.walk(spec):
+            for name in files:
+                if name.lower().endswith(IMAGE_EXTS):
+                    paths.append(os.path.join(root, name))
+        return sorted(paths)
+    if os.path.isfile(spec) and not spec.lower().endswith(IMAGE_EXTS):
+        base = os.path.dirname(os.path.abspath(spec))
+        paths = []
+        with open(spec, encoding="utf-8") as f:
+            for ln in f:
+                ln = ln.strip()
+                if not ln or ln.startswith("#"):
+                    continue
+                paths.append(ln if os.path.isabs(ln) else os.path.join(base, ln))
+        return paths
+    if os.path.isfile(spec):
+        return [spec]
+    return sorted(glob.glob(spec, recursive=True))
+
+
+def _init_worker(threads, scope=""):
+    global _ocr, _scope
+    _scope = scope
+    # split the cores between workers instead of letting each one grab all of them
+    os.environ.setdefault("OMP_NUM_THREADS", str(threads))
+    import extract_receipt
+    _ocr = extract_receipt.create_ocr()
+
+
+def _work(path):
+    import extract_receipt
+    try:
+        result = extract_receipt.extract(path, _ocr, scope=_scope)
+    except Exception as e:
+        result = extract_receipt.empty_result()
+        result["error"] = f"{type(e).__name__}: {e}"
+    return {"path": path, **result}
+
+
+def run_batch(paths, workers=None, out=sys.stdout, scope=""):
+    """Process paths on a worker pool, writing JSON lines in completion order."""
+    workers = max(1, min(workers or os.cpu_count() or 1, len(paths) or 1))
+    count = 0
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    with mp.Pool(workers, initializer=_init_worker, initargs=(threads, scope)) as pool:
+        for rec in pool.imap_unordered(_work, paths):
+            out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            out.flush()
+            count += 1
+    return count
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Extract many receipts with a pool of warm OCR workers.")
+    ap.add_argument("inputs", help="directory, glob pattern or manifest file")
+    ap.add_argument("-j", "--workers", type=int, default=None,
+                    help="worker processes (default: CPU count)")
+    ap.add_argument("--scope", default="",
+                    help="owner of the receipts (e.g. user id) for duplicate detection")
+    args = ap.parse_args()
+
+    paths = collect_inputs(args.inputs)
+    print(f"DEBUG: batch of {len(paths)} receipt(s)", file=sys.stderr, flush=True)
+    if not paths:
+        return
+    run_batch(paths, args.workers, scope=args.scope)
+
+
+if __name__ == "__main__":
+    main()
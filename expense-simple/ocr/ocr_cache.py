@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Content-addressed cache of OCR output (lines + row geometry) and parsed results, keyed by image hash.
+
+Entries live in a small SQLite file next to this script (override with
+SMARTSPEND_OCR_CACHE=<path>, disable with SMARTSPEND_OCR_CACHE=0). The key
+combines the SHA-256 of the image bytes with the OCR pipeline version, so a
+preprocessing or model change never serves stale OCR output. Parsed results
+are tagged with the parser version and re-derived from the cached OCR output
+when the parser changes. The total size is bounded with least-recently-used eviction.
+"""
+import os, json, time, sqlite3, hashlib
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ocr_cache.sqlite3")
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ocr_cache (
+    key        TEXT PRIMARY KEY,
+    parser     TEXT NOT NULL,
+    lines      TEXT NOT NULL,  -- JSON OCR output, whatever shape the pipeline version stores
+    result     TEXT NOT NULL,
+    size       INTEGER NOT NULL,
+    last_used  REAL NOT NULL
+)
+"""
+
+
+def image_key(data: bytes, pipeline_version: str) -> str:
+    return hashlib.sha256(data).hexdigest() + ":" + pipeline_version
+
+
+class OCRCache:
+    def __init__(self, path=DEFAULT_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        with self._connect() as db:
+            db.execute(_SCHEMA)
+            db.execute("CREATE INDEX IF NOT EXISTS ocr_cache_lru ON ocr_cache(last_used)")
+
+    def _connect(self):
+        # short-lived connections: safe across daemon threads and batch processes
+        return sqlite3.connect(self.path, timeout=5.0)
+
+    def get(self, key):
+        """Return (ocr_out, result, parser_version) or None."""
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT lines, result, parser FROM ocr_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE ocr_cache SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0]), json.loads(row[1]), row[2]
+
+    def put(self, key, ocr_out, result, parser_version):
+        lines_js = json.dumps(ocr_out, ensure_ascii=False)
+        result_js = json.dumps(result, ensure_ascii=False)
+        size = len(lines_js.encode("utf-8")) + len(result_js.encode("utf-8"))
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO ocr_cache (key, parser, lines, result, size, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, parser_version, lines_js, result_js, size, time.time()),
+            )
+            self._evict(db)
+
+    def _evict(self, db):
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # drop least recently used entries until we are back under budget
+        for key, size in db.execute(
+            "SELECT key, size FROM ocr_cache ORDER BY last_used ASC"
+        ).fetchall():
+            db.execute("DELETE FROM ocr_cache WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        with self._connect() as db:
+            db.execute("DELETE FROM ocr_cache")
+
+
+_default = None
+
+
+def default_cache():
+    """Process-wide cache from the environment, or None when disabled."""
+    global _default
+    path = os.environ.get("SMARTSPEND_OCR_CACHE", DEFAULT_PATH)
+    if path in ("", "0", "off"):
+        return None
+    if _default is None or _default.path != path:
+        max_mb = float(os.environ.get("SMARTSPEND_OCR_CACHE_MB") or DEFAULT_MAX_BYTES / (1024 * 1024))
+        try:
+            _default = OCRCache(path, int(max_mb * 1024 * 1024))
+        except sqlite3.Error:
+            return None
+    return _default
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Warm OCR daemon: loads PaddleOCR once and serves extract requests over localhost TCP.
+
+Protocol: one JSON object per line in each direction.
+    {"op": "extract", "image_b64": "<base64 bytes>"}    ->  same JSON as extract_receipt.py
+    {"op": "extract", "path": "C:\\...\\receipt.jpg"}  ->  same, for files under SMARTSPEND_OCR_ROOTS
+    (either may carry "scope": "<user id>" for duplicate detection, and
+    "progressive": true to get a {"partial": true, "merchant", "amount", "date"}
+    line first, as soon as the header and footer are read, or "multi": true
+    for a photo of several receipts: {"receipts": [...]}, see extract_many)
+    {"op": "ping"}                                     ->  {"ok": true}
+
+Any local process can connect, so the daemon never writes where a request
+asks and only opens a "path" that resolves to a file inside one of the
+directories in SMARTSPEND_OCR_ROOTS (os.pathsep separated; unset means no
+paths at all). The CLI always sends the image bytes.
+
+Start it with:  python extract_receipt.py --serve
+"""
+import os, sys, json, base64, socket, socketserver, threading
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+CONNECT_TIMEOUT = 0.25   # seconds; a missing daemon must not slow the CLI down
+REQUEST_TIMEOUT = 120.0  # seconds; OCR of a large receipt can take a while
+
+
+def _address(host=None, port=None):
+    host = host or os.environ.get("SMARTSPEND_OCR_HOST") or DEFAULT_HOST
+    port = port or int(os.environ.get("SMARTSPEND_OCR_PORT") or DEFAULT_PORT)
+    return host, port
+
+
+# ---------- client ----------
+def _error_result(error):
+    """An error reply that still has every key of an extract result (PHP reads them unconditionally)."""
+    import extract_receipt
+    result = extract_receipt.empty_result()
+    result["error"] = error
+    return result
+
+
+def _call(msg, host=None, port=None, timeout=REQUEST_TIMEOUT, on_partial=None):
+    """Send one request; return the decoded reply, or None if no daemon took it.
+
+    Replies marked "partial" go to on_partial; the last line is the reply.
+    Only a daemon that could not be reached (or not sent the request) gives
+    None for the caller to run the request itself; once it has the request,
+    a timeout or dropped connection is an error reply, since running it again
+    would pay for the OCR twice and repeat the partial lines.
+    """
+    if os.environ.get("SMARTSPEND_OCR_DAEMON", "1") == "0":
+        return None
+    try:
+        sock = socket.create_connection(_address(host, port), timeout=CONNECT_TIMEOUT)
+    except OSError:
+        return None
+    with sock:
+        try:
+            sock.settimeout(timeout)
+            sock.sendall(json.dumps(msg, ensure_ascii=False).encode("utf-8") + b"\n")
+        except OSError as e:
+            print(f"DEBUG: daemon request not sent: {e}", file=sys.stderr, flush=True)
+            return None
+        try:
+            with sock.makefile("rb") as f:
+                while True:
+                    line = f.readline()
+                    if not line:
+                        return _error_result("daemon_failed: connection closed")
+                    reply = json.loads(line.decode("utf-8"))
+                    if not (isinstance(reply, dict) and reply.get("partial")):
+                        return reply if isinstance(reply, dict) else _error_result("daemon_failed: bad reply")
+                    if on_partial is not None:
+                        on_partial(reply)
+        except (OSError, ValueError) as e:
+            print(f"DEBUG: daemon request failed: {e}", file=sys.stderr, flush=True)
+            return _error_result(f"daemon_failed: {type(e).__name__}: {e}")
+
+
+def request_extract(src, host=None, port=None, scope="", on_partial=None, multi=False):
+    """src is an image path or the raw image bytes; on_partial asks for progressive replies.
+
+    None when no daemon took the request, else its reply (an error result included).
+    """
+    if not isinstance(src, (bytes, bytearray)):
+        with open(src, "rb") as f:
+            src = f.read()
+    msg = {"op": "extract", "image_b64": base64.b64encode(src).decode("ascii")}
+    if scope:
+        msg["scope"] = scope
+    if on_partial is not None:
+        msg["progressive"] = True
+    if multi:
+        msg["multi"] = True
+    return _call(msg, host, port, on_partial=on_partial)
+
+
+def ping(host=None, port=None):
+    reply = _call({"op": "ping"}, host, port, timeout=CONNECT_TIMEOUT)
+    return bool(reply and reply.get("ok"))
+
+
+# ---------- server ----------
+def _allowed_roots():
+    roots = os.environ.get("SMARTSPEND_OCR_ROOTS") or ""
+    return [os.path.realpath(r) for r in roots.split(os.pathsep) if r.strip()]
+
+
+def _confined_path(path):
+    """Real path of an existing file inside SMARTSPEND_OCR_ROOTS, else None."""
+    if not isinstance(path, str) or not path:
+        return None
+    real = os.path.realpath(path)
+    if not os.path.isfile(real):
+        return None
+    for root in _allowed_roots():
+        if os.path.commonpath([real, root]) == root:
+            return real
+    return None
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for raw in self.rfile:
+            raw = raw.strip()
+            if not raw:
+                continue
+            try:
+                msg = json.loads(raw.decode("utf-8"))
+                reply = self.server.dispatch(msg, self.send)
+            except Exception as e:
+                reply = _error_result(f"{type(e).__name__}: {e}")
+            self.send(reply)
+
+    def send(self, reply):
+        self.wfile.write(json.dumps(reply, ensure_ascii=False).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+
+class OCRServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, ocr):
+        super().__init__(address, _Handler)
+        self.ocr = ocr
+        # PaddleOCR predictors are not thread-safe; serialize inference
+        self.lock = threading.Lock()
+
+    def dispatch(self, msg, send=None):
+        import extract_receipt
+        op = msg.get("op")
+        if op == "ping":
+            return {"ok": True}
+        if op == "extract":
+            if msg.get("image_b64"):
+                src = base64.b64decode(msg["image_b64"])
+            else:
+                src = _confined_path(msg.get("path"))
+                if src is None:
+                    return _error_result("path_not_allowed")
+            on_partial = send if msg.get("progressive") else None
+            with self.lock:
+                if msg.get("multi"):
+                    return extract_receipt.extract_many(src, self.ocr, scope=str(msg.get("scope") or ""))
+                return extract_receipt.extract(src, self.ocr, scope=str(msg.get("scope") or ""),
+                                              on_partial=on_partial)
+        return _error_result(f"unknown_op: {op}")
+
+
+def serve(host=None, port=None):
+    import extract_receipt
+    address = _address(host, port)
+    print("DEBUG: daemon loading models", file=sys.stderr, flush=True)
+    ocr = extract_receipt.create_ocr()
+    with OCRServer(address, ocr) as server:
+        print(f"DEBUG: daemon listening on {address[0]}:{address[1]}", file=sys.stderr, flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
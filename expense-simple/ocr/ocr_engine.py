@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""OCR engine construction from named CPU inference profiles.
+
+    python ocr_engine.py list                                   # profiles and the resolved settings
+    python ocr_engine.py bench IMAGE... [--profile NAME]... [--pin]
+    python ocr_engine.py quantize det.onnx det.int8.onnx        # dynamic int8 weights for the onnx backend
+
+A profile (ocr_profiles.json next to this script, override the path with
+SMARTSPEND_OCR_PROFILES) overrides DEFAULTS: backend ("paddle" or "onnx"),
+CPU threads, MKL-DNN, recognizer batch size, whether the angle classifier
+runs, detector limits and thresholds, and model names or paths.
+SMARTSPEND_OCR_PROFILE selects one, else the file's "active" entry.
+
+The paddle backend maps the settings onto whichever PaddleOCR is installed:
+2.x takes det_db_thresh/drop_score/use_gpu..., 3.x takes text_det_thresh/
+text_rec_score_thresh/device... and rejects the 2.x names outright. The
+onnx backend runs exported (optionally quantized) det/rec/cls models through
+rapidocr_onnxruntime and returns PaddleOCR 2.x shaped results, so the rest
+of the pipeline does not care which one is loaded.
+"""
+import os, sys, json, time, hashlib, argparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PATH = os.path.join(HERE, "ocr_profiles.json")
+
+DEFAULTS = {
+    "backend": "paddle",
+    "lang": "en",
+    "angle_cls": True,
+    "det_limit_side_len": 1536,
+    "det_thresh": 0.30,
+    "det_box_thresh": 0.50,
+    "drop_score": 0.30,
+    "threads": None,      # None: OMP_NUM_THREADS if set, else the library default
+    "mkldnn": None,       # None: library default
+    "rec_batch": None,
+    "ocr_version": None,  # e.g. "PP-OCRv4"
+    "det_model": None,    # paddle: model dir; onnx: .onnx path (relative to this script)
+    "rec_model": None,
+    "cls_model": None,
+}
+
+
+# ---------- profiles ----------
+def load_profiles(path=None):
+    path = path or os.environ.get("SMARTSPEND_OCR_PROFILES") or DEFAULT_PATH
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        data = {}
+    data.setdefault("profiles", {}).setdefault("default", {})
+    return data, path
+
+
+def resolve(name=None, path=None):
+    """(name, settings) for a profile: DEFAULTS overlaid with the profile's keys."""
+    data, _ = load_profiles(path)
+    name = name or os.environ.get("SMARTSPEND_OCR_PROFILE") or data.get("active") or "default"
+    try:
+        overrides = data["profiles"][name]
+    except KeyError:
+        raise ValueError(f"unknown OCR profile {name!r}") from None
+    unknown = set(overrides) - set(DEFAULTS)
+    if unknown:
+        raise ValueError(f"OCR profile {name!r} has unknown keys: {', '.join(sorted(unknown))}")
+    cfg = dict(DEFAULTS, **overrides)
+    if cfg["threads"] is None and os.environ.get("OMP_NUM_THREADS"):
+        cfg["threads"] = int(os.environ["OMP_NUM_THREADS"])
+    return name, cfg
+
+
+def _model_path(p):
+    return p if p is None or os.path.isabs(p) else os.path.join(HERE, p)
+
+
+# settings that only change how fast a profile reads, not what it reads
+SPEED_ONLY = ("threads",)
+
+
+def fingerprint(cfg):
+    """Short hash of the settings and model files that decide what a profile reads.
+
+    Part of the OCR cache key and the result version, so switching profile,
+    model or quantization never serves text read by another engine.
+    """
+    h = hashlib.sha256(json.dumps({k: v for k, v in cfg.items() if k not in SPEED_ONLY},
+                                  sort_keys=True).encode("utf-8"))
+    for key in ("det_model", "rec_model", "cls_model"):
+        path = _model_path(cfg[key])
+        if path and os.path.exists(path):
+            st = os.stat(path)  # a model replaced in place keeps its path
+            h.update(f"{key}:{st.st_size}:{st.st_mtime_ns}".encode("utf-8"))
+    return h.hexdigest()[:12]
+
+
+def profile_tag(profile=None):
+    """(name, fingerprint) of a profile as resolve() finds it now."""
+    name, cfg = resolve(profile)
+    return name, fingerprint(cfg)
+
+
+# ---------- backends ----------
+def _paddle_major():
+    import paddleocr
+    try:
+        return int(str(getattr(paddleocr, "__version__", "2")).split(".")[0])
+    except ValueError:
+        return 2
+
+
+def paddle_kwargs(cfg, major):
+    """PaddleOCR constructor arguments for the installed major version."""
+    if major >= 3:
+        kw = {
+            "lang": cfg["lang"],
+            "device": "cpu",
+            "use_textline_orientation": cfg["angle_cls"],
+            # we deskew ourselves; the document classifiers only add latency on receipts
+            "use_doc_orientation_classify": False,
+            "use_doc_unwarping": False,
+            "text_det_limit_side_len": cfg["det_limit_side_len"],
+            "text_det_thresh": cfg["det_thresh"],
+            "text_det_box_thresh": cfg["det_box_thresh"],
+            "text_rec_score_thresh": cfg["drop_score"],
+        }
+        optional = {"enable_mkldnn": cfg["mkldnn"], "cpu_threads": cfg["threads"],
+                    "text_recognition_batch_size": cfg["rec_batch"], "ocr_version": cfg["ocr_version"],
+                    "text_detection_model_dir": _model_path(cfg["det_model"]),
+                    "text_recognition_model_dir": _model_path(cfg["rec_model"]),
+                    "textline_orientation_model_dir": _model_path(cfg["cls_model"])}
+    else:
+        kw = {
+            "lang": cfg["lang"],
+            "use_gpu": False,
+            "use_angle_cls": cfg["angle_cls"],
+            "det_limit_side_len": cfg["det_limit_side_len"],
+            "det_db_thresh": cfg["det_thresh"],
+            "det_db_box_thresh": cfg["det_box_thresh"],
+            "drop_score": cfg["drop_score"],
+        }
+        optional = {"enable_mkldnn": cfg["mkldnn"], "cpu_threads": cfg["threads"],
+                    "rec_batch_num": cfg["rec_batch"], "ocr_version": cfg["ocr_version"],
+                    "det_model_dir": _model_path(cfg["det_model"]),
+                    "rec_model_dir": _model_path(cfg["rec_model"]),
+                    "cls_model_dir": _model_path(cfg["cls_model"])}
+    kw.update({k: v for k, v in optional.items() if v is not None})
+    return kw
+
+
+def _create_paddle(cfg):
+    from paddleocr import PaddleOCR
+    major = _paddle_major()
+    kw = paddle_kwargs(cfg, major)
+    print(f"DEBUG: PaddleOCR {major}.x with {kw}", file=sys.stderr, flush=True)
+    try:
+        return PaddleOCR(**kw)
+    except TypeError:
+        if major >= 3:
+            raise
+        # older 2.x releases lack some tuning args; keep the essentials
+        return PaddleOCR(lang=cfg["lang"], use_angle_cls=cfg["angle_cls"])
+
+
+class OnnxEngine:
+    """rapidocr_onnxruntime behind the PaddleOCR .ocr() interface."""
+
+    def __init__(self, cfg):
+        from rapidocr_onnxruntime import RapidOCR
+        kw = {
+            "use_cls": cfg["angle_cls"],
+            "det_limit_side_len": cfg["det_limit_side_len"],
+            "det_thresh": cfg["det_thresh"],
+            "det_box_thresh": cfg["det_box_thresh"],
+            "text_score": cfg["drop_score"],
+        }
+        optional = {"intra_op_num_threads": cfg["threads"], "rec_batch_num": cfg["rec_batch"],
+                    "det_model_path": _model_path(cfg["det_model"]),
+                    "rec_model_path": _model_path(cfg["rec_model"]),
+                    "cls_model_path": _model_path(cfg["cls_model"])}
+        kw.update({k: v for k, v in optional.items() if v is not None})
+        for key in ("det_model_path", "rec_model_path", "cls_model_path"):
+            if key in kw and not os.path.isfile(kw[key]):
+                raise FileNotFoundError(f"{key}: {kw[key]}")
+        print(f"DEBUG: RapidOCR with {kw}", file=sys.stderr, flush=True)
+        self.engine = RapidOCR(**kw)
+
+    def ocr(self, img):
+        if isinstance(img, str):
+            import cv2
+            img = cv2.imread(img)
+        result, _elapse = self.engine(img)
+        page = []
+        for poly, text, score in result or []:
+            page.append([[list(map(float, pt)) for pt in poly], (text, float(score))])
+        return [page]
+
+
+def create(profile=None):
+    """Build the OCR engine for a profile (slow: loads the det/rec/cls models)."""
+    name, cfg = resolve(profile)
+    print(f"DEBUG: OCR profile {name}", file=sys.stderr, flush=True)
+    if cfg["backend"] == "onnx":
+        engine = OnnxEngine(cfg)
+    elif cfg["backend"] == "paddle":
+        engine = _create_paddle(cfg)
+    else:
+        raise ValueError(f"unknown OCR backend {cfg['backend']!r}")
+    # what it was built from, even if the environment or the pinned profile changes later
+    engine.smartspend_profile = (name, fingerprint(cfg))
+    return engine
+
+
+# ---------- tools ----------
+def bench(images, profiles, repeat=3):
+    """Load each profile and time ocr_lines over the images; one report dict per profile."""
+    import extract_receipt as er
+    datas = []
+    for path in images:
+        with open(path, "rb") as f:
+            datas.append((path, f.read()))
+    reports = []
+    for name in profiles:
+        rep = {"profile": name}
+        t0 = time.perf_counter()
+        try:
+            engine = create(name)
+        except Exception as e:
+            rep["error"] = f"{type(e).__name__}: {e}"
+            reports.append(rep)
+            continue
+        rep["load_ms"] = round((time.perf_counter() - t0) * 1000.0, 1)
+        times, lines = [], 0
+        for path, data in datas:
+            er.ocr_lines(data, engine)  # warm-up (first call allocates)
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                got, _rows = er.ocr_lines(data, engine, deadline=er.Deadline(float("inf")))
+                times.append((time.perf_counter() - t0) * 1000.0)
+            lines += len(got)
+        times.sort()
+        rep.update({
+            "images": len(datas),
+            "p50_ms": round(times[len(times) // 2], 1),
+            "p95_ms": round(times[min(len(times) - 1, int(len(times) * 0.95))], 1),
+            "lines": lines,  # a faster profile that reads fewer lines is not a win
+        })
+        reports.append(rep)
+        del engine
+    return reports
+
+
+def pin(name, path=None):
+    """Make a profile the file's "active" one."""
+    data, path = load_profiles(path)
+    if name not in data["profiles"]:
+        raise ValueError(f"unknown OCR profile {name!r}")
+    data["active"] = name
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+        f.write("\n")
+
+
+def quantize(src, dst):
+    """Dynamic int8 weight quantization of an exported det/rec/cls model."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    quantize_dynamic(src, dst, weight_type=QuantType.QUInt8)
+    return os.path.getsize(src), os.path.getsize(dst)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Inspect, benchmark and pin OCR engine profiles.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("list", help="print every profile with its resolved settings")
+    p = sub.add_parser("bench", help="time ocr_lines per profile on sample images")
+    p.add_argument("images", nargs="+")
+    p.add_argument("--profile", action="append", help="profile to run (repeatable; default: all)")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--pin", action="store_true",
+                   help="make the fastest profile active among those reading within 2%% of the most lines")
+    p = sub.add_parser("quantize", help="int8-quantize an ONNX model for the onnx backend")
+    p.add_argument("src")
+    p.add_argument("dst")
+    args = ap.parse_args()
+
+    if args.cmd == "list":
+        data, _ = load_profiles()
+        active = os.environ.get("SMARTSPEND_OCR_PROFILE") or data.get("active") or "default"
+        for name in data["profiles"]:
+            try:
+                cfg = resolve(name)[1]
+            except ValueError as e:
+                cfg = {"error": str(e)}
+            print(json.dumps({"profile": name, "active": name == active, **cfg}), flush=True)
+    elif args.cmd == "bench":
+        names = args.profile or list(load_profiles()[0]["profiles"])
+        reports = bench(args.images, names, args.repeat)
+        for rep in reports:
+            print(json.dumps(rep), flush=True)
+        ok = [r for r in reports if "error" not in r]
+        if args.pin and ok:
+            most = max(r["lines"] for r in ok)
+            best = min((r for r in ok if r["lines"] >= 0.98 * most), key=lambda r: r["p50_ms"])
+            pin(best["profile"])
+            print(f"DEBUG: pinned profile {best['profile']}", file=sys.stderr, flush=True)
+    else:
+        before, after = quantize(args.src, args.dst)
+        print(json.dumps({"src": args.src, "dst": args.dst, "bytes": [before, after]}), flush=True)
+
+
+if __name__ == "__main__":
+    main()
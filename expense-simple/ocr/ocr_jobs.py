@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""SQLite-backed receipt job queue served by a pool of warm OCR workers.
+
+    python ocr_jobs.py enqueue <image | -> [--bulk] [--scope USER_ID]  ->  {"job_id": 12}   (returns at once)
+    python ocr_jobs.py status 12                      ->  {"id": 12, "state": "done", "result": {...}}
+    python ocr_jobs.py wait 12 [--timeout 60]         ->  same, once the job has finished
+    python ocr_jobs.py work [-j WORKERS]              ->  run the worker pool until Ctrl+C
+
+Interactive uploads (priority 0) are always claimed before bulk back-fills
+(priority 10). A claimed job holds a lease of `timeout` seconds: the pool
+supervisor kills a worker whose lease runs out and the job is retried until
+max_attempts, then marked failed; an error a retry would only repeat (an
+empty upload, a parser exception) fails the job at once. Image bytes are stored in the queue so the
+web tier never writes under ocr/; they are dropped once the job finishes.
+A job's scope (the owner, e.g. the user id) goes to extract() for duplicate
+detection; jobs without one get none.
+The database lives next to this script (override with SMARTSPEND_OCR_JOBS).
+"""
+import os, sys, json, time, signal, sqlite3, argparse
+import multiprocessing as mp
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ocr_jobs.sqlite3")
+
+PRIORITIES = {"interactive": 0, "bulk": 10}
+DEFAULT_TIMEOUT = 120.0   # seconds a worker may spend on one job
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 0.2       # idle worker / wait() polling period
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ocr_jobs (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    priority      INTEGER NOT NULL,
+    state         TEXT NOT NULL,     -- queued | running | done | failed
+    path          TEXT,
+    image         BLOB,
+    scope         TEXT NOT NULL DEFAULT '',
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    max_attempts  INTEGER NOT NULL,
+    timeout       REAL NOT NULL,
+    worker        TEXT,
+    lease_until   REAL,
+    created       REAL NOT NULL,
+    started       REAL,
+    finished      REAL,
+    result        TEXT,
+    error         TEXT
+)
+"""
+
+
+class JobQueue:
+    def __init__(self, path=None):
+        self.path = path or os.environ.get("SMARTSPEND_OCR_JOBS") or DEFAULT_PATH
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")  # readers (status polls) never block the workers
+            db.execute(_SCHEMA)
+            if "scope" not in {c[1] for c in db.execute("PRAGMA table_info(ocr_jobs)")}:
+                db.execute("ALTER TABLE ocr_jobs ADD COLUMN scope TEXT NOT NULL DEFAULT ''")
+            db.execute("CREATE INDEX IF NOT EXISTS ocr_jobs_next ON ocr_jobs(state, priority, id)")
+
+    def _connect(self):
+        # short-lived connections, like ocr_cache: safe across worker processes
+        return sqlite3.connect(self.path, timeout=10.0)
+
+    # ---------- producer side ----------
+    def enqueue(self, src, priority="interactive", timeout=DEFAULT_TIMEOUT, max_attempts=MAX_ATTEMPTS,
+                scope=""):
+        """Queue an image path or raw image bytes of scope's (the owner's); return the job id."""
+        prio = PRIORITIES.get(priority, priority)
+        if isinstance(src, (bytes, bytearray)):
+            path, image = None, sqlite3.Binary(bytes(src))
+        else:
+            path, image = os.path.abspath(src), None
+        with self._connect() as db:
+            cur = db.execute(
+                "INSERT INTO ocr_jobs (priority, state, path, image, scope, max_attempts, timeout, created) "
+                "VALUES (?, 'queued', ?, ?, ?, ?, ?, ?)",
+                (int(prio), path, image, str(scope or ""), int(max_attempts), float(timeout), time.time()),
+            )
+            return cur.lastrowid
+
+    def status(self, job_id):
+        """Job record as a dict (result decoded), or None for an unknown id."""
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT id, priority, state, path, attempts, max_attempts, created, started, finished, "
+                "result, error FROM ocr_jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        keys = ("id", "priority", "state", "path", "attempts", "max_attempts",
+                "created", "started", "finished", "result", "error")
+        rec = dict(zip(keys, row))
+        rec["result"] = json.loads(rec["result"]) if rec["result"] else None
+        return rec
+
+    def wait(self, job_id, timeout=None):
+        """Poll until the job is done or failed (or timeout seconds pass); return its status."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            rec = self.status(job_id)
+            if rec is None or rec["state"] in ("done", "failed"):
+                return rec
+            if deadline is not None and time.monotonic() >= deadline:
+                return rec
+            time.sleep(POLL_INTERVAL)
+
+    # ---------- worker side ----------
+    def claim(self, worker):
+        """Lease the most urgent queued job to worker; return (id, src, scope) or None."""
+        now = time.time()
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT id, path, image, scope, timeout FROM ocr_jobs WHERE state = 'queued' "
+                "ORDER BY priority, id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                db.commit()
+                return None
+            job_id, path, image, scope, timeout = row
+            db.execute(
+                "UPDATE ocr_jobs SET state = 'running', worker = ?, attempts = attempts + 1, "
+                "started = ?, lease_until = ? WHERE id = ?",
+                (worker, now, now + timeout, job_id),
+            )
+            db.commit()
+        finally:
+            db.close()
+        return job_id, (bytes(image) if image is not None else path), scope
+
+    def complete(self, job_id, worker, result):
+        # the worker check drops a late answer for a job whose lease was already taken away
+        with self._connect() as db:
+            db.execute(
+                "UPDATE ocr_jobs SET state = 'done', result = ?, error = NULL, image = NULL, "
+                "finished = ?, lease_until = NULL WHERE id = ? AND state = 'running' AND worker = ?",
+                (json.dumps(result, ensure_ascii=False), time.time(), job_id, worker),
+            )
+
+    def fail(self, job_id, worker, error, final=False):
+        """Record a failed attempt: back to the queue, or failed once attempts are used up
+        (at once when final, for errors another attempt cannot fix)."""
+        with self._connect() as db:
+            self._retry_or_fail(db, "id = ? AND state = 'running' AND worker = ?",
+                                (job_id, worker), error, time.time(), final)
+
+    def expire(self):
+        """Requeue (or fail) running jobs whose lease ran out; return their (id, worker) pairs."""
+        now = time.time()
+        db = self._connect()
+        try:
+            # one transaction: a job completed between the two statements must not be reported
+            db.execute("BEGIN IMMEDIATE")
+            stale = db.execute(
+                "SELECT id, worker FROM ocr_jobs WHERE state = 'running' AND lease_until < ?", (now,)
+            ).fetchall()
+            if stale:
+                self._retry_or_fail(db, "state = 'running' AND lease_until < ?", (now,), "timeout", now)
+            db.commit()
+        finally:
+            db.close()
+        return stale
+
+    @staticmethod
+    def _retry_or_fail(db, where, args, error, now, final=False):
+        done = "(attempts >= max_attempts OR ?)"
+        db.execute(
+            f"UPDATE ocr_jobs SET state = CASE WHEN {done} THEN 'failed' ELSE 'queued' END, "
+            f"image = CASE WHEN {done} THEN NULL ELSE image END, "
+            f"finished = CASE WHEN {done} THEN ? ELSE NULL END, "
+            f"error = ?, worker = NULL, lease_until = NULL WHERE {where}",
+            (final, final, final, now, error) + tuple(args),
+        )
+
+    def purge(self, older_than_s):
+        """Delete finished jobs older than the given age; return how many went."""
+        with self._connect() as db:
+            cur = db.execute(
+                "DELETE FROM ocr_jobs WHERE state IN ('done', 'failed') AND finished < ?",
+                (time.time() - older_than_s,),
+            )
+            return cur.rowcount
+
+
+# ---------- worker pool ----------
+def _worker_main(db_path, name, threads):
+    os.environ.setdefault("OMP_NUM_THREADS", str(threads))
+    import extract_receipt
+    queue = JobQueue(db_path)
+    ocr = extract_receipt.create_ocr()
+    print(f"DEBUG: {name} ready", file=sys.stderr, flush=True)
+    while True:
+        try:
+            job = queue.claim(name)
+        except sqlite3.Error as e:  # e.g. locked past the busy timeout; try again
+            print(f"DEBUG: {name} claim failed: {e}", file=sys.stderr, flush=True)
+            job = None
+        if job is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+        run_job(queue, name, job, ocr)
+
+
+# a retry reads the same bytes with the same code: these errors cannot go away
+PERMANENT_ERRORS = ("file_missing_or_empty",)
+PERMANENT_EXCEPTIONS = ("ValueError", "TypeError", "KeyError", "IndexError", "AttributeError",
+                        "ZeroDivisionError", "UnicodeDecodeError")
+
+
+def is_permanent(error):
+    """True for an extract error another attempt would only repeat (OCR engine trouble is retried)."""
+    return error in PERMANENT_ERRORS or error.split(":", 1)[0] in PERMANENT_EXCEPTIONS
+
+
+def run_job(queue, name, job, ocr):
+    """Extract one claimed job and record the outcome: done, or a failed attempt."""
+    import extract_receipt
+    job_id, src, scope = job
+    try:
+        result = extract_receipt.extract(src, ocr, scope=scope)
+    except Exception as e:
+        result = {"error": f"{type(e).__name__}: {e}"}
+    if result.get("error"):
+        # extract() reports unreadable images and OCR failures in the result, it does not raise
+        print(f"DEBUG: {name} job {job_id} failed: {result['error']}", file=sys.stderr, flush=True)
+        queue.fail(job_id, name, result["error"], final=is_permanent(result["error"]))
+        return
+    queue.complete(job_id, name, result)
+
+
+def _start(db_path, name, threads):
+    p = mp.Process(target=_worker_main, args=(db_path, name, threads), name=name, daemon=True)
+    p.start()
+    return p
+
+
+def run_workers(workers=None, db_path=None):
+    """Run N warm workers; restart any that die or overrun a job's timeout."""
+    queue = JobQueue(db_path)
+    workers = max(1, workers or os.cpu_count() or 1)
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    names = [f"worker-{os.getpid()}-{i}" for i in range(workers)]
+    procs = {n: _start(queue.path, n, threads) for n in names}
+    # a service manager stops us with SIGTERM; take the workers down with us
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        while True:
+            time.sleep(1.0)
+            # a hung OCR call cannot be interrupted from inside; kill the process instead
+            for job_id, worker in queue.expire():
+                print(f"DEBUG: job {job_id} timed out on {worker}", file=sys.stderr, flush=True)
+                if worker in procs:
+                    procs[worker].terminate()
+                    procs[worker].join(5)
+            for n, p in procs.items():
+                if not p.is_alive():
+                    print(f"DEBUG: restarting {n}", file=sys.stderr, flush=True)
+                    procs[n] = _start(queue.path, n, threads)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in procs.values():
+            p.terminate()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Queue receipts for OCR and run the worker pool.")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("enqueue", help="queue an image (or - for stdin) and print its job id")
+    p.add_argument("image")
+    p.add_argument("--bulk", action="store_true", help="low priority back-fill job")
+    p.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT)
+    p.add_argument("--scope", default="", help="owner of the receipt (e.g. user id) for duplicate detection")
+    p = sub.add_parser("status", help="print a job record")
+    p.add_argument("job_id", type=int)
+    p = sub.add_parser("wait", help="block until a job finishes and print it")
+    p.add_argument("job_id", type=int)
+    p.add_argument("--timeout", type=float, default=None)
+    p = sub.add_parser("work", help="run the worker pool")
+    p.add_argument("-j", "--workers", type=int, default=None)
+    p = sub.add_parser("purge", help="delete finished jobs older than N hours")
+    p.add_argument("--hours", type=float, default=24.0)
+    args = ap.parse_args()
+
+    queue = JobQueue()
+    if args.cmd == "enqueue":
+        src = sys.stdin.buffer.read() if args.image == "-" else args.image
+        job_id = queue.enqueue(src, "bulk" if args.bulk else "interactive", timeout=args.timeout,
+                               scope=args.scope)
+        out = {"job_id": job_id}
+    elif args.cmd in ("status", "wait"):
+        rec = queue.status(args.job_id) if args.cmd == "status" else queue.wait(args.job_id, args.timeout)
+        out = rec if rec is not None else {"error": f"unknown job {args.job_id}"}
+    elif args.cmd == "purge":
+        out = {"purged": queue.purge(args.hours * 3600.0)}
+    else:
+        run_workers(args.workers)
+        return
+    print(json.dumps(out, ensure_ascii=False), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Per-stage latency timers, peak memory and a size-capped JSONL metrics log.
+
+    timer = StageTimer()
+    with timer.stage("ocr"):
+        ...
+    result["timings"] = timer.as_dict()
+
+Each extraction appends one line to ocr_metrics.jsonl next to this script
+(override with SMARTSPEND_OCR_METRICS=<path>, disable with =0), as a single
+O_APPEND write so concurrent processes never interleave. At
+SMARTSPEND_OCR_METRICS_MB (default 5) the file is moved aside to
+<path>.<time>-<pid>; the newest METRICS_BACKUPS of those are kept.
+"""
+import os, sys, json, time
+from contextlib import contextmanager
+
+DEFAULT_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ocr_metrics.jsonl")
+
+
+class StageTimer:
+    """Accumulates wall-clock milliseconds per named stage (monotonic clock)."""
+
+    def __init__(self):
+        self.timings = {}
+        self.info = {}          # non-timing facts, e.g. image dimensions
+        self._t0 = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - t) * 1000.0)
+
+    def add(self, name, ms):
+        self.timings[name] = self.timings.get(name, 0.0) + ms
+
+    def note(self, key, value):
+        self.info[key] = value
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self._t0) * 1000.0
+
+    def as_dict(self):
+        out = {k: round(v, 2) for k, v in self.timings.items()}
+        out["total"] = round(self.elapsed_ms(), 2)
+        return out
+
+
+class _NullTimer:
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def add(self, name, ms):
+        pass
+
+    def note(self, key, value):
+        pass
+
+    def elapsed_ms(self):
+        return 0.0
+
+
+NULL_TIMER = _NullTimer()
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, or None if unavailable."""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KiB, macOS bytes
+        return round(peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0, 1)
+    except ImportError:
+        pass
+    if os.name == "nt":
+        try:
+            import ctypes
+            from ctypes import wintypes
+
+            class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+                _fields_ = [
+                    ("cb", wintypes.DWORD),
+                    ("PageFaultCount", wintypes.DWORD),
+                    ("PeakWorkingSetSize", ctypes.c_size_t),
+                    ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t),
+                    ("PeakPagefileUsage", ctypes.c_size_t),
+                ]
+
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(counters)
+            handle = ctypes.windll.kernel32.GetCurrentProcess()
+            if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+                return round(counters.PeakWorkingSetSize / (1024.0 * 1024.0), 1)
+        except Exception:
+            pass
+    return None
+
+
+METRICS_BACKUPS = 3
+
+
+def _metrics_path():
+    path = os.environ.get("SMARTSPEND_OCR_METRICS", DEFAULT_LOG)
+    return None if path in ("", "0", "off") else path
+
+
+def _rotate(path, max_bytes):
+    """Move a full log aside under a name no other process picks; keep the newest METRICS_BACKUPS.
+
+    A writer that opened the file just before the rename finishes its line
+    in the moved file, so nothing is lost or interleaved.
+    """
+    try:
+        if os.path.getsize(path) < max_bytes:
+            return
+        os.rename(path, f"{path}.{time.time_ns():020d}-{os.getpid()}")
+    except OSError:
+        return  # rotated by another process already, or still open elsewhere (Windows)
+    import glob
+    for old in sorted(glob.glob(glob.escape(path) + ".*-*"))[:-METRICS_BACKUPS]:
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+
+
+def log_metrics(record):
+    """Append one JSON line to the metrics log; never raises.
+
+    Batch workers, the daemon and CLI runs share the file, so each line is
+    one O_APPEND write of its own open: no buffered handler, no lock.
+    """
+    path = _metrics_path()
+    if path is None:
+        return
+    try:
+        record = dict(record, ts=round(time.time(), 3), pid=os.getpid())
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        max_mb = float(os.environ.get("SMARTSPEND_OCR_METRICS_MB") or 5)
+        _rotate(path, int(max_mb * 1024 * 1024))
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_BINARY", 0), 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except Exception as e:
+        print(f"DEBUG: metrics log failed: {e}", file=sys.stderr, flush=True)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""Near-duplicate receipt detection: perceptual hashes searched through a BK-tree.
+
+    index = default_index()
+    index.nearest(phash, scope)  ->  {"distance": 3, "sha256": "...", "seen": 1730000000.0,
+                                      "version": "6:5", "result": {...}} or None
+    index.add(phash, sha256, result, scope, version)
+
+Every extracted receipt leaves its 64-bit perceptual hash (see
+extract_receipt.receipt_hash) and parsed result in a small SQLite file next
+to this script (override with SMARTSPEND_DUPES=<path>, disable with
+SMARTSPEND_DUPES=0). Each process keeps a BK-tree per scope (one per user,
+so receipts are never matched across accounts) over those rows and catches
+up on rows other processes added before every lookup, so a search within
+WARN_DISTANCE bits costs well under a millisecond and happens before OCR.
+
+Different photos of one receipt land within a few bits, but receipts from
+the same shop share a layout and can be just as close (two coffees on the
+same till roll differ only in a few digits). A perceptual match is therefore
+only a warning; the stored result stands in for OCR only when the image
+bytes are identical and it was produced by the same pipeline version (the
+caller compares "version"; storing the receipt again refreshes the result).
+
+A BK-tree search at WARN_DISTANCE stays sub-millisecond up to a few thousand
+receipts per scope. Each scope keeps its newest MAX_PER_SCOPE receipts and
+nothing older than MAX_AGE_DAYS.
+"""
+import os, json, time, sqlite3, threading
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "receipt_hashes.sqlite3")
+
+WARN_DISTANCE = 10
+MAX_PER_SCOPE = 5000
+MAX_AGE_DAYS = 400
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipt_hashes (
+    id       INTEGER PRIMARY KEY AUTOINCREMENT,
+    scope    TEXT NOT NULL,
+    phash    TEXT NOT NULL,     -- 16 hex digits
+    sha256   TEXT NOT NULL,     -- of the image bytes
+    created  REAL NOT NULL,
+    result   TEXT NOT NULL,
+    version  TEXT NOT NULL DEFAULT '',  -- pipeline that produced result
+    UNIQUE (scope, sha256)
+)
+"""
+
+
+class BKTree:
+    """Metric tree over Hamming distance; nodes are [hash, [items], {distance: child}]."""
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, h, item):
+        if self.root is None:
+            self.root = [h, [item], {}]
+            return
+        node = self.root
+        while True:
+            d = (node[0] ^ h).bit_count()
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, [item], {}]
+                return
+            node = child
+
+    def search(self, h, radius):
+        """[(distance, item)] within radius, nearest first."""
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = (node[0] ^ h).bit_count()
+            if d <= radius:
+                found.extend((d, item) for item in node[1])
+            # triangle inequality: only children at distance d +- radius can hold matches
+            for k, child in node[2].items():
+                if d - radius <= k <= d + radius:
+                    stack.append(child)
+        found.sort()
+        return found
+
+
+class DupeIndex:
+    def __init__(self, path=DEFAULT_PATH, max_per_scope=MAX_PER_SCOPE, max_age_days=MAX_AGE_DAYS):
+        self.path = path
+        self.max_per_scope = max_per_scope
+        self.max_age_s = max_age_days * 86400.0
+        self.trees = {}      # scope -> BKTree of row ids (evicted ids are skipped on lookup)
+        self.last_id = 0     # rows up to here are in the trees
+        self.lock = threading.Lock()
+        with self._connect() as db:
+            db.execute(_SCHEMA)
+            if "version" not in {c[1] for c in db.execute("PRAGMA table_info(receipt_hashes)")}:
+                # files from before results were versioned: their results never match one
+                db.execute("ALTER TABLE receipt_hashes ADD COLUMN version TEXT NOT NULL DEFAULT ''")
+            db.execute("CREATE INDEX IF NOT EXISTS receipt_hashes_age ON receipt_hashes(created)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5.0)
+
+    def _sync(self, db):
+        for row_id, scope, phash in db.execute(
+            "SELECT id, scope, phash FROM receipt_hashes WHERE id > ? ORDER BY id", (self.last_id,)
+        ):
+            self.trees.setdefault(scope, BKTree()).add(int(phash, 16), row_id)
+            self.last_id = row_id
+
+    def nearest(self, phash, scope="", radius=WARN_DISTANCE):
+        """Closest earlier receipt in this scope within radius bits, or None."""
+        with self.lock, self._connect() as db:
+            self._sync(db)
+            tree = self.trees.get(scope)
+            hits = tree.search(phash, radius) if tree is not None else []
+            for distance, row_id in hits:
+                row = db.execute(
+                    "SELECT sha256, created, version, result FROM receipt_hashes WHERE id = ?", (row_id,)
+                ).fetchone()
+                if row is not None:  # None: evicted, possibly by another process
+                    sha, created, version, result = row
+                    return {"distance": distance, "sha256": sha, "seen": created, "version": version,
+                            "result": json.loads(result)}
+        return None
+
+    def add(self, phash, sha256, result, scope="", version=""):
+        """Remember a receipt; the same image bytes are stored once per scope (latest result kept)."""
+        with self.lock, self._connect() as db:
+            db.execute(
+                "INSERT INTO receipt_hashes (scope, phash, sha256, created, result, version) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (scope, sha256) DO UPDATE SET result = excluded.result, version = excluded.version",
+                (scope, f"{phash:016x}", sha256, time.time(), json.dumps(result, ensure_ascii=False), version),
+            )
+            if self._evict(db, scope):
+                self.trees, self.last_id = {}, 0  # rebuilt from the remaining rows below
+            self._sync(db)
+
+    def _evict(self, db, scope):
+        """Drop rows past max_age_s, and this scope's oldest past max_per_scope; True if any went."""
+        gone = db.execute("DELETE FROM receipt_hashes WHERE created < ?",
+                          (time.time() - self.max_age_s,)).rowcount
+        count = db.execute("SELECT COUNT(*) FROM receipt_hashes WHERE scope = ?", (scope,)).fetchone()[0]
+        if count > self.max_per_scope:
+            # trim to 90% so the trees are not rebuilt on every add once a scope is full
+            keep = int(self.max_per_scope * 0.9)
+            gone += db.execute(
+                "DELETE FROM receipt_hashes WHERE id IN (SELECT id FROM receipt_hashes WHERE scope = ? "
+                "ORDER BY created, id LIMIT ?)", (scope, count - keep),
+            ).rowcount
+        return gone > 0
+
+
+_default = None
+
+
+def default_index():
+    """Process-wide index from the environment, or None when disabled."""
+    global _default
+    path = os.environ.get("SMARTSPEND_DUPES", DEFAULT_PATH)
+    if path in ("", "0", "off"):
+        return None
+    if _default is None or _default.path != path:
+        try:
+            _default = DupeIndex(path)
+        except sqlite3.Error:
+            return None
+    return _default
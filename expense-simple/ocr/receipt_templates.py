@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Per-merchant receipt layouts learned from receipts that parsed cleanly.
+
+    store = default_store()
+    store.get("99 Speedmart")  ->  {"anchor": "total", "tail": 0.41, "amount_x": [0.74, 0.79], "dated": true, ...}
+    store.learn("99 Speedmart", {"anchor": "total", "tail": 0.43, "amount_x": 0.76, "dated": true})
+    store.failed("99 Speedmart")
+
+A layout (see extract_receipt.layout_sample) holds the keyword on the total
+row, where that row's amount ends (fraction of the page width) and how much
+page is left below the last useful row, total or date (in page widths, which
+stay the same for a chain while the page height grows with the item count),
+and whether the receipt had a date. Learning keeps the smallest tail, the
+widest amount_x range and "dated" once any receipt had a date, so a layout
+only ever gets more cautious.
+
+Layouts are only handed out after MIN_SAMPLES receipts agreed, and are
+forgotten after MAX_FAILURES receipts in a row failed validation (the chain
+changed its till roll). They live in a small SQLite file next to this script
+(override with SMARTSPEND_TEMPLATES=<path>, disable with
+SMARTSPEND_TEMPLATES=0). Only layout facts are stored, never amounts or
+items, so templates are shared by all users.
+"""
+import os, json, time, sqlite3
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "receipt_templates.sqlite3")
+
+MIN_SAMPLES = 2
+MAX_FAILURES = 2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipt_templates (
+    merchant TEXT PRIMARY KEY,    -- canonical name from merchants.json
+    layout   TEXT NOT NULL,       -- JSON, see merge()
+    samples  INTEGER NOT NULL,
+    failures INTEGER NOT NULL DEFAULT 0,
+    updated  REAL NOT NULL
+)
+"""
+
+
+def merge(layout, sample):
+    """Fold one receipt's sample into a stored layout (None for the first)."""
+    if layout is None:
+        return {"anchors": {sample["anchor"]: 1}, "tail": sample["tail"],
+                "amount_x": [sample["amount_x"], sample["amount_x"]], "dated": sample["dated"]}
+    anchors = dict(layout["anchors"])
+    anchors[sample["anchor"]] = anchors.get(sample["anchor"], 0) + 1
+    lo, hi = layout["amount_x"]
+    return {"anchors": anchors, "tail": min(layout["tail"], sample["tail"]),
+            "amount_x": [min(lo, sample["amount_x"]), max(hi, sample["amount_x"])],
+            "dated": layout.get("dated", True) or sample["dated"]}
+
+
+class TemplateStore:
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        with self._connect() as db:
+            db.execute(_SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5.0)
+
+    def any_usable(self):
+        """True when some merchant has a layout to hand out (one cheap query)."""
+        try:
+            with self._connect() as db:
+                row = db.execute("SELECT 1 FROM receipt_templates WHERE samples >= ? LIMIT 1",
+                                 (MIN_SAMPLES,)).fetchone()
+        except sqlite3.Error:
+            return False
+        return row is not None
+
+    def usable(self, merchant):
+        """True when get(merchant) would return a layout (one cheap query)."""
+        try:
+            with self._connect() as db:
+                row = db.execute("SELECT 1 FROM receipt_templates WHERE merchant = ? AND samples >= ?",
+                                 (merchant, MIN_SAMPLES)).fetchone()
+        except sqlite3.Error:
+            return False  # a busy store only means the generic path this time
+        return row is not None
+
+    def get(self, merchant):
+        """Layout with its most common "anchor", or None until MIN_SAMPLES receipts agreed."""
+        with self._connect() as db:
+            row = db.execute("SELECT layout, samples FROM receipt_templates WHERE merchant = ?",
+                             (merchant,)).fetchone()
+        if row is None or row[1] < MIN_SAMPLES:
+            return None
+        layout = json.loads(row[0])
+        layout["anchor"] = max(layout["anchors"], key=layout["anchors"].get)
+        layout.setdefault("dated", True)  # learned before "dated" existed: assume the cautious answer
+        layout["samples"] = row[1]
+        return layout
+
+    def learn(self, merchant, sample):
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")  # read-modify-write; other workers wait
+            row = db.execute("SELECT layout, samples FROM receipt_templates WHERE merchant = ?",
+                             (merchant,)).fetchone()
+            layout = merge(json.loads(row[0]) if row else None, sample)
+            db.execute(
+                "INSERT OR REPLACE INTO receipt_templates (merchant, layout, samples, failures, updated) "
+                "VALUES (?, ?, ?, 0, ?)",
+                (merchant, json.dumps(layout, ensure_ascii=False), (row[1] if row else 0) + 1, time.time()),
+            )
+
+    def failed(self, merchant):
+        """Count a failed validation; the layout is dropped after MAX_FAILURES in a row."""
+        with self._connect() as db:
+            db.execute("UPDATE receipt_templates SET failures = failures + 1, updated = ? WHERE merchant = ?",
+                       (time.time(), merchant))
+            db.execute("DELETE FROM receipt_templates WHERE merchant = ? AND failures >= ?",
+                       (merchant, MAX_FAILURES))
+
+
+_default = None
+
+
+def default_store():
+    """Process-wide store from the environment, or None when disabled."""
+    global _default
+    path = os.environ.get("SMARTSPEND_TEMPLATES", DEFAULT_PATH)
+    if path in ("", "0", "off"):
+        return None
+    if _default is None or _default.path != path:
+        try:
+            _default = TemplateStore(path)
+        except sqlite3.Error:
+            return None
+    return _default
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""pytest setup: the OCR modules are flat scripts, import them from the parent directory.
+
+    cd expense-simple/ocr && python -m pytest -q tests
+"""
+import os, sys
+
+import pytest
+
+OCR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if OCR_DIR not in sys.path:
+    sys.path.insert(0, OCR_DIR)
+
+
+@pytest.fixture(autouse=True)
+def private_stores(tmp_path, monkeypatch):
+    """Every SQLite store and log in a fresh temp directory, never next to the scripts."""
+    for var, name in (("SMARTSPEND_OCR_CACHE", "ocr_cache.sqlite3"),
+                      ("SMARTSPEND_DUPES", "receipt_hashes.sqlite3"),
+                      ("SMARTSPEND_TEMPLATES", "receipt_templates.sqlite3"),
+                      ("SMARTSPEND_OCR_JOBS", "ocr_jobs.sqlite3"),
+                      ("SMARTSPEND_OCR_METRICS", "ocr_metrics.jsonl")):
+        monkeypatch.setenv(var, str(tmp_path / name))
+    return tmp_path
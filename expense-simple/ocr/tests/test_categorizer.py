@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import sys
+
+import pytest
+
+import categorizer
+import extract_receipt as er
+
+lc = pytest.importorskip("learned_categorizer")
+
+
+@pytest.fixture
+def model_dir(tmp_path, monkeypatch):
+    path = tmp_path / "category_model"
+    monkeypatch.setenv("SMARTSPEND_CATEGORY_MODEL", str(path))
+    monkeypatch.setattr(categorizer, "_shared", None)
+    return path
+
+
+def _save(path, labels):
+    texts = ["nasi lemak", "teh tarik", "panadol", "shampoo"]
+    lc.train(texts, labels, bits=8, epochs=5).save(str(path))
+
+
+def test_parser_version_follows_the_model(model_dir):
+    assert er.parser_version() == er.PARSER_VERSION  # rules only
+    _save(model_dir, ["Food & Dining", "Food & Dining", "Health", "Shopping"])
+    first = er.parser_version()
+    assert first.startswith(er.PARSER_VERSION + "+")
+    _save(model_dir, ["Food & Dining", "Food & Dining", "Shopping", "Health"])  # retrained
+    assert er.parser_version() != first
+    assert er.result_version().endswith(er.parser_version())
+
+
+def test_loaded_model_keeps_its_version(model_dir):
+    _save(model_dir, ["Food & Dining", "Food & Dining", "Health", "Shopping"])
+    categorizer.get_categorizer()
+    loaded = er.parser_version()
+    _save(model_dir, ["Food & Dining", "Food & Dining", "Shopping", "Health"])
+    assert er.parser_version() == loaded  # this process still predicts with the old one
+
+
+def test_cached_results_are_reparsed_after_retraining(model_dir, monkeypatch):
+    import ocr_cache
+    monkeypatch.setenv("SMARTSPEND_DUPES", "0")
+    cache = ocr_cache.default_cache()
+    page = {"lines": ["TOTAL 5.00"], "rows": []}
+    key = ocr_cache.image_key(b"jpeg", er.pipeline_version())
+    cache.put(key, page, {"amount": "stale"}, er.parser_version())
+    assert er.extract(b"jpeg", ocr=None)["amount"] == "stale"
+    _save(model_dir, ["Food & Dining", "Food & Dining", "Health", "Shopping"])
+    assert er.extract(b"jpeg", ocr=None)["amount"] == "5.00"
+
+
+def test_featurize_rows_without_words():
+    texts = ["nasi lemak", "", "teh tarik", "--", ""]
+    indptr, indices, data = lc.featurize(texts, bits=8)
+    assert list(indptr[1:] - indptr[:-1] == 0) == [False, True, False, True, True]
+    for i in (0, 2):
+        row = data[indptr[i]:indptr[i + 1]]
+        assert float((row * row).sum()) == pytest.approx(1.0, abs=1e-5)
+    model = lc.train(["nasi lemak", "teh tarik", "panadol", "shampoo"],
+                     ["Food & Dining", "Food & Dining", "Health", "Shopping"], bits=8, epochs=5)
+    assert len(model.predict(["nasi lemak", "", "..."])) == 3
+
+
+def test_shared_memo_survives_concurrent_batches(monkeypatch):
+    import threading
+    monkeypatch.setattr(categorizer, "_MEMO_LIMIT", 8)  # clears all the time
+    cat = categorizer.ReceiptCategorizer(None)
+    descs = [f"nasi lemak {i}" for i in range(40)] + [f"panadol {i}" for i in range(40)]
+    want = [cat._rule_category(d) for d in descs]
+    errors = []
+
+    def work():
+        try:
+            for _ in range(30):
+                assert cat.predict_many(descs) == want
+        except Exception as e:  # KeyError from a memo emptied under our feet
+            errors.append(e)
+    threads = [threading.Thread(target=work) for _ in range(6)]
+    old = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # switch threads as often as possible
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setswitchinterval(old)
+    assert errors == []
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from merchants import MerchantIndex, default_index, max_edits
+
+
+@pytest.fixture(scope="module")
+def index():
+    return default_index()
+
+
+@pytest.mark.parametrize("line", [
+    "SUNWAY PYRAMID",           # one edit from "subway"
+    "Bandar Sunway",
+    "PRIMA",                    # one deletion from "primax"
+    "Lot 5, Jalan Aeon",        # the street, not the shop
+    "16A, Jalan Astaka U8/83, Bukit Jelutong",
+    "40150 Shah Alam, Selangor D.E.",
+    "S HELL",                   # a short alias does not span extra tokens
+])
+def test_no_false_positives(index, line):
+    assert index.match_line(line) is None
+
+
+@pytest.mark.parametrize("line, name", [
+    ("SUBWAY", "Subway"),
+    ("PRIMAX", "Primax"),
+    ("AEON BIG", "AEON"),
+    ("FAMILY HART", "FamilyMart"),     # OCR slip in a long alias
+    ("99 SPEED MART SDN. BHD.", "99 Speedmart"),
+    ("MR. DIY", "MR DIY"),
+    ("Mc Donald s", "McDonald's"),
+])
+def test_header_matches(index, line, name):
+    m = index.match_line(line)
+    assert m is not None and m["name"] == name
+
+
+def test_address_line_is_not_an_exact_match_either(index):
+    assert index.resolve(["Lot 5, Jalan Aeon", "Nasi Lemak 5.00"]) is None
+    assert index.resolve(["Receipt", "Lot 5, Jalan Aeon", "AEON"])["name"] == "AEON"
+
+
+def test_short_aliases_take_no_edits():
+    assert max_edits(6) == 0
+    assert max_edits(7) == 1
+    ix = MerchantIndex([{"name": "Tealive", "aliases": ["tealive"]}, {"name": "KFC"}])
+    assert ix.match_line("TEALIVF")["name"] == "Tealive"
+    assert ix.match_line("KFD") is None
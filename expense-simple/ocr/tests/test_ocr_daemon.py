@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import base64, os, socket, threading
+
+import pytest
+
+import extract_receipt
+import ocr_daemon
+
+REFUSED = dict(extract_receipt.empty_result(), error="path_not_allowed")
+
+
+@pytest.fixture
+def server(monkeypatch):
+    seen = []
+
+    def fake(src, ocr, **kw):
+        seen.append((src, kw))
+        return {"amount": "1.00"}
+    monkeypatch.setattr(extract_receipt, "extract", fake)
+    monkeypatch.setattr(extract_receipt, "extract_many", fake)
+    monkeypatch.delenv("SMARTSPEND_OCR_ROOTS", raising=False)
+    srv = ocr_daemon.OCRServer(("127.0.0.1", 0), ocr=None)
+    srv.seen = seen
+    yield srv
+    srv.server_close()
+
+
+def test_dump_path_is_not_part_of_the_protocol(server, tmp_path):
+    target = tmp_path / "owned.png"
+    msg = {"op": "extract", "image_b64": base64.b64encode(b"jpeg").decode("ascii"),
+           "dump_path": str(target)}
+    assert server.dispatch(msg) == {"amount": "1.00"}
+    assert server.dispatch(dict(msg, multi=True)) == {"amount": "1.00"}
+    assert all("dump_path" not in kw for _, kw in server.seen)
+    assert not target.exists()
+
+
+def test_paths_refused_without_roots(server, tmp_path):
+    img = tmp_path / "r.jpg"
+    img.write_bytes(b"jpeg")
+    assert server.dispatch({"op": "extract", "path": str(img)}) == REFUSED
+    assert server.seen == []
+
+
+def test_paths_confined_to_roots(server, tmp_path, monkeypatch):
+    inside = tmp_path / "uploads"
+    inside.mkdir()
+    (inside / "r.jpg").write_bytes(b"jpeg")
+    (tmp_path / "secret.txt").write_text("x")
+    monkeypatch.setenv("SMARTSPEND_OCR_ROOTS", str(inside))
+
+    assert server.dispatch({"op": "extract", "path": str(inside / "r.jpg")}) == {"amount": "1.00"}
+    assert server.seen[-1][0] == os.path.realpath(str(inside / "r.jpg"))
+    for path in (str(inside / ".." / "secret.txt"), str(tmp_path / "secret.txt"),
+                 str(inside), str(inside / "missing.jpg"), "", None):
+        assert server.dispatch({"op": "extract", "path": path}) == REFUSED
+    if hasattr(os, "symlink"):
+        os.symlink(str(tmp_path / "secret.txt"), str(inside / "link.jpg"))
+        assert server.dispatch({"op": "extract", "path": str(inside / "link.jpg")}) == REFUSED
+
+
+def test_client_sends_bytes_not_paths(tmp_path, monkeypatch):
+    img = tmp_path / "r.jpg"
+    img.write_bytes(b"jpeg")
+    sent = []
+    monkeypatch.setattr(ocr_daemon, "_call", lambda msg, *a, **kw: sent.append(msg) or {"ok": 1})
+    ocr_daemon.request_extract(str(img), scope="7")
+    assert sent == [{"op": "extract", "image_b64": base64.b64encode(b"jpeg").decode("ascii"), "scope": "7"}]
+
+
+def _listener(behaviour):
+    """A one-connection daemon stand-in on a free port; behaviour(conn) plays the daemon's part."""
+    srv = socket.socket()
+    srv.bind(("127.0.0.1", 0))
+    srv.listen(1)
+
+    def accept():
+        conn, _ = srv.accept()
+        with conn:
+            conn.makefile("rb").readline()
+            behaviour(conn)
+        srv.close()
+    threading.Thread(target=accept, daemon=True).start()
+    return srv.getsockname()[1]
+
+
+def test_no_daemon_runs_locally():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()  # nothing listens there
+    assert ocr_daemon.request_extract(b"jpeg", port=port) is None
+
+
+def test_daemon_failing_mid_request_is_an_error_not_a_rerun():
+    partials = []
+
+    def partial_then_drop(conn):
+        conn.sendall(b'{"partial": true, "amount": "5.00"}\n')
+    port = _listener(partial_then_drop)
+    reply = ocr_daemon.request_extract(b"jpeg", port=port, on_partial=partials.append)
+    assert reply["error"].startswith("daemon_failed") and reply["items"] == [] and reply["merchant"] == ""
+    assert partials == [{"partial": True, "amount": "5.00"}]
+
+
+def test_daemon_timeout_is_an_error():
+    done = threading.Event()
+    port = _listener(lambda conn: done.wait(2))
+    reply = ocr_daemon._call({"op": "extract"}, port=port, timeout=0.2)
+    done.set()
+    assert reply["error"].startswith("daemon_failed") and set(extract_receipt.empty_result()) <= set(reply)
+
+
+def test_error_replies_carry_the_result_keys(server):
+    reply = server.dispatch({"op": "nope"})
+    assert reply == dict(extract_receipt.empty_result(), error="unknown_op: nope")
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import json, os
+
+import pytest
+
+import ocr_engine
+
+OCR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def profiles(tmp_path, monkeypatch):
+    path = tmp_path / "ocr_profiles.json"
+    path.write_text(json.dumps({"active": "default", "profiles": {
+        "default": {}, "strict": {"det_box_thresh": 0.6}, "default-4t": {"threads": 4}}}))
+    monkeypatch.setenv("SMARTSPEND_OCR_PROFILES", str(path))
+    monkeypatch.delenv("SMARTSPEND_OCR_PROFILE", raising=False)
+    return path
+
+
+def test_fingerprint_follows_reading_settings_only(profiles):
+    default = ocr_engine.profile_tag("default")[1]
+    assert ocr_engine.profile_tag("strict")[1] != default
+    assert ocr_engine.profile_tag("default-4t")[1] == default  # threads only change speed
+
+
+def test_fingerprint_follows_model_files(profiles, tmp_path):
+    model = tmp_path / "det.onnx"
+    model.write_bytes(b"fp32")
+    cfg = dict(ocr_engine.DEFAULTS, det_model=str(model))
+    before = ocr_engine.fingerprint(cfg)
+    model.write_bytes(b"int8 weights")  # quantized over the same path
+    assert ocr_engine.fingerprint(cfg) != before
+
+
+class FakeOCR:
+    calls = 0
+
+    def ocr(self, img):
+        FakeOCR.calls += 1
+        return [[[[[0, 0], [600, 0], [600, 40], [0, 40]], ("FAMILYMART", 0.99)],
+                 [[[0, 60], [600, 60], [600, 100], [0, 100]], ("TOTAL 12.50", 0.99)]]]
+
+
+def test_switching_profile_misses_the_cache(profiles, monkeypatch):
+    pytest.importorskip("cv2")
+    import extract_receipt as er
+    monkeypatch.setenv("SMARTSPEND_TEMPLATES", "0")
+    with open(os.path.join(OCR_DIR, "_work_69046c7ca05f6.jpg_clean.png"), "rb") as f:
+        png = f.read()
+
+    assert er.extract(png, FakeOCR(), scope="1")["cache"] == "miss"
+    assert er.extract(png, FakeOCR(), scope="1")["cache"] == "duplicate"
+    monkeypatch.setenv("SMARTSPEND_OCR_PROFILE", "strict")
+    calls = FakeOCR.calls
+    again = er.extract(png, FakeOCR(), scope="1")
+    assert again["cache"] == "miss" and FakeOCR.calls > calls
+
+    # an engine keeps the profile it was built from, whatever the environment says now
+    built = FakeOCR()
+    built.smartspend_profile = ocr_engine.profile_tag("default")
+    calls = FakeOCR.calls
+    assert er.extract(png, built)["cache"] == "hit" and FakeOCR.calls == calls
+
+
+def test_strip_engines_copy_the_callers_profile(profiles, monkeypatch):
+    import extract_receipt as er
+    monkeypatch.setattr(er, "_tile_engines", {})
+    built = []
+
+    def create(profile=None):
+        eng = FakeOCR()
+        eng.smartspend_profile = ocr_engine.profile_tag(profile)
+        built.append(profile)
+        return eng
+    monkeypatch.setattr(er, "create_ocr", create)
+
+    caller = FakeOCR()
+    caller.smartspend_profile = ocr_engine.profile_tag("strict")
+    pool = er._checkout_engines(caller, 3)
+    engines = [pool.get() for _ in range(pool.qsize())]
+    assert built == ["strict", "strict"] and engines[0] is caller
+    assert {e.smartspend_profile for e in engines} == {caller.smartspend_profile}
+    for e in engines:
+        pool.put(e)
+    er._return_engines(pool, caller)
+    assert er._checkout_engines(caller, 3).qsize() == 3 and len(built) == 2  # reused
+
+    assert er._checkout_engines(FakeOCR(), 3).qsize() == 1  # no profile to copy
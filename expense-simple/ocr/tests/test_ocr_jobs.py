@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+import extract_receipt
+from ocr_jobs import JobQueue, run_job
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs.sqlite3"))
+
+
+def _extract_returning(result, seen=None):
+    def fake(src, ocr, scope=""):
+        if seen is not None:
+            seen.append((src, scope))
+        return dict(result)
+    return fake
+
+
+def test_done_with_result(queue, monkeypatch):
+    seen = []
+    monkeypatch.setattr(extract_receipt, "extract", _extract_returning({"amount": "5.00"}, seen))
+    job_id = queue.enqueue(b"jpeg", scope="7")
+    run_job(queue, "w", queue.claim("w"), ocr=None)
+    rec = queue.status(job_id)
+    assert rec["state"] == "done" and rec["result"] == {"amount": "5.00"}
+    assert seen == [(b"jpeg", "7")]
+
+
+def test_error_result_is_a_failed_attempt(queue, monkeypatch):
+    # an OCR engine failure (OCRError text) may not happen again
+    monkeypatch.setattr(extract_receipt, "extract", _extract_returning({"error": "could not allocate memory"}))
+    job_id = queue.enqueue(b"jpeg", max_attempts=2)
+    run_job(queue, "w", queue.claim("w"), ocr=None)
+    rec = queue.status(job_id)
+    assert rec["state"] == "queued" and rec["error"] == "could not allocate memory"
+    run_job(queue, "w", queue.claim("w"), ocr=None)
+    rec = queue.status(job_id)
+    assert rec["state"] == "failed" and rec["result"] is None
+
+
+@pytest.mark.parametrize("error", ["file_missing_or_empty", "ValueError: could not convert string to float"])
+def test_permanent_error_fails_at_once(queue, monkeypatch, error):
+    monkeypatch.setattr(extract_receipt, "extract", _extract_returning({"error": error}))
+    job_id = queue.enqueue(b"jpeg", max_attempts=3)
+    run_job(queue, "w", queue.claim("w"), ocr=None)
+    rec = queue.status(job_id)
+    assert rec["state"] == "failed" and rec["error"] == error and rec["attempts"] == 1
+    assert queue.claim("w") is None
+
+
+def test_exception_is_a_failed_attempt(queue, monkeypatch):
+    def boom(src, ocr, scope=""):
+        raise RuntimeError("engine died")
+    monkeypatch.setattr(extract_receipt, "extract", boom)
+    job_id = queue.enqueue(b"jpeg", max_attempts=1)
+    run_job(queue, "w", queue.claim("w"), ocr=None)
+    assert queue.status(job_id)["error"] == "RuntimeError: engine died"
+
+
+def test_interactive_before_bulk(queue):
+    bulk = queue.enqueue(b"a", "bulk")
+    interactive = queue.enqueue(b"b")
+    assert queue.claim("w")[0] == interactive
+    assert queue.claim("w")[0] == bulk
+    assert queue.claim("w") is None
+
+
+def test_expire_requeues_and_reports(queue):
+    job_id = queue.enqueue(b"a", timeout=0.0)
+    queue.claim("w")
+    time.sleep(0.01)
+    assert queue.expire() == [(job_id, "w")]
+    assert queue.status(job_id)["state"] == "queued"
+    assert queue.expire() == []
+    # the late answer of the worker that lost its lease is dropped
+    queue.complete(job_id, "w", {"amount": "1.00"})
+    assert queue.status(job_id)["state"] == "queued"
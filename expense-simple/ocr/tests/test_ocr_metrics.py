@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import glob, json, multiprocessing, os
+
+import pytest
+
+import ocr_metrics
+
+
+def _write(n):
+    for i in range(n):
+        ocr_metrics.log_metrics({"i": i, "pad": "x" * 200})
+
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="needs fork")
+def test_processes_sharing_the_log_lose_no_lines(tmp_path, monkeypatch):
+    path = str(tmp_path / "ocr_metrics.jsonl")
+    monkeypatch.setenv("SMARTSPEND_OCR_METRICS", path)
+    monkeypatch.setenv("SMARTSPEND_OCR_METRICS_MB", "0.02")  # rotates every ~80 lines
+    monkeypatch.setattr(ocr_metrics, "METRICS_BACKUPS", 1000)
+    ctx = multiprocessing.get_context("fork")
+    procs = [ctx.Process(target=_write, args=(200,)) for _ in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    files = [path] + glob.glob(path + ".*-*")
+    assert len(files) > 2
+    records = [json.loads(line) for f in files for line in open(f, encoding="utf-8")]
+    assert len(records) == 800
+    assert len({(r["pid"], r["i"]) for r in records}) == 800
+
+
+def test_old_logs_are_pruned(tmp_path, monkeypatch):
+    path = str(tmp_path / "ocr_metrics.jsonl")
+    monkeypatch.setenv("SMARTSPEND_OCR_METRICS", path)
+    monkeypatch.setenv("SMARTSPEND_OCR_METRICS_MB", "0.001")
+    _write(50)
+    assert len(glob.glob(path + ".*-*")) == ocr_metrics.METRICS_BACKUPS
+    assert os.path.getsize(path) < 2048
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import os, sqlite3, time
+
+import pytest
+
+import receipt_dupes
+from receipt_dupes import DupeIndex
+
+cv2 = pytest.importorskip("cv2")
+import extract_receipt as er  # noqa: E402
+
+OCR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeOCR:
+    calls = 0
+
+    def ocr(self, img):
+        FakeOCR.calls += 1
+        return [[[[[0, 0], [600, 0], [600, 40], [0, 40]], ("FAMILYMART", 0.99)],
+                 [[[0, 60], [600, 60], [600, 100], [0, 100]], ("TOTAL 12.50", 0.99)]]]
+
+
+@pytest.fixture
+def receipt_jpeg():
+    img = cv2.imread(os.path.join(OCR_DIR, "_work_69046c7ca05f6.jpg_clean.png"))
+    return cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+
+@pytest.fixture(autouse=True)
+def no_cache(monkeypatch):
+    monkeypatch.setenv("SMARTSPEND_OCR_CACHE", "0")  # every miss below is a real OCR call
+    monkeypatch.setenv("SMARTSPEND_TEMPLATES", "0")
+
+
+def test_same_bytes_reuse_the_stored_result(receipt_jpeg):
+    first = er.extract(receipt_jpeg, FakeOCR(), scope="1")
+    calls = FakeOCR.calls
+    again = er.extract(receipt_jpeg, FakeOCR(), scope="1")
+    assert first["amount"] == again["amount"] == "12.50"
+    assert again["cache"] == "duplicate" and FakeOCR.calls == calls
+
+
+def test_result_from_another_version_is_redone(receipt_jpeg, monkeypatch):
+    er.extract(receipt_jpeg, FakeOCR(), scope="1")
+    calls = FakeOCR.calls
+    monkeypatch.setattr(er, "PARSER_VERSION", er.PARSER_VERSION + "-next")
+    again = er.extract(receipt_jpeg, FakeOCR(), scope="1")
+    assert again.get("cache") != "duplicate" and FakeOCR.calls > calls
+    assert again["duplicate_of"]["distance"] == 0  # still reported
+    assert er.extract(receipt_jpeg, FakeOCR(), scope="1")["cache"] == "duplicate"  # refreshed
+
+
+def test_no_scope_no_lookup(receipt_jpeg):
+    er.extract(receipt_jpeg, FakeOCR())
+    again = er.extract(receipt_jpeg, FakeOCR())
+    assert "duplicate_of" not in again
+    assert er.extract(receipt_jpeg, FakeOCR(), scope="2").get("duplicate_of") is None
+
+
+def test_scopes_are_separate(tmp_path):
+    index = DupeIndex(str(tmp_path / "d.sqlite3"))
+    index.add(0xFF, "a" * 64, {"amount": "1.00"}, scope="1", version="v")
+    assert index.nearest(0xFE, "1")["version"] == "v"
+    assert index.nearest(0xFE, "2") is None
+
+
+def test_eviction_by_count_and_age(tmp_path):
+    index = DupeIndex(str(tmp_path / "d.sqlite3"), max_per_scope=10, max_age_days=1)
+    for i in range(11):
+        index.add(i << 32, f"{i:064x}", {"n": i}, scope="1")
+    with sqlite3.connect(index.path) as db:
+        assert db.execute("SELECT COUNT(*) FROM receipt_hashes").fetchone()[0] == 9
+    assert index.nearest(0, "1", radius=0) is None  # the oldest went
+    assert index.nearest(10 << 32, "1", radius=0)["result"] == {"n": 10}
+
+    with sqlite3.connect(index.path) as db:
+        db.execute("UPDATE receipt_hashes SET created = ?", (time.time() - 2 * 86400,))
+    index.add(1, "f" * 64, {}, scope="2")
+    assert index.nearest(10 << 32, "1", radius=0) is None
+
+
+def test_evicted_rows_are_skipped_by_other_processes(tmp_path):
+    path = str(tmp_path / "d.sqlite3")
+    reader, writer = DupeIndex(path), DupeIndex(path)
+    writer.add(0, "a" * 64, {"n": 1}, scope="1")
+    writer.add(1, "b" * 64, {"n": 2}, scope="1")
+    assert reader.nearest(0, "1")["result"] == {"n": 1}
+    with sqlite3.connect(path) as db:
+        db.execute("DELETE FROM receipt_hashes WHERE sha256 = ?", ("a" * 64,))
+    assert reader.nearest(0, "1")["result"] == {"n": 2}
+
+
+def test_old_file_gets_a_version_column(tmp_path):
+    path = str(tmp_path / "d.sqlite3")
+    with sqlite3.connect(path) as db:
+        db.execute("CREATE TABLE receipt_hashes (id INTEGER PRIMARY KEY AUTOINCREMENT, scope TEXT NOT NULL, "
+                   "phash TEXT NOT NULL, sha256 TEXT NOT NULL, created REAL NOT NULL, result TEXT NOT NULL, "
+                   "UNIQUE (scope, sha256))")
+        db.execute("INSERT INTO receipt_hashes (scope, phash, sha256, created, result) VALUES "
+                   "('1', '00000000000000ff', 'x', ?, '{}')", (time.time(),))
+    assert DupeIndex(path).nearest(0xFF, "1")["version"] == ""
+
+
+def test_default_index_off(monkeypatch):
+    monkeypatch.setenv("SMARTSPEND_DUPES", "0")
+    assert receipt_dupes.default_index() is None
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+import receipt_templates
+from receipt_templates import TemplateStore, merge
+
+cv2 = pytest.importorskip("cv2")
+np = pytest.importorskip("numpy")
+import extract_receipt as er  # noqa: E402
+
+OCR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+W = 1200
+
+
+def receipt(n_items, dated=True, footer=10, header="99 SPEED MART SDN. BHD."):
+    """(clean page, [(text, y0, y1, x0, x1)], total) for a short receipt, 99 Speedmart by default."""
+    rows = [[(header, 300, 800)], [("INVOICE 00123", 10, 400)]]
+    total = 0.0
+    for i in range(n_items):
+        price = 1.5 + i
+        total += price
+        rows.append([(f"Gula pasir jenama {chr(65 + i)}", 10, 500), (f"{price:.2f}", 1000, 1100)])
+    rows.append([("TOTAL RM", 10, 300), (f"{total:.2f}", 1000, 1100)])
+    if dated:
+        rows.append([("07/10/2025 13:36", 10, 500)])
+    rows += [[(f"Thank you come again {j}", 100, 900)] for j in range(footer)]
+    lines = [(t, 40 + 70 * i, 76 + 70 * i, x0, x1) for i, cells in enumerate(rows) for t, x0, x1 in cells]
+    clean = np.full((60 + 70 * len(rows), W), 255, np.uint8)
+    # each strip handed to the engine starts with its page offset in the first two pixels
+    ys = np.arange(clean.shape[0])
+    clean[:, 0], clean[:, 1] = ys // 256, ys % 256
+    return clean, lines, total
+
+
+class FakeOCR:
+    def __init__(self):
+        self.lines, self.calls = [], []
+
+    def ocr(self, img):
+        h = img.shape[0]
+        self.calls.append(h)
+        top = int(img[0, 0, 0]) * 256 + int(img[0, 1, 0])
+        out = []
+        for t, y0, y1, x0, x1 in self.lines:
+            a, b = y0 - top, y1 - top
+            if 0 <= a and b <= h:
+                out.append([[[x0, a], [x1, a], [x1, b], [x0, b]], (t, 0.95)])
+        return [out]
+
+
+@pytest.fixture
+def run(monkeypatch):
+    """run(n_items, dated=True, scope="u", header=...) extracts a fresh upload of one photo."""
+    page = {}
+    monkeypatch.setattr(er, "decode_image", lambda data, quad=None: page["clean"][:, :, None].repeat(3, 2))
+    monkeypatch.setattr(er, "locate_receipt", lambda img: None)
+    monkeypatch.setattr(er, "preprocess_image",
+                        lambda img, dump_path=None, timer=None, return_gray=False, quad=None:
+                        (page["clean"], page["clean"]))
+    photo = cv2.imread(os.path.join(OCR_DIR, "_work_69037f891a178.jpg_clean.png"))
+    engine = FakeOCR()
+    uploads = iter(range(60, 100))
+
+    def run(n_items, dated=True, scope="u", **kw):
+        page["clean"], engine.lines, total = receipt(n_items, dated, **kw)
+        engine.calls.clear()
+        # the same receipt photographed again: other bytes, (almost) the same perceptual hash
+        data = cv2.imencode(".jpg", photo, [cv2.IMWRITE_JPEG_QUALITY, next(uploads)])[1].tobytes()
+        result = er.extract(data, engine, scope=scope)
+        assert result["amount"] == f"{total:.2f}" and len(result["items"]) == n_items
+        return result, list(engine.calls)
+    return run
+
+
+def test_learned_layout_cuts_the_read_short(run):
+    for n in (5, 8):
+        _, calls = run(n)
+        assert len(calls) == 1  # nothing learned yet: one ordinary pass
+    layout = receipt_templates.default_store().get("99 Speedmart")
+    assert layout["anchor"] == "total" and layout["dated"] is True
+
+    result, calls = run(6)
+    assert result["date"] == "2025-10-07"
+    assert len(calls) == 2 and sum(calls) < receipt(6)[0].shape[0]  # header, then down to the cut
+
+
+def test_template_reads_are_not_cached(run):
+    import ocr_cache
+    run(5), run(8)
+    run(6)
+    with ocr_cache.default_cache()._connect() as db:
+        assert db.execute("SELECT COUNT(*) FROM ocr_cache").fetchone()[0] == 2
+
+
+def test_missing_date_fails_the_layout_and_reads_everything(run):
+    run(5), run(8)
+    result, calls = run(6, dated=False)
+    assert result["date"] == ""
+    assert len(calls) == 3 and calls[-1] == receipt(6, dated=False)[0].shape[0]  # cut, then a full read
+    with receipt_templates.default_store()._connect() as db:
+        assert db.execute("SELECT failures FROM receipt_templates").fetchone()[0] == 1
+
+
+def test_merchant_comes_from_the_header_not_a_near_duplicate(run, monkeypatch):
+    run(5), run(8)
+    monkeypatch.setenv("SMARTSPEND_DUPES", "0")  # no earlier receipt to go by
+    result, calls = run(6, scope="")
+    assert result["merchant"] == "99 Speedmart"
+    assert len(calls) == 2 and sum(calls) < receipt(6)[0].shape[0]
+
+
+def test_other_shops_are_read_to_the_bottom(run):
+    run(5), run(8)
+    result, calls = run(6, header="KEDAI RUNCIT ALI")
+    h = receipt(6, header="KEDAI RUNCIT ALI")[0].shape[0]
+    assert len(calls) == 2 and sum(calls) >= h  # header band, then everything below it
+
+
+def test_no_layouts_no_header_pass(run):
+    _, calls = run(6)
+    assert len(calls) == 1
+
+def test_merge_is_cautious():
+    a = merge(None, {"anchor": "total", "tail": 0.4, "amount_x": 0.8, "dated": False})
+    b = merge(a, {"anchor": "total", "tail": 0.3, "amount_x": 0.7, "dated": True})
+    assert b["tail"] == 0.3 and b["amount_x"] == [0.7, 0.8] and b["dated"] is True
+    assert merge(b, {"anchor": "jumlah", "tail": 0.5, "amount_x": 0.8, "dated": False})["dated"] is True
+
+
+def test_store_needs_samples_and_forgets_failures(tmp_path):
+    store = TemplateStore(str(tmp_path / "t.sqlite3"))
+    sample = {"anchor": "total", "tail": 0.4, "amount_x": 0.8, "dated": True}
+    store.learn("Shop", sample)
+    assert store.get("Shop") is None and not store.usable("Shop")
+    store.learn("Shop", sample)
+    assert store.usable("Shop") and store.get("Shop")["samples"] == 2
+    store.failed("Shop")
+    store.failed("Shop")
+    assert store.get("Shop") is None
@@ -179,46 +179,58 @@ if ($_SERVER['REQUEST_METHOD']==='POST' && ($_POST['action'] ?? '')==='upload_re
         $script    = dirname(__DIR__) . '/ocr/extract_receipt.py';
         $python    = getenv('SMARTSPEND_PYTHON') ?: 'C:\\Users\\acer\\AppData\\Local\\Programs\\Python\\Python310\\python.exe';
 
-        // 2) Write a stable temp copy next to /ocr (Windows sometimes locks PHP temp files)
-        $workImg = dirname(__DIR__) . DIRECTORY_SEPARATOR . 'ocr' . DIRECTORY_SEPARATOR . ('_work_' . uniqid() . '.' . $ext);
-        file_put_contents($workImg, $data);
-
-        // 3) Build command (DO NOT use 2>&1 — we want stderr separated)
+        // 2) Build command (DO NOT use 2>&1 — we want stderr separated).
+        //    "-" makes the script read the image bytes from stdin, so nothing is written under /ocr.
+        //    --scope keeps duplicate-receipt detection within this user's own uploads;
+        //    --compact also returns the smaller rendition we store instead of the photo.
+        $scope = (string)(int)$u['id'];
         $cmd = (PHP_OS_FAMILY === 'Windows')
-          ? '"' . $python . '" "' . $script . '" "' . $workImg . '"'
-          : escapeshellarg($python) . ' ' . escapeshellarg($script) . ' ' . escapeshellarg($workImg);
+          ? '"' . $python . '" "' . $script . '" - --compact --scope ' . $scope
+          : escapeshellarg($python) . ' ' . escapeshellarg($script) . ' - --compact --scope ' . $scope;
 
-        // 4) Run with proc_open so we can read stdout and stderr independently
+        // 3) Run with proc_open so we can read stdout and stderr independently
         $descriptors = [
-          0 => ['pipe', 'r'], // stdin
+          0 => ['pipe', 'r'], // stdin  -> image bytes
           1 => ['pipe', 'w'], // stdout -> JSON
           2 => ['pipe', 'w'], // stderr -> logs
         ];
         $proc = proc_open($cmd, $descriptors, $pipes);
         $stdout = $stderr = ''; $exit = -1;
         if (is_resource($proc)) {
-          fclose($pipes[0]);                                // we won't write to stdin
+          fwrite($pipes[0], $data); fclose($pipes[0]);      // the script reads all of stdin before OCR
           $stdout = stream_get_contents($pipes[1]); fclose($pipes[1]);
           $stderr = stream_get_contents($pipes[2]); fclose($pipes[2]);
           $exit   = proc_close($proc);
         }
 
-        // 5) Clean up the working image
-        @unlink($workImg);
-
-        // 6) Write a single debug file with everything (don’t overwrite it again later)
+        // 4) Write a single debug file with everything (don’t overwrite it again later)
         file_put_contents(
           dirname(__DIR__) . '/ocr_last_output.txt',
           "CMD:\n$cmd\n\nEXIT:$exit\n\nSTDOUT:\n$stdout\n\nSTDERR:\n$stderr"
         );
 
-        // 7) Decode ONLY stdout (this is the clean JSON from extract_receipt.py)
+        // 5) Decode ONLY stdout (this is the clean JSON from extract_receipt.py)
         $ocrData = json_decode($stdout, true);
         if ($ocrData === null) {
           error_log('OCR JSON decode error: ' . json_last_error_msg());
           $flash = 'Could not parse OCR output. Open ocr_last_output.txt for details.';
         }
 
+        // Keep the cropped grayscale rendition rather than the multi-MB photo
+        // (PDFs and images that would not get smaller come back without one)
+        if (is_array($ocrData) && !empty($ocrData['storage']['image_b64'])) {
+          $stored = $ocrData['storage'];
+          $review['blob'] = $stored['image_b64'];
+          $review['type'] = $stored['type'];
+          $review['b64']  = 'data:' . $stored['type'] . ';base64,' . $stored['image_b64'];
+          error_log('Receipt stored at ' . (int)$stored['stored_bytes'] . ' bytes, ' . (int)$stored['saved_bytes'] . ' saved');
+        }
+
+        if (is_array($ocrData) && !empty($ocrData['duplicate_of'])) {
+          $seen  = date('Y-m-d', (int)($ocrData['duplicate_of']['seen'] ?? time()));
+          $flash = 'This receipt looks like one you already uploaded on ' . $seen . '. Check your expenses before saving so it is not counted twice.';
+        }
+
         if (is_array($ocrData)) {
           // Helpers for mapping and normalization
           $mapToKnown = function(string $label, array $known) {
@@ -436,7 +448,9 @@ if (isset($_GET['del'])) {
 }
 
 /* --- Load filtered data --- */
-$listStmt = $pdo->prepare("SELECT * FROM expenses WHERE $whereSql ORDER BY date DESC, id DESC");
+// Only whether a receipt exists: pulling every blob made the list as slow as the receipts were big
+$listStmt = $pdo->prepare("SELECT id, date, category, amount, note, receipt_blob IS NOT NULL AS has_receipt
+                           FROM expenses WHERE $whereSql ORDER BY date DESC, id DESC");
 $listStmt->execute($args);
 $data = $listStmt->fetchAll();
 
@@ -581,7 +595,7 @@ layout_header('Expense'); ?>
           </div>
         </div>
         <div class="d-flex align-items-center gap-2">
-          <?php if (!empty($r['receipt_blob'])): ?>
+          <?php if (!empty($r['has_receipt'])): ?>
             <a class="btn btn-sm btn-outline-primary" href="view_receipt.php?id=<?= (int)$r['id'] ?>" target="_blank">
             🧾 View
             </a>